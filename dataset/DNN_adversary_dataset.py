@@ -6,19 +6,27 @@ import glob
 import re
 import numpy as np
 import os
-from lru import LRU
+from dataset.adversary_corpus import SharedImageCache, convert_npz_corpus
 from dataset.protocol_enum import SPLIT_DATA_PROTOCOL
 
 
 class AdversaryDataset(data.Dataset):
-    def __init__(self, root_path, train, protocol, META_ATTACKER_PART_I, META_ATTACKER_PART_II, balance, use_cache=True):
+    '''
+    The images are read from the npy corpus converted once from each npz (see adversary_corpus), which is mapped with mmap
+    in every process, img_label_list holds (file_id, index, adv_label). With use_cache a SharedImageCache of cache_mb
+    is shared by all DataLoader workers, cache_stats reports its hit rate.
+    '''
+    def __init__(self, root_path, train, protocol, META_ATTACKER_PART_I, META_ATTACKER_PART_II, balance, use_cache=True,
+                 cache_mb=1024):
         self.root_path = root_path
         self.use_cache = use_cache
         filter_str = "train"
         if not train:
             filter_str = "test"
         extract_pattern = re.compile("(.*?)_untargeted.*")
-        self.cache = LRU(16)
+        self.npy_paths = []
+        self.file_offsets = []  # the global index of the first image of each npy file, the key of the cache
+        num_total_images = 0
         self.img_label_list = []
         self.img_label_dict = defaultdict(list)
         for npz_path in glob.glob(root_path + "/*{}.npz".format(filter_str)):
@@ -38,43 +46,61 @@ class AdversaryDataset(data.Dataset):
                 if adv_name not in META_ATTACKER_PART_II:
                     continue
 
-            data = np.load(npz_path)
+            npy_path = convert_npz_corpus(npz_path)
+            data = np.load(npz_path)  # 只解压label, 不解压adv_images
             adv_pred = data["adv_pred"]
             gt_label = data["gt_label"]
+            file_id = len(self.npy_paths)
+            self.npy_paths.append(npy_path)
+            self.file_offsets.append(num_total_images)
+            num_total_images += len(gt_label)
 
             if adv_name == "clean":
                 adv_label = 1
-                adv_images = data["adv_images"]
-                if self.use_cache:
-                    self.cache[npz_path] = adv_images
-                indexes = np.arange(adv_images.shape[0])
+                indexes = np.arange(len(gt_label))
             else:
                 adv_label = 0
                 indexes = np.where(adv_pred != gt_label)[0]
             for index in indexes:
-                self.img_label_dict[adv_label].append((npz_path, index, adv_label))
+                self.img_label_dict[adv_label].append((file_id, index, adv_label))
             print("{} done".format(npz_path))
         self.img_label_list.extend(self.img_label_dict[1])
         if balance:
             self.img_label_list.extend(random.sample(self.img_label_dict[0], len(self.img_label_dict[1])))
         else:
             self.img_label_list.extend(self.img_label_dict[0])
+        self._images = None
+        self.cache = None
+        if self.use_cache and self.npy_paths:
+            images = self.images[0]  # 10000,32,32,3
+            capacity = max(1, min(num_total_images, cache_mb * 1024 ** 2 // images[0].nbytes))
+            self.cache = SharedImageCache(capacity, images.shape[1:], images.dtype)
+
+    @property
+    def images(self):
+        if self._images is None:
+            self._images = [np.load(npy_path, mmap_mode="r") for npy_path in self.npy_paths]
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None  # each process maps the npy files by itself
+        return state
+
+    def cache_stats(self):
+        return None if self.cache is None else self.cache.stats()
 
     def __len__(self):
         return len(self.img_label_list)
 
 
     def __getitem__(self, item):
-        npz_path, index, label = self.img_label_list[item]
-        if self.use_cache and npz_path in self.cache:
-            adv_images = self.cache[npz_path]
+        file_id, index, label = self.img_label_list[item]
+        if self.cache is not None:
+            adv_image = self.cache.get(self.file_offsets[file_id] + index,
+                                       lambda key: np.array(self.images[file_id][index]))
         else:
-            data = np.load(npz_path)
-            adv_images = data["adv_images"]  # 10000,32,32,3
-            if self.use_cache:
-                self.cache[npz_path] = adv_images
-
-        adv_image = adv_images[index]
+            adv_image = np.array(self.images[file_id][index])  # one image of I/O
         adv_image = np.transpose(adv_image, (2,0,1))
 
         return adv_image, label
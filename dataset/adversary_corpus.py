@@ -0,0 +1,76 @@
+import ctypes
+import multiprocessing
+import os
+
+import numpy as np
+
+'''
+Contiguous NPY corpus of the adversarial npz files and the shared image cache of AdversaryDataset.
+Every npz corpus is converted once into a raw npy file of its adv_images next to it, which is opened with mmap,
+so reading one image costs the I/O of one image instead of decompressing the whole 10000 images array.
+The cache lives in shared memory created in the main process, the DataLoader workers forked from it all read and fill
+the same slots instead of keeping one copy of the data per worker.
+'''
+
+IMAGES_SUFFIX = ".images.npy"
+NUM_STRIPES = 64
+
+
+def images_npy_path(npz_path):
+    return npz_path[:-len(".npz")] + IMAGES_SUFFIX
+
+
+def convert_npz_corpus(npz_path):
+    ''' write the adv_images of npz_path to the raw npy file once, return the npy path '''
+    npy_path = images_npy_path(npz_path)
+    if os.path.exists(npy_path):
+        return npy_path
+    adv_images = np.load(npz_path)["adv_images"]
+    tmp_path = npy_path + ".tmp"
+    with open(tmp_path, "wb") as file_obj:
+        np.save(file_obj, np.ascontiguousarray(adv_images))
+    os.replace(tmp_path, npy_path)  # a npy file exists only when it is complete
+    print("convert {} to {}".format(npz_path, npy_path))
+    return npy_path
+
+
+class SharedImageCache(object):
+    '''
+    Direct-mapped image cache in shared memory: the image of key k lives in slot k % capacity.
+    It must be created in the main process before the DataLoader workers are forked (the default on Linux).
+    The slots are guarded by striped locks, the hits and misses are counted per stripe and summed by stats.
+    '''
+
+    def __init__(self, capacity, image_shape, dtype):
+        self.capacity = capacity
+        self.image_shape = tuple(image_shape)
+        self.dtype = np.dtype(dtype)
+        num_bytes = capacity * int(np.prod(self.image_shape)) * self.dtype.itemsize
+        self._data = multiprocessing.RawArray(ctypes.c_uint8, num_bytes)
+        self._keys = multiprocessing.RawArray(ctypes.c_longlong, capacity)
+        self._counts = multiprocessing.RawArray(ctypes.c_longlong, 2 * NUM_STRIPES)
+        self.locks = [multiprocessing.Lock() for _ in range(NUM_STRIPES)]
+        self.data = np.frombuffer(self._data, dtype=self.dtype).reshape((capacity,) + self.image_shape)
+        self.keys = np.frombuffer(self._keys, dtype=np.int64)
+        self.counts = np.frombuffer(self._counts, dtype=np.int64).reshape(NUM_STRIPES, 2)  # hits, misses
+        self.keys[:] = -1
+
+    def get(self, key, load):
+        ''' the image of key, load(key) reads it on a miss '''
+        slot = key % self.capacity
+        stripe = slot % NUM_STRIPES
+        with self.locks[stripe]:
+            if self.keys[slot] == key:
+                self.counts[stripe, 0] += 1
+                return self.data[slot].copy()
+            self.counts[stripe, 1] += 1
+        image = load(key)
+        with self.locks[stripe]:
+            self.data[slot] = image
+            self.keys[slot] = key
+        return image
+
+    def stats(self):
+        hits, misses = self.counts.sum(axis=0).tolist()
+        return {"hits": hits, "misses": misses, "hit_rate": hits / max(1, hits + misses),
+                "MB": self.data.nbytes / 1024 ** 2}
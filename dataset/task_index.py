@@ -0,0 +1,101 @@
+import os
+import shutil
+
+import numpy as np
+
+from config import META_ATTACKER_INDEX
+
+# column name -> dtype, one row per image of a task: support images first, then query images
+ROW_COLUMNS = {"file_ids": np.int32, "image_offsets": np.int32, "img_gt_labels": np.uint8, "adv_labels": np.uint8,
+               "way_labels": np.uint8, "adversary_ids": np.uint8}
+# column name -> dtype, one row per task
+TASK_COLUMNS = {"task_offsets": np.int64, "num_support": np.int32, "positive_labels": np.uint8}
+
+
+class TaskIndex(object):
+    '''
+    Columnar index of all tasks of a MetaTaskDataset, which replaces the pickled dict of per-image dicts.
+    Each column is one npy file inside the index directory and is loaded with mmap, file_paths is the string table
+    of the source npy files and file_ids points into it, image_offsets is the image index inside that npy file.
+    The rows of task i are task_offsets[i]:task_offsets[i+1], the first num_support[i] of them are the support set.
+    '''
+
+    def __init__(self, index_path):
+        self.index_path = index_path
+        for column in list(ROW_COLUMNS.keys()) + list(TASK_COLUMNS.keys()):
+            setattr(self, column, np.load("{}/{}.npy".format(index_path, column), mmap_mode="r"))
+        self.file_paths = np.load("{}/file_paths.npy".format(index_path)).tolist()
+
+    def __len__(self):
+        return len(self.task_offsets) - 1
+
+    def task_rows(self, task_index):
+        ''' return the rows of support set and query set '''
+        start, end = int(self.task_offsets[task_index]), int(self.task_offsets[task_index + 1])
+        middle = start + int(self.num_support[task_index])
+        return np.arange(start, middle), np.arange(middle, end)
+
+    def adversary_index(self, task_index):
+        ''' the META_ATTACKER_INDEX index of the adversary of the task, -1 if the task has no unique adversary '''
+        start, end = int(self.task_offsets[task_index]), int(self.task_offsets[task_index + 1])
+        adversary_ids = np.unique(self.adversary_ids[start:end][self.adv_labels[start:end] == 0])
+        if len(adversary_ids) != 1:
+            return -1
+        return int(adversary_ids[0])
+
+    @staticmethod
+    def exists(index_path):
+        return os.path.exists("{}/task_offsets.npy".format(index_path))
+
+    @staticmethod
+    def build(tasks, index_path):
+        '''
+        tasks: list of (positive_label, support_items, query_items),
+        each item is (img_gt_label, way_label, adv_label, adversary, npy_path, image_idx)
+        '''
+        file_ids = {}
+        rows = {column: [] for column in ROW_COLUMNS.keys()}
+        task_offsets = [0]
+        num_support = []
+        positive_labels = []
+        for positive_label, support_items, query_items in tasks:
+            for img_gt_label, way_label, adv_label, adversary, npy_path, image_idx in support_items + query_items:
+                rows["file_ids"].append(file_ids.setdefault(npy_path, len(file_ids)))
+                rows["image_offsets"].append(image_idx)
+                rows["img_gt_labels"].append(img_gt_label)
+                rows["adv_labels"].append(adv_label)
+                rows["way_labels"].append(way_label)
+                rows["adversary_ids"].append(META_ATTACKER_INDEX.index(adversary))
+            task_offsets.append(task_offsets[-1] + len(support_items) + len(query_items))
+            num_support.append(len(support_items))
+            positive_labels.append(positive_label)
+        columns = {column: np.array(values, dtype=ROW_COLUMNS[column]) for column, values in rows.items()}
+        columns["task_offsets"] = np.array(task_offsets, dtype=TASK_COLUMNS["task_offsets"])
+        columns["num_support"] = np.array(num_support, dtype=TASK_COLUMNS["num_support"])
+        columns["positive_labels"] = np.array(positive_labels, dtype=TASK_COLUMNS["positive_labels"])
+        columns["file_paths"] = np.array(sorted(file_ids.keys(), key=file_ids.get))
+
+        tmp_path = index_path + ".tmp"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        for column, array in columns.items():
+            np.save("{}/{}.npy".format(tmp_path, column), array)
+        # rename at last, so that an interrupted build is never mistaken for a complete index
+        shutil.rmtree(index_path, ignore_errors=True)
+        os.replace(tmp_path, index_path)
+        print("write task index of {} tasks to {}".format(len(num_support), index_path))
+
+    @staticmethod
+    def from_all_tasks(all_tasks):
+        ''' convert the former pickled all_tasks dict to the tasks list of build '''
+        tasks = []
+        for task_index in sorted(all_tasks.keys()):
+            task_items = {"support": [], "query": []}
+            for data_json in all_tasks[task_index]:
+                image_path = data_json["img_path"]
+                task_items[data_json["type"]].append((int(data_json["img_gt_label"]), int(data_json["way_label"]),
+                                                      int(data_json["adv_label"]), data_json["adversary"],
+                                                      image_path[:image_path.rindex("#")],
+                                                      int(image_path[image_path.rindex("#") + 1:])))
+            tasks.append((all_tasks[task_index][0]["pos_label"], task_items["support"], task_items["query"]))
+        return tasks
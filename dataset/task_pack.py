@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+
+from config import IMAGE_SIZE, IN_CHANNELS
+
+IMAGES_SUFFIX = ".images.npy"
+INDEX_SUFFIX = ".index.npz"
+
+
+class TaskPack(object):
+    '''
+    Packed, memory-mapped store of all tasks of a MetaTaskDataset.
+    The images of every task are written once (C,H,W flattened, float32) into one contiguous npy file,
+    support images first and then query images, an offset index locates each task's block.
+    Reading a task is then a slice of the mapped file instead of one open/np.memmap/close per image.
+    The file is mapped lazily so that every DataLoader worker maps it after fork and shares the OS page cache.
+    '''
+
+    def __init__(self, pack_path):
+        self.pack_path = pack_path
+        index = np.load(pack_path + INDEX_SUFFIX)
+        self.task_offsets = index["task_offsets"]  # num_tasks + 1, the start of task i is task_offsets[i]
+        self.num_support = index["num_support"]  # support image count of each task
+        self.positive_labels = index["positive_labels"]
+        self.adversary_indexes = index["adversary_indexes"]  # -1 if the task has no (unique) adversary
+        self.img_gt_labels = index["img_gt_labels"]
+        self.adv_labels = index["adv_labels"]
+        self.way_labels = index["way_labels"]
+        self._images = None
+
+    @property
+    def images(self):
+        if self._images is None:
+            # copy-on-write mapping, so torch.from_numpy gets a writable zero-copy view and the file is never modified
+            self._images = np.load(self.pack_path + IMAGES_SUFFIX, mmap_mode="c")
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None  # each DataLoader worker maps the file by itself
+        return state
+
+    def __len__(self):
+        return len(self.task_offsets) - 1
+
+    def get_task(self, task_index, no_random_way):
+        start, end = self.task_offsets[task_index], self.task_offsets[task_index + 1]
+        middle = start + self.num_support[task_index]
+        labels = self.adv_labels if no_random_way else self.way_labels
+        return self.images[start:middle], self.img_gt_labels[start:middle], labels[start:middle], \
+               self.images[middle:end], self.img_gt_labels[middle:end], labels[middle:end], \
+               int(self.adversary_indexes[task_index]), int(self.positive_labels[task_index])
+
+    @staticmethod
+    def exists(pack_path):
+        return os.path.exists(pack_path + IMAGES_SUFFIX) and os.path.exists(pack_path + INDEX_SUFFIX)
+
+    @staticmethod
+    def build(task_index, dataset, pack_path):
+        '''
+        Write the tasks of the TaskIndex of MetaTaskDataset into a task pack located at pack_path.
+        The support and query images of each task are shuffled once here, instead of in every __getitem__.
+        '''
+        height, width = IMAGE_SIZE[dataset]
+        channels = IN_CHANNELS[dataset]
+        dim_input = height * width * channels
+        num_tasks = len(task_index)
+        total_images = int(task_index.task_offsets[num_tasks])
+
+        task_offsets = np.zeros(num_tasks + 1, dtype=np.int64)
+        num_support = np.zeros(num_tasks, dtype=np.int64)
+        positive_labels = np.zeros(num_tasks, dtype=np.int64)
+        adversary_indexes = np.full(num_tasks, -1, dtype=np.int64)
+        img_gt_labels = np.zeros(total_images, dtype=np.int64)
+        adv_labels = np.zeros(total_images, dtype=np.int64)
+        way_labels = np.zeros(total_images, dtype=np.int64)
+
+        os.makedirs(os.path.dirname(pack_path), exist_ok=True)
+        tmp_images_path = pack_path + ".tmp" + IMAGES_SUFFIX
+        images = np.lib.format.open_memmap(tmp_images_path, mode="w+", dtype=np.float32, shape=(total_images, dim_input))
+        source_npy = {}  # each source npy file is only mapped once during the whole build
+        position = 0
+        for i in range(num_tasks):
+            if i % 1000 == 0:
+                print("pack {} tasks".format(i))
+            support_rows, query_rows = task_index.task_rows(i)
+            np.random.shuffle(support_rows)
+            np.random.shuffle(query_rows)
+            adversary_indexes[i] = task_index.adversary_index(i)
+            positive_labels[i] = task_index.positive_labels[i]
+            num_support[i] = len(support_rows)
+            task_offsets[i] = position
+            for row in np.concatenate([support_rows, query_rows]):
+                file_id = int(task_index.file_ids[row])
+                if file_id not in source_npy:
+                    source_npy[file_id] = np.memmap(task_index.file_paths[file_id], dtype='float32',
+                                                    mode='r').reshape(-1, height, width, channels)
+                im = source_npy[file_id][task_index.image_offsets[row]]
+                images[position] = np.transpose(im, axes=(2, 0, 1)).reshape(dim_input)  # C,H,W
+                img_gt_labels[position] = task_index.img_gt_labels[row]
+                adv_labels[position] = task_index.adv_labels[row]
+                way_labels[position] = task_index.way_labels[row]
+                position += 1
+        task_offsets[num_tasks] = position
+        images.flush()
+        del images
+        source_npy.clear()
+        np.savez(pack_path + ".tmp" + INDEX_SUFFIX, task_offsets=task_offsets, num_support=num_support,
+                 positive_labels=positive_labels, adversary_indexes=adversary_indexes,
+                 img_gt_labels=img_gt_labels, adv_labels=adv_labels, way_labels=way_labels)
+        # rename at last, so that an interrupted build is never mistaken for a complete pack
+        os.replace(tmp_images_path, pack_path + IMAGES_SUFFIX)
+        os.replace(pack_path + ".tmp" + INDEX_SUFFIX, pack_path + INDEX_SUFFIX)
+        print("write task pack to {}".format(pack_path))
@@ -0,0 +1,147 @@
+import glob
+import os
+import pickle
+import random
+import re
+import shutil
+from functools import lru_cache
+from multiprocessing import Pool
+
+from config import META_ATTACKER_INDEX
+
+'''
+Sharded task sampling of MetaTaskDataset.
+The task range is cut into shards of a fixed size and every shard samples with its own random.Random seeded by
+(seed, shard index), so the sampled tasks only depend on the seed, not on the number of worker processes.
+Each finished shard is saved in a checkpoint directory, an interrupted run resumes from the missing shards.
+The folder listings and the count.txt of each folder are read once per process and cached.
+'''
+
+SHARD_SIZE = 500
+extract_gt_label_pattern = re.compile(".*(\d+)_(\d+).*")
+
+
+@lru_cache(maxsize=None)
+def list_class_folders(root_pattern):
+    ''' all class folders (ClassID_attackIDX) under the root folders matched by root_pattern '''
+    folders = []
+    for root_folder in sorted(glob.glob(root_pattern)):
+        for label in sorted(os.listdir(root_folder)):  # label = ClassID_attackIDX
+            if os.path.isdir(os.path.join(root_folder, label)):
+                folders.append(os.path.join(root_folder, label))
+    return tuple(folders)
+
+
+@lru_cache(maxsize=None)
+def read_image_count(path):
+    with open(path + "/" + "count.txt", "r") as file_obj:
+        return int(file_obj.read().strip())
+
+
+def image_counts(folders, is_test):
+    ''' count of images of every folder, read in the parent process and passed to the workers '''
+    if is_test:
+        return {orig_path + "/" + sq: read_image_count(orig_path + "/" + sq) for orig_path in folders
+                for sq in ["support", "query"]}
+    return {orig_path: read_image_count(orig_path) for orig_path in folders}
+
+
+def image_item(npy_path, idx, way_label):
+    ma = extract_gt_label_pattern.match(npy_path)
+    img_gt_label = int(ma.group(1))
+    adv_label = int(ma.group(2))
+    adversary = META_ATTACKER_INDEX[adv_label - 1]  # clean = 1,所以从1 开始 -1，则从0开始
+    if adv_label != 1:
+        adv_label = 0  # real image == 1, adv image == 0
+    return img_gt_label, way_label, adv_label, adversary, npy_path, idx
+
+
+def get_image_paths(rng, paths, num_support, num_query, is_test, counts):
+    support_images = []
+    query_images = []
+    for i, orig_path in enumerate(paths):  # for循环一个path就表示一个way
+        if orig_path.endswith("_1"):
+            positive_label = i
+        if not is_test:
+            npy_path = orig_path + "/train.npy"
+            N = counts[orig_path]
+            all_index = list(range(N))
+            support_idx = rng.sample(all_index, num_support)
+            rest_idx = sorted(set(all_index) - set(support_idx))
+            try:
+                query_idx = rng.sample(rest_idx, num_query)
+            except ValueError:
+                print("error in sample from {} N = {} sampling {}".format(orig_path, N, num_query))
+                raise
+            support_images.extend(image_item(npy_path, idx, i) for idx in support_idx)
+            query_images.extend(image_item(npy_path, idx, i) for idx in query_idx)
+        else:
+            for sq, num, label_images in [("support", num_support, support_images), ("query", num_query, query_images)]:
+                path = orig_path + "/{}".format(sq)
+                N = counts[path]
+                if N < num:
+                    raise IOError('please check that whether each class contains enough images for the {} set,'
+                                  'the class path is :  {}'.format(sq, path))
+                sampled_images = rng.sample(range(N), num)  # support和query不能有交集
+                label_images.extend(image_item("{}/{}.npy".format(path, sq), idx, i) for idx in sampled_images)
+    return support_images, query_images, positive_label
+
+
+def sample_task_folders(rng, folder_p, folder_n, num_classes):
+    p_folder = rng.sample(folder_p, 1)  # 只有一个way是正样本
+    n_folder = rng.sample(folder_n, num_classes - 1)  # 剩余的1-way都是负样本
+    task_folders = p_folder + n_folder
+    rng.shuffle(task_folders)  # 每个task为task_folders随机安排的class id. 所以no_random_way也是作用在这里
+    return task_folders
+
+
+def sample_shard(job):
+    shard_idx, num_tasks, seed, folder_p, folder_n, counts, num_classes, num_support, num_query, is_test, shard_path = job
+    rng = random.Random(seed * 1000003 + shard_idx)
+    tasks = []
+    for _ in range(num_tasks):
+        try:
+            supp_items, query_items, positive_label = get_image_paths(
+                rng, sample_task_folders(rng, folder_p, folder_n, num_classes), num_support, num_query, is_test, counts)
+        except IOError:  # 重来一遍 sample, 这个way放弃
+            supp_items, query_items, positive_label = get_image_paths(
+                rng, sample_task_folders(rng, folder_p, folder_n, num_classes), num_support, num_query, is_test, counts)
+        tasks.append((positive_label, supp_items, query_items))
+    with open(shard_path + ".tmp", "wb") as file_obj:
+        pickle.dump(tasks, file_obj, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(shard_path + ".tmp", shard_path)  # a shard file exists only when it is complete
+    return shard_idx
+
+
+def sample_tasks(num_total_tasks, folder_p, folder_n, num_classes, num_support, num_query, is_test, checkpoint_dir,
+                 num_workers=1, seed=1337):
+    '''
+    Sample num_total_tasks tasks in the format of TaskIndex.build, the shards already in checkpoint_dir are reused.
+    Remove checkpoint_dir with clear_checkpoint after the tasks are saved.
+    '''
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    folder_p, folder_n = list(folder_p), list(folder_n)
+    counts = image_counts(folder_p + folder_n, is_test)
+    num_shards = (num_total_tasks + SHARD_SIZE - 1) // SHARD_SIZE
+    shard_paths = ["{}/shard_{}.pkl".format(checkpoint_dir, shard_idx) for shard_idx in range(num_shards)]
+    jobs = [(shard_idx, min(SHARD_SIZE, num_total_tasks - shard_idx * SHARD_SIZE), seed, folder_p, folder_n, counts,
+             num_classes, num_support, num_query, is_test, shard_paths[shard_idx])
+            for shard_idx in range(num_shards) if not os.path.exists(shard_paths[shard_idx])]
+    if len(jobs) < num_shards:
+        print("resume task sampling from {}, {}/{} shards are done".format(checkpoint_dir, num_shards - len(jobs), num_shards))
+    if num_workers > 1 and len(jobs) > 1:
+        with Pool(min(num_workers, len(jobs))) as pool:
+            for done, shard_idx in enumerate(pool.imap_unordered(sample_shard, jobs)):
+                print("store shard {} ({}/{})".format(shard_idx, done + 1, len(jobs)))
+    else:
+        for done, job in enumerate(jobs):
+            print("store shard {} ({}/{})".format(sample_shard(job), done + 1, len(jobs)))
+    tasks = []
+    for shard_path in shard_paths:
+        with open(shard_path, "rb") as file_obj:
+            tasks.extend(pickle.load(file_obj))
+    return tasks
+
+
+def clear_checkpoint(checkpoint_dir):
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
@@ -2,61 +2,29 @@ import os
 import re
 from collections import defaultdict
 
-import copy
-
-from torch.optim import SGD
 from torch.utils.data import DataLoader
 import torch
 from config import PY_ROOT, IN_CHANNELS, IMAGE_SIZE
+from evaluation_toolkit.adaptation_engine import AdaptationEngine
 from evaluation_toolkit.evaluation import finetune_eval_task_accuracy
 from networks.conv3 import Conv3
 from dataset.meta_task_dataset import MetaTaskDataset
 from dataset.protocol_enum import SPLIT_DATA_PROTOCOL, LOAD_TASK_MODE
-from meta_adv_detector.score import forward_pass, evaluate_two_way
-import numpy as np
-import time
+from toolkit.device import to_device, module_to_device
 
-def speed_test(network, val_loader, inner_lr, num_updates, update_BN=True):
-    # test_net = copy.deepcopy(network)
+def speed_test(network, val_loader, inner_lr, num_updates, update_BN=True, cache=None):
     # Select ten tasks randomly from the test set to evaluate_accuracy on
-    test_net = copy.deepcopy(network)
-    all_times  = []
+    engine = AdaptationEngine(network, inner_lr, num_updates, update_BN, cache=cache)
     # support_images,support_gt_labels, support_binary_labels, query_images, query_gt_labels, query_binary_labels
     for val_idx, (support_images, _, support_labels, query_images, _, query_labels, positive_labels) in enumerate(val_loader):
         # print("process task {}  task_batch={}".format(val_idx, len(support_images)))
-        support_labels = support_labels.cuda()
-        query_labels = query_labels.cuda()
+        support_labels = to_device(support_labels)
+        query_labels = to_device(query_labels)
         for task_idx in range(support_images.size(0)):
-            # Make a test net with same parameters as our current net
-            test_net = copy.deepcopy(network)
-            test_net.cuda()
-            test_opt = SGD(test_net.parameters(), lr=inner_lr)
-            support_task, support_target = support_images[task_idx], support_labels[task_idx]
-            test_net.train()
-
-            before_time = time.time()
-            if not update_BN:
-                for m in test_net.modules():
-                    if isinstance(m, torch.nn.BatchNorm2d):
-                        m.eval()
-            for i in range(num_updates):  # 先fine_tune
-                loss, out = forward_pass(test_net, support_task, support_target)
-                test_opt.zero_grad()
-                loss.backward()
-                test_opt.step()
-            test_net.eval()
-            query_acc, query_F1_score = evaluate_two_way(test_net, query_images[task_idx], query_labels[task_idx])
-            pass_time = time.time() - before_time
-            all_times.append(pass_time)
-            test_net.eval()
-            # Evaluate the trained model on train and val examples
-
-    mean_time_elapse = np.mean(all_times)
-    std_var_time_elapse = np.var(all_times)
-    result_json = {"mean_time":mean_time_elapse, "var_time": std_var_time_elapse}
-
-    del test_net
-    return result_json
+            # time of fine-tuning on the support set and evaluating the query set, measured by the engine
+            engine.evaluate_task(support_images[task_idx], support_labels[task_idx], query_images[task_idx],
+                                 query_labels[task_idx], eval_support=False)
+    return engine.time_stats()
 
 def evaluate_speed(model_path_list, num_update, lr, protocol):
     # deep learning训练是在all_in或者sampled all in下训练的，但是测试需要在task版本的dataset上做
@@ -84,7 +52,7 @@ def evaluate_speed(model_path_list, num_update, lr, protocol):
         arch = ma.group(3)
         adv_arch = ma.group(4)
         model = Conv3(IN_CHANNELS[dataset], IMAGE_SIZE[dataset], 2)
-        model = model.cuda()
+        model = module_to_device(model)
 
         checkpoint = torch.load(model_path, map_location=lambda storage, location: storage)
         model.load_state_dict(checkpoint['state_dict'])
@@ -33,6 +33,7 @@ from deep_learning_adv_detector.evaluation.zero_shot_evaluation import evaluate_
 from deep_learning_adv_detector.evaluation.white_box_evaluation import evaluate_whitebox
 import glob
 from deep_learning_adv_detector.evaluation.speed_evaluation import evaluate_speed
+from toolkit.device import add_device_args, set_device_by_args, device_name
 
 model_names = sorted(name for name in models.__dict__
                      if name.islower() and not name.startswith("__")
@@ -87,6 +88,7 @@ best_acc1 = 0
 
 
 def main():
+    add_device_args(parser)
     args = parser.parse_args()
     if args.seed is not None:
         random.seed(args.seed)
@@ -126,6 +128,7 @@ def main():
         elif args.study_subject == "zero_shot":
             result =evaluate_zero_shot(model_file_list, args.lr, args.protocol, args)
         elif args.study_subject == "speed_test":
+            set_device_by_args(args)
             result = evaluate_speed(model_file_list, args.num_updates, args.lr, args.protocol)
         elif args.study_subject == "white_box":
             result =defaultdict(dict)
@@ -149,7 +152,7 @@ def main():
                                                                                                          args.dataset,
                                                                                                          args.protocol)
         elif args.study_subject == "speed_test":
-            file_name = '{}/train_pytorch_model/DL_DET/speed_test_of_DNN.json'.format(PY_ROOT)
+            file_name = '{}/train_pytorch_model/DL_DET/speed_test_of_DNN_{}.json'.format(PY_ROOT, device_name())
         elif args.study_subject == "zero_shot":
             if args.cross_domain_source:
                 file_name = '{}/train_pytorch_model/DL_DET/evaluate_{}_{}--{}_using_{}_protocol.json'.format(PY_ROOT,
@@ -231,6 +234,8 @@ def main_train_worker(args, model_path, META_ATTACKER_PART_I=None,META_ATTACKER_
         adjust_learning_rate(optimizer, epoch, args)
         # train for one epoch
         train(train_loader, None, model, criterion, optimizer, epoch,tensorboard, args)
+        if hasattr(train_dataset, "cache_stats") and train_dataset.cache_stats() is not None:
+            print("epoch {} image cache: {}".format(epoch, train_dataset.cache_stats()))
         if args.balance:
             train_dataset.img_label_list.clear()
             train_dataset.img_label_list.extend(train_dataset.img_label_dict[1])
@@ -0,0 +1,105 @@
+import copy
+import queue
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+from torch.optim import SGD
+
+from meta_adv_detector.score import forward_pass, evaluate_two_way
+from evaluation_toolkit.adapted_cache import hash_tensors
+from toolkit.device import to_device, module_to_device, synchronize
+
+
+class AdaptationEngine(object):
+    '''
+    Test-time adaptation of many tasks from one master network: fine-tune on the support set, then evaluate the query set.
+    The worker networks and their optimizers are allocated once. Before each task the parameters and BN buffers of
+    a worker are reset in place from a snapshot of the master network, which replaces copy.deepcopy(network),
+    .cuda() and a new SGD per task. The snapshot stays on the device of the workers, so a reset is a device-to-device copy.
+    The pool allows several threads (e.g. a serving path) to adapt tasks at the same time, one worker each.
+    With an AdaptedWeightCache, a support set that was adapted before is restored from the cache instead of fine-tuned.
+    '''
+
+    def __init__(self, network, inner_lr, num_updates, update_BN=True, pool_size=1, cache=None):
+        self.inner_lr = inner_lr
+        self.num_updates = num_updates
+        self.update_BN = update_BN
+        self.master_state = {name: to_device(tensor.detach().clone()) for name, tensor in network.state_dict().items()}
+        self.cache = cache
+        if cache is not None:
+            self.master_hash = hash_tensors(self.master_state.values())
+        self.pool = queue.Queue()
+        for _ in range(pool_size):
+            worker_net = module_to_device(copy.deepcopy(network))
+            optimizer = SGD(worker_net.parameters(), lr=inner_lr)
+            # state_dict() shares the storage of the parameters and buffers, so copy_ writes into the network itself
+            copy_pairs = [(tensor, self.master_state[name]) for name, tensor in worker_net.state_dict().items()]
+            self.pool.put((worker_net, optimizer, copy_pairs))
+        self.task_times = []  # adaptation + query evaluation time of each task
+
+    @contextmanager
+    def worker(self):
+        worker = self.pool.get()
+        try:
+            yield worker
+        finally:
+            self.pool.put(worker)
+
+    def reset(self, worker):
+        worker_net, optimizer, copy_pairs = worker
+        with torch.no_grad():
+            for tensor, master_tensor in copy_pairs:
+                tensor.copy_(master_tensor)
+        optimizer.state.clear()
+        for param_group in optimizer.param_groups:
+            param_group["lr"] = self.inner_lr
+
+    def adapt(self, worker, support_task, support_target):
+        ''' reset the worker to the master network and fine-tune it on the support set '''
+        worker_net, optimizer, copy_pairs = worker
+        if self.cache is not None:
+            key = self.cache.make_key(self.master_hash, support_task, support_target, self.inner_lr, self.num_updates,
+                                      self.update_BN)
+            state = self.cache.get(key)
+            if state is not None:
+                with torch.no_grad():
+                    for (tensor, _), cached_tensor in zip(copy_pairs, state):
+                        tensor.copy_(cached_tensor)
+                worker_net.eval()
+                return worker_net
+        self.reset(worker)
+        worker_net.train()
+        if not self.update_BN:
+            for m in worker_net.modules():
+                if isinstance(m, torch.nn.BatchNorm2d):
+                    m.eval()
+        for i in range(self.num_updates):  # 先fine_tune
+            loss, out = forward_pass(worker_net, support_task, support_target)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        worker_net.eval()
+        if self.cache is not None:
+            self.cache.put(key, [tensor for tensor, _ in copy_pairs])
+        return worker_net
+
+    def evaluate_task(self, support_task, support_target, query_task, query_target, eval_support=True):
+        with self.worker() as worker:
+            synchronize()
+            before_time = time.time()
+            worker_net = self.adapt(worker, support_task, support_target)
+            query_acc, query_F1 = evaluate_two_way(worker_net, query_task, query_target)  # ends with a device to host copy
+            task_time = time.time() - before_time
+            self.task_times.append(task_time)
+            result = {"query_acc": query_acc, "query_F1": query_F1, "task_time": task_time}
+            if eval_support:
+                result["support_acc"], result["support_F1"] = evaluate_two_way(worker_net, support_task, support_target)
+        return result
+
+    def time_stats(self):
+        stats = {"mean_time": np.mean(self.task_times), "var_time": np.var(self.task_times)}
+        if self.cache is not None:
+            stats["cache"] = self.cache.stats()
+        return stats
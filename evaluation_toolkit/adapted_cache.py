@@ -0,0 +1,96 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+
+from toolkit.device import to_device
+
+
+def hash_tensors(tensors):
+    sha1 = hashlib.sha1()
+    for tensor in tensors:
+        tensor = torch.as_tensor(tensor).detach().cpu().contiguous()
+        sha1.update(str(tuple(tensor.size())).encode("utf-8"))
+        sha1.update(tensor.numpy().tobytes())
+    return sha1.hexdigest()
+
+
+class AdaptedWeightCache(object):
+    '''
+    LRU cache of the weights of adapted detectors, so that a support set seen again skips its num_updates SGD steps.
+    The key is a content hash of the master weights, the support images and labels, inner_lr, num_updates and update_BN.
+    An entry is the list of tensors of the adapted state_dict. When the entries exceed max_bytes the least recently used
+    ones are evicted, and if spill_dir is given they are saved there and loaded back on a later hit.
+    '''
+
+    def __init__(self, max_bytes, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+        self.entries = OrderedDict()  # key -> list of tensors, the last one is the most recently used
+        self.num_bytes = 0
+        self.lock = threading.Lock()
+        self.hits, self.spill_hits, self.misses = 0, 0, 0
+
+    @staticmethod
+    def make_key(master_hash, support_images, support_labels, inner_lr, num_updates, update_BN):
+        return hash_tensors([support_images, support_labels]) + "_{}_{}_{}_{}".format(master_hash, inner_lr,
+                                                                                     num_updates, update_BN)
+
+    @staticmethod
+    def entry_bytes(state):
+        return sum(tensor.numel() * tensor.element_size() for tensor in state)
+
+    def spill_path(self, key):
+        return "{}/{}.pth".format(self.spill_dir, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+        if self.spill_dir is not None and os.path.exists(self.spill_path(key)):
+            state = [to_device(tensor) for tensor in torch.load(self.spill_path(key), map_location="cpu")]
+            self.put(key, state)
+            with self.lock:
+                self.spill_hits += 1
+            return state
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, state):
+        state = [tensor.detach().clone() for tensor in state]
+        size = self.entry_bytes(state)
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.num_bytes -= self.entry_bytes(self.entries.pop(key))
+            self.entries[key] = state
+            self.num_bytes += size
+            while self.num_bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, old_state = self.entries.popitem(last=False)
+                self.num_bytes -= self.entry_bytes(old_state)
+                evicted.append((old_key, old_state))
+        if self.spill_dir is not None:
+            for old_key, old_state in evicted:
+                if not os.path.exists(self.spill_path(old_key)):
+                    tmp_path = self.spill_path(old_key) + ".tmp"
+                    torch.save([tensor.cpu() for tensor in old_state], tmp_path)
+                    os.replace(tmp_path, self.spill_path(old_key))
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "spill_hits": self.spill_hits, "misses": self.misses,
+                    "entries": len(self.entries), "MB": self.num_bytes / 1024 ** 2}
+
+
+def build_adapted_cache(args):
+    ''' from --adapted_cache_mb and --adapted_cache_dir, None if the cache is disabled '''
+    if args.adapted_cache_mb <= 0:
+        return None
+    return AdaptedWeightCache(args.adapted_cache_mb * 1024 ** 2, args.adapted_cache_dir)
@@ -1,14 +1,12 @@
-import copy
 import random
-import time
 from collections import defaultdict
 
 import numpy as np
 import torch
-from torch.optim import SGD
 
 from config import META_ATTACKER_INDEX
-from meta_adv_detector.score import forward_pass, evaluate_two_way
+from evaluation_toolkit.adaptation_engine import AdaptationEngine
+from toolkit.device import to_device
 
 
 def accuracy(output, target, topk=(1,)):
@@ -28,38 +26,21 @@ def accuracy(output, target, topk=(1,)):
 
 
 
-def finetune_eval_task_rotate(network, val_loader, inner_lr, num_updates, update_BN=True, limit=-1):
-    # test_net = copy.deepcopy(network)
+def finetune_eval_task_rotate(network, val_loader, inner_lr, num_updates, update_BN=True, limit=-1, cache=None):
     # Select ten tasks randomly from the test set to evaluate_accuracy on
     support_F1_list,  query_F1_list = [], []
-    test_net = copy.deepcopy(network)
+    engine = AdaptationEngine(network, inner_lr, num_updates, update_BN, cache=cache)
     # support_images,support_gt_labels, support_binary_labels, query_images, query_gt_labels, query_binary_labels
     for val_idx, (support_images, _, support_labels, query_images, _, query_labels, positive_labels) in enumerate(val_loader):
         # print("process task {}  task_batch={}".format(val_idx, len(support_images)))
-        support_labels = support_labels.cuda()
-        query_labels = query_labels.cuda()
+        support_labels = to_device(support_labels)
+        query_labels = to_device(query_labels)
         for task_idx in range(support_images.size(0)):
-            # Make a test net with same parameters as our current net
-            test_net = copy.deepcopy(network)
-            test_net.cuda()
-            test_opt = SGD(test_net.parameters(), lr=inner_lr)
-            support_task, support_target = support_images[task_idx], support_labels[task_idx]
-            test_net.train()
-            if not update_BN:
-                for m in test_net.modules():
-                    if isinstance(m, torch.nn.BatchNorm2d):
-                        m.eval()
-            for i in range(num_updates):  # 先fine_tune
-                loss, out = forward_pass(test_net, support_task, support_target)
-                test_opt.zero_grad()
-                loss.backward()
-                test_opt.step()
-            test_net.eval()
-            # Evaluate the trained model on train and val examples
-            support_acc, support_F1_score = evaluate_two_way(test_net, support_task, support_target)
-            query_acc, query_F1_score = evaluate_two_way(test_net, query_images[task_idx], query_labels[task_idx])
-            support_F1_list.append(support_F1_score)
-            query_F1_list.append(query_F1_score)
+            # the engine resets its worker network to the current net before fine-tuning
+            task_result = engine.evaluate_task(support_images[task_idx], support_labels[task_idx],
+                                               query_images[task_idx], query_labels[task_idx])
+            support_F1_list.append(task_result["support_F1"])
+            query_F1_list.append(task_result["query_F1"])
             if limit > 0 and len(query_F1_list) >= limit:
                 break
 
@@ -69,14 +50,14 @@ def finetune_eval_task_rotate(network, val_loader, inner_lr, num_updates, update
     print('-------------------------')
     print('Support F1: {}'.format(support_F1))
     print('Query F1: {}'.format(query_F1))
+    print('Mean time per task: {}'.format(engine.time_stats()["mean_time"]))
     print('-------------------------')
-    del test_net
     return result_json
 
 # 这里加入每个attack攻击类型分别统计的代码
-def finetune_eval_task_accuracy(network, val_loader, inner_lr, num_updates, update_BN=True, limit=-1):
+def finetune_eval_task_accuracy(network, val_loader, inner_lr, num_updates, update_BN=True, limit=-1, cache=None):
     # Select ten tasks randomly from the test set to evaluate_accuracy on
-    test_net = copy.deepcopy(network)
+    engine = AdaptationEngine(network, inner_lr, num_updates, update_BN, cache=cache)
     support_F1_list,  query_F1_list = [], []
     # support_images,support_gt_labels, support_binary_labels, query_images, query_gt_labels, query_binary_labels
     each_attack_stats = val_loader.dataset.fetch_attack_name
@@ -87,36 +68,17 @@ def finetune_eval_task_accuracy(network, val_loader, inner_lr, num_updates, upda
         else:
             support_images, _, support_labels, query_images, _, query_labels, positive_labels = pack
         # print("process task {}  task_batch={}".format(val_idx, len(support_images)))
-        support_labels = support_labels.cuda()
-        query_labels = query_labels.cuda()
+        support_labels = to_device(support_labels)
+        query_labels = to_device(query_labels)
         for task_idx in range(support_images.size(0)):
-            # Make a test net with same parameters as our current net
-            start_time = time.time()
-            test_net = copy.deepcopy(network)
-            test_net.cuda()
-            test_opt = SGD(test_net.parameters(), lr=inner_lr)
-            support_task, support_target = support_images[task_idx], support_labels[task_idx]
-
-            test_net.train()
-            if not update_BN:
-                for m in test_net.modules():
-                    if isinstance(m, torch.nn.BatchNorm2d):
-                        m.eval()
-            for i in range(num_updates):  # 先fine_tune
-                loss, out = forward_pass(test_net, support_task, support_target)
-                test_opt.zero_grad()
-                loss.backward()
-                test_opt.step()
-            test_net.eval()
-            # Evaluate the trained model on train and val examples
-            support_acc, support_F1_score = evaluate_two_way(test_net, support_task, support_target)
-            query_acc, query_F1_score = evaluate_two_way(test_net, query_images[task_idx], query_labels[task_idx])
-
-            torch.cuda.empty_cache()
+            # the engine resets its worker network to the current net before fine-tuning
+            task_result = engine.evaluate_task(support_images[task_idx], support_labels[task_idx],
+                                               query_images[task_idx], query_labels[task_idx])
+            query_F1_score = task_result["query_F1"]
             if each_attack_stats:
                 adversary = META_ATTACKER_INDEX[adversary_indexes[task_idx].item()]
                 attack_stats[adversary].append(query_F1_score)
-            support_F1_list.append(support_F1_score)
+            support_F1_list.append(task_result["support_F1"])
             query_F1_list.append(query_F1_score)
             if limit > 0 and len(query_F1_list) >= limit:
                 break
@@ -132,6 +94,6 @@ def finetune_eval_task_accuracy(network, val_loader, inner_lr, num_updates, upda
     print('-------------------------')
     print('Support F1: {}'.format(support_F1))
     print('Query F1: {}'.format(query_F1))
+    print('Mean time per task: {}'.format(engine.time_stats()["mean_time"]))
     print('-------------------------')
     return result_json
-
@@ -43,15 +43,16 @@ class DetectionEvaluator:
     A detector should have this simplified interface:
         Y_pred = detector(X)
     """
-    def __init__(self, model, dataset_name):
+    def __init__(self, model, dataset_name, squeezer_backend="python"):
         # set_base_model()
         self.model = model
         self.dataset_name = dataset_name
+        self.squeezer_backend = squeezer_backend
         self.detector = self.get_detector(model)
 
 
     def get_detector(self, model):
-        detector = FeatureSqueezingDetector(model)
+        detector = FeatureSqueezingDetector(model, squeezer_backend=self.squeezer_backend)
         return detector
 
 
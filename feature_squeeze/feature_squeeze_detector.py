@@ -9,6 +9,7 @@ from torchvision import transforms
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 # from utils.visualization import draw_plot
 from feature_squeeze.squeeze import  get_squeezer_by_name, isfloat
+from feature_squeeze.quantile_sketch import QuantileSketch
 from urllib import parse as urlparse
 from sklearn.preprocessing import normalize
 
@@ -75,18 +76,48 @@ def kl(x1, x2):
     return e
 
 
+# Torch versions of the normalizers and metrics for the fused get_distance, x1/x2 are N,D tensors on the device.
+def softmax_torch(z):
+    return torch.softmax(z, dim=1)
+
+def unit_norm_torch(x):
+    norm = torch.norm(x, p=2, dim=1, keepdim=True)
+    return x / torch.where(norm == 0, torch.ones_like(norm), norm)  # zero vectors stay zero like sklearn
+
+l1_dist_torch = lambda x1,x2: torch.sum(torch.abs(x1 - x2), dim=1)
+l2_dist_torch = lambda x1,x2: torch.sum((x1 - x2)**2, dim=1)**.5
+
+def kl_torch(x1, x2):
+    ''' the same as kl: scipy.stats.entropy normalizes both distributions, inf is replaced by 2 '''
+    assert x1.shape == x2.shape
+    p = x1 / torch.sum(x1, dim=1, keepdim=True)
+    q = x2 / torch.sum(x2, dim=1, keepdim=True)
+    e = torch.sum(torch.where(p > 0, p * torch.log(p / q), torch.zeros_like(p)), dim=1)
+    e[torch.isinf(e)] = 2
+    return e
+
+
 class FeatureSqueezingDetector:
 
     # 范例：distance_measure=l1&squeezers=median_smoothing_2,bit_depth_4,bilateral_filter_15_15_60;
     # squeezers=median_smoothing_2,bit_depth_4,bilateral_filter_15_15_60&distance_measure=l1&fpr=0.05
-    def __init__(self, model, param_str="squeezers=bit_depth_4,median_filter_3_3&distance_measure=l2&fpr=0.05"):
+    # squeezer_backend=torch runs the squeezers on whole batches on the device of the model, see squeeze.py
+    # fused=false goes back to one model run and one host transfer per squeezer,
+    # forward_batch_size splits the fused forward batch of (1 + SQUEEZER_NUM) * N images
+    def __init__(self, model, param_str="squeezers=bit_depth_4,median_filter_3_3&distance_measure=l2&fpr=0.05",
+                 squeezer_backend="python"):
         self.model = model
         self.model.eval()
         params = parse_params(param_str)
+        self.squeezer_backend = params.get('squeezer_backend', squeezer_backend)
+        self.fused = params.get('fused', True)
+        self.forward_batch_size = int(params['forward_batch_size']) if 'forward_batch_size' in params else None
 
         normalizer = 'none'
         metric = params['distance_measure']
         squeezers_name = params['squeezers'].split(',')
+        for squeezer_name in squeezers_name:
+            self.get_squeezer_by_name(squeezer_name)  # a squeezer without an implementation of the backend fails here
         self.set_config(normalizer, metric, squeezers_name)
 
         if 'threshold' in params:
@@ -96,7 +127,13 @@ class FeatureSqueezingDetector:
             self.train_fpr = float(params['fpr'])
 
     def get_squeezer_by_name(self, name):
-        return get_squeezer_by_name(name, 'python')
+        return get_squeezer_by_name(name, self.squeezer_backend)
+
+    def squeeze(self, squeeze_func, X):
+        ''' squeeze the device tensor X, the torch backend does not leave the device '''
+        if self.squeezer_backend == 'torch':
+            return squeeze_func(X).float().to(X.device)
+        return torch.from_numpy(squeeze_func(X.detach().cpu().numpy())).float().to(X.device)
 
     def get_normalizer_by_name(self, name):
         d = {'unit_norm': unit_norm, 'softmax': softmax, 'none': lambda x:x}
@@ -106,6 +143,15 @@ class FeatureSqueezingDetector:
         d = {'kl_f': lambda x1,x2: kl(x1, x2), 'kl_b': lambda x1,x2: kl(x2, x1), 'l1': l1_dist, 'l2': l2_dist}
         return d[name]
 
+    def get_torch_normalizer_by_name(self, name):
+        d = {'unit_norm': unit_norm_torch, 'softmax': softmax_torch, 'none': lambda x:x}
+        return d[name]
+
+    def get_torch_metric_by_name(self, name):
+        d = {'kl_f': lambda x1,x2: kl_torch(x1, x2), 'kl_b': lambda x1,x2: kl_torch(x2, x1), 'l1': l1_dist_torch,
+             'l2': l2_dist_torch}
+        return d[name]
+
     def set_config(self,  normalizer_name, metric_name, squeezers_name):
         self.normalizer_name = normalizer_name
         self.metric_name = metric_name
@@ -125,11 +171,34 @@ class FeatureSqueezingDetector:
         dist_array = np.array(dist_array) # shape = SQUEEZER_NUM, 50000个样本
         return np.max(dist_array, axis=0)
 
+    def get_fused_distance(self, X1):
+        '''
+        The original batch and all its squeezed versions go through the model as one batch,
+        the distances and their max over the squeezers are computed on the device, only the result is copied to host.
+        '''
+        normalizer_name, metric_name, squeezers_name = self.get_config()
+        normalize_func = self.get_torch_normalizer_by_name(normalizer_name)
+        distance_func = self.get_torch_metric_by_name(metric_name)
+        with torch.no_grad():
+            X_all = torch.cat([X1] + [self.squeeze(self.get_squeezer_by_name(squeezer_name), X1)
+                                      for squeezer_name in squeezers_name])
+            if self.forward_batch_size is None:
+                vals = self.eval_layer_output(X_all)
+            else:
+                vals = torch.cat([self.eval_layer_output(X) for X in torch.split(X_all, self.forward_batch_size)])
+            vals = normalize_func(reshape_2d(vals)).view(len(squeezers_name) + 1, X1.size(0), -1)
+            distance = torch.stack([distance_func(vals[0], val_squeezed) for val_squeezed in vals[1:]])
+            distance = torch.max(distance, dim=0)[0]  # shape = SQUEEZER_NUM, N -> N
+        return distance.cpu().numpy()
+
     def get_distance(self, X1, X2=None):
+        device = next(self.model.parameters()).device  # numpy input goes to the device of the model, also the CPU
         if isinstance(X1, np.ndarray):
-            X1 = torch.from_numpy(X1).cuda()
+            X1 = torch.from_numpy(X1).to(device)
         if isinstance(X2, np.ndarray):
-            X2 = torch.from_numpy(X2).cuda()
+            X2 = torch.from_numpy(X2).to(device)
+        if X2 is None and self.fused:
+            return self.get_fused_distance(X1)
         normalizer_name, metric_name, squeezers_name = self.get_config()
         normalize_func = self.get_normalizer_by_name(normalizer_name)
         # return numpy array
@@ -142,7 +211,7 @@ class FeatureSqueezingDetector:
                 vals_squeezed = []
                 for squeezer_name in squeezers_name:
                     squeeze_func = self.get_squeezer_by_name(squeezer_name)
-                    val_squeezed_norm = input_to_normalized_output(torch.from_numpy(squeeze_func(X1.detach().cpu().numpy())).float().cuda())  # squeeze后再经过模型输出，再得到squeezed_norm
+                    val_squeezed_norm = input_to_normalized_output(self.squeeze(squeeze_func, X1))  # squeeze后再经过模型输出，再得到squeezed_norm
                     torch.cuda.empty_cache()
                     vals_squeezed.append(val_squeezed_norm)
                 distance = self.calculate_distance_max(val_orig_norm, vals_squeezed, metric_name)
@@ -200,8 +269,39 @@ class FeatureSqueezingDetector:
             print ("Selected %f as the threshold value." % self.threshold)
         return self.threshold
 
-    def test(self, X):
+    def calibration_sketch(self, data_loader, sketch=None):
+        """
+        Streaming calibration: the legitimate images of data_loader (batches of images or (images, labels)) are
+        consumed batch by batch, only a QuantileSketch of their distances is kept.
+        Workers can fill their own sketches on shards of the data, merge them and call thresholds_from_sketch.
+        """
+        if sketch is None:
+            sketch = QuantileSketch()
+        device = next(self.model.parameters()).device
+        for batch in data_loader:
+            X = batch[0] if isinstance(batch, (list, tuple)) else batch
+            if isinstance(X, np.ndarray):
+                X = torch.from_numpy(X)
+            sketch.update(self.get_distance(X.float().to(device)))
+        return sketch
+
+    def thresholds_from_sketch(self, sketch, fprs=None):
+        """ thresholds of several FPR targets at once, the one of the configured fpr becomes self.threshold """
+        fprs = list(fprs or [])
+        if hasattr(self, 'train_fpr') and self.train_fpr not in fprs:
+            fprs.append(self.train_fpr)
+        thresholds = sketch.quantiles([1 - fpr for fpr in fprs])
+        self.thresholds = dict(zip(fprs, thresholds))
+        if hasattr(self, 'train_fpr'):
+            self.threshold = self.thresholds[self.train_fpr]
+        print ("Selected thresholds %s from %d legitimate examples." % (self.thresholds, sketch.count))
+        return self.thresholds
+
+    def calibrate(self, data_loader, fprs=None):
+        return self.thresholds_from_sketch(self.calibration_sketch(data_loader), fprs)
+
+    def test(self, X, fpr=None):
         distances = self.get_distance(X)
-        threshold = self.threshold
+        threshold = self.threshold if fpr is None else self.thresholds[fpr]
         Y_pred = (distances < threshold).astype(np.int32)
         return Y_pred, distances
\ No newline at end of file
@@ -3,6 +3,7 @@ import torch
 from clean_image_classifier.train import get_preprocessor
 from config import PY_ROOT, IMAGE_DATA_ROOT
 from feature_squeeze.detection_evaluator import DetectionEvaluator
+from feature_squeeze.squeeze import validate_torch_squeezers
 import re
 import argparse
 import os
@@ -28,6 +29,14 @@ parser.add_argument('--gpu', default=0, type=int,
 parser.add_argument("--split_data_protocol",
                     type=SPLIT_DATA_PROTOCOL, choices=list(SPLIT_DATA_PROTOCOL), help="split data protocol")
 parser.add_argument("--output_path",type=str, required=True)
+parser.add_argument("--squeezer_backend", type=str, default="python", choices=["python", "torch"],
+                    help="torch runs the squeezers on whole batches on the GPU")
+parser.add_argument("--stream_calibration", action="store_true",
+                    help="calibrate the threshold on the whole clean train set with a streaming quantile sketch")
+parser.add_argument("--calibration_fprs", type=str, default="0.05",
+                    help="comma separated FPR targets of the streaming calibration")
+parser.add_argument("--validate_squeezers", action="store_true",
+                    help="check the torch squeezers against the python ones on the first task before evaluating")
 best_acc1 = 0
 
 # 所谓训练过程就是确定阈值的过程， 用全部train数据集，和finetune的support数据进行确定阈值
@@ -70,7 +79,7 @@ def main():
         model.load_state_dict(checkpoint["state_dict"])
         model.cuda()
         print("loading {}".format(model_path))
-        detector = DetectionEvaluator(model, dataset)
+        detector = DetectionEvaluator(model, dataset, args.squeezer_backend)
         for pkl_task_file_name in glob.glob("{}/task/{}/test_{}*.pkl".format(PY_ROOT,args.split_data_protocol, dataset)):
             preprocessor = get_preprocessor(input_size=IMAGE_SIZE[dataset], input_channels=IN_CHANNELS[dataset])
             if dataset == "CIFAR-10":
@@ -92,9 +101,18 @@ def main():
                                            pkl_task_dump_path=pkl_task_file_name,
                                            protocol=args.split_data_protocol)
             val_loader = DataLoader(meta_dataset, batch_size=args.batch_size, shuffle=False)
+            if args.validate_squeezers:
+                support_images = next(iter(val_loader))[0][0].detach().cpu().numpy()
+                support_images = support_images.reshape(-1, IN_CHANNELS[dataset], IMAGE_SIZE[dataset][0], IMAGE_SIZE[dataset][1])
+                print("max abs diff of torch squeezers: {}".format(
+                    validate_torch_squeezers(support_images, detector.detector.squeezers_name)))
 
             # train_imgs = get_train_data(train_dataset)
             train_imgs = []
+            if args.stream_calibration:  # the threshold is set here, so the per-task train does not change it
+                calibration_loader = DataLoader(train_dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+                detector.detector.threshold = None
+                detector.detector.calibrate(calibration_loader, [float(fpr) for fpr in args.calibration_fprs.split(",")])
             accuracy = detector.evaluate_detections(train_imgs, val_loader)
             key1 = os.path.basename(model_path)
             key1 = key1[:key1.rindex(".")]
@@ -0,0 +1,86 @@
+import numpy as np
+
+
+class QuantileSketch(object):
+    '''
+    Mergeable streaming quantile sketch (KLL) of the detection distances.
+    Level h keeps items of weight 2^h, a full level is sorted and every other item is promoted to the next level,
+    so the memory is O(k log(n/k)) for n values. Until k values are seen nothing is compacted and the quantiles
+    are exact. Sketches filled by different workers (pickled back to the parent) are combined by merge.
+    '''
+
+    def __init__(self, k=2000, seed=1337):
+        self.k = k
+        self.levels = [np.empty(0, dtype=np.float64)]
+        self.count = 0
+        self.rng = np.random.RandomState(seed)
+
+    def capacity(self, level):
+        # the top level holds k items, lower levels shrink geometrically
+        return max(2, int(np.ceil(self.k * (2.0 / 3.0) ** (len(self.levels) - level - 1))))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.count += len(values)
+        self.compress()
+        return self
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0, dtype=np.float64))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.count += other.count
+        self.compress()
+        return self
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            if len(self.levels[level]) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0, dtype=np.float64))
+                items = np.sort(self.levels[level])
+                if len(items) % 2 == 1:  # the odd item stays in this level
+                    self.levels[level], items = items[-1:], items[:-1]
+                else:
+                    self.levels[level] = np.empty(0, dtype=np.float64)
+                promoted = items[self.rng.randint(2)::2]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def sorted_items(self):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(items_), 2 ** level, dtype=np.int64)
+                                  for level, items_ in enumerate(self.levels)])
+        order = np.argsort(items, kind="mergesort")
+        return items[order], np.cumsum(weights[order])
+
+    def quantiles(self, qs):
+        '''
+        for each q the smallest value whose rank reaches ceil(q * count),
+        the same as sorted(values)[ceil(count * q) - 1] when the sketch is exact
+        '''
+        assert self.count > 0, "empty sketch"
+        items, cum_weights = self.sorted_items()
+        total = cum_weights[-1]
+        results = []
+        for q in qs:
+            rank = max(1, int(np.ceil(total * q)))
+            results.append(items[min(np.searchsorted(cum_weights, rank), len(items) - 1)])
+        return results
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    def num_items(self):
+        return sum(len(items) for items in self.levels)
+
+
+def merge_sketches(sketches):
+    sketches = list(sketches)
+    merged = sketches[0]
+    for sketch in sketches[1:]:
+        merged.merge(sketch)
+    return merged
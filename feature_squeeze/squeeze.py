@@ -2,6 +2,7 @@ import torch
 import numpy as np
 from scipy import ndimage
 import torch.distributions as tdist
+import torch.nn.functional as F
 import copy
 
 def recreate_image(x, npp_int):
@@ -118,14 +119,14 @@ def opencv_wrapper(imgs, opencv_func, argv):
     imgs_copy = imgs
 
     for img in imgs_copy:  # each is C,H,W
-        img = recreate_image(img)  # H, W, C
+        img = recreate_image(img, 255)  # H, W, C
         if img.shape[-1] == 1:
             img = np.squeeze(img) # grey image convert to H,W
         img_uint8 = np.clip(img, 0, 255).astype(np.uint8)
         ret_img = opencv_func(*[img_uint8]+argv)  # H,W,C
         if type(ret_img) == tuple:
             ret_img = ret_img[1]
-        if ret_img.shape[-1] == 1:
+        if ret_img.ndim == 2:
             ret_img = np.expand_dims(ret_img, -1) # H, W, 1
         ret_img = normalized_process(ret_img, 255).astype(np.float32) # C,H,W
         ret_imgs.append(ret_img)
@@ -190,6 +191,107 @@ def adaptive_bilateral_filter_py(imgs, ksize, sigmaSpace, maxSigmaColor=20.0):
     return opencv_wrapper(imgs, cv2.adaptiveBilateralFilter, [(ksize,ksize), sigmaSpace, maxSigmaColor])
 
 
+'''
+Torch versions of the squeezers, which work on whole N,C,H,W batches on the device of the input tensor
+instead of looping over the images in numpy/OpenCV. get_squeezer_by_name(name, 'torch') selects them.
+'''
+
+def channel_stats_torch(x):
+    ''' mean and std of the normalization of recreate_image/normalized_process, shape 1,C,1,1 '''
+    if x.size(1) == 3:
+        mean, std = [0.485, 0.456, 0.406], [0.229, 0.224, 0.225]
+    else:
+        mean, std = [0.456], [0.224]
+    return torch.tensor(mean, dtype=x.dtype, device=x.device).view(1, -1, 1, 1), \
+           torch.tensor(std, dtype=x.dtype, device=x.device).view(1, -1, 1, 1)
+
+def recreate_image_torch(x, npp_int):
+    ''' N,C,H,W normalized -> N,C,H,W integer valued in [0, npp_int] '''
+    mean, std = channel_stats_torch(x)
+    return torch.round(torch.clamp(x * std + mean, 0, 1) * npp_int)
+
+def normalized_process_torch(x, npp_int):
+    ''' N,C,H,W integer valued in [0, npp_int] -> N,C,H,W normalized '''
+    mean, std = channel_stats_torch(x)
+    return (x / npp_int - mean) / std
+
+def reduce_precision_torch(x, npp):
+    npp_int = npp - 1
+    assert x.dim() == 4, x.dim()
+    return normalized_process_torch(recreate_image_torch(x, npp_int), npp_int)
+
+def bit_depth_torch(x, bits):
+    return reduce_precision_torch(x, 2**bits)
+
+def bit_depth_random_torch(x, bits, stddev):
+    return bit_depth_torch(x + torch.randn_like(x) * stddev, bits)
+
+def binary_filter_torch(x, threshold):
+    return (x > threshold).to(x.dtype)
+
+def binary_random_filter_torch(x, threshold, stddev=0.125):
+    return binary_filter_torch(x + torch.randn_like(x) * stddev, threshold)
+
+def symmetric_index_torch(n, before, after, device):
+    ''' indices of scipy.ndimage "reflect" padding: d c b a | a b c d | d c b a '''
+    idx = torch.remainder(torch.arange(-before, n + after, device=device), 2 * n)
+    return torch.where(idx >= n, 2 * n - 1 - idx, idx)
+
+def median_filter_torch(x, width, height=-1):
+    """
+    Median smoothing with unfold, the same as median_filter_py: size=(width, height) on the H and W axes,
+    reflect mode of scipy and the upper median for windows of even size.
+    """
+    if height == -1:
+        height = width
+    N, C, H, W = x.size()
+    rows = symmetric_index_torch(H, width // 2, width - 1 - width // 2, x.device)
+    cols = symmetric_index_torch(W, height // 2, height - 1 - height // 2, x.device)
+    padded = x.index_select(2, rows).index_select(3, cols)
+    windows = F.unfold(padded.reshape(N * C, 1, padded.size(2), padded.size(3)), (width, height))  # N*C, k, H*W
+    median = windows.kthvalue(width * height // 2 + 1, dim=1)[0]
+    return median.view(N, C, H, W)
+
+def bilateral_filter_torch(imgs, d, sigmaSpace, sigmaColor):
+    """
+    Approximation of bilateral_filter_py: the same circular window, reflect-101 border and L1 color distance as
+    cv2.bilateralFilter on uint8 images, but with exact float weights instead of the lookup tables of OpenCV,
+    so some pixels differ by 1 grey level. One pass per window offset, no N,C,k,H,W tensor is allocated.
+    """
+    x = recreate_image_torch(imgs, 255)  # N,C,H,W in 0..255
+    radius = d // 2 if d > 0 else int(round(sigmaSpace * 1.5))
+    H, W = x.size(2), x.size(3)
+    padded = F.pad(x, [radius, radius, radius, radius], mode="reflect")
+    numerator = torch.zeros_like(x)
+    denominator = torch.zeros_like(x[:, :1])
+    for dy in range(-radius, radius + 1):
+        for dx in range(-radius, radius + 1):
+            if dy * dy + dx * dx > radius * radius:
+                continue
+            neighbor = padded[:, :, radius + dy: radius + dy + H, radius + dx: radius + dx + W]
+            color_dist = (neighbor - x).abs().sum(dim=1, keepdim=True)
+            weight = torch.exp(-0.5 * (dy * dy + dx * dx) / sigmaSpace ** 2 - 0.5 * color_dist ** 2 / sigmaColor ** 2)
+            numerator += weight * neighbor
+            denominator += weight
+    return normalized_process_torch(torch.round(numerator / denominator), 255)
+
+
+def validate_torch_squeezers(x, squeezers_name, atol=1e-4):
+    '''
+    Run each squeezer with the python and the torch backend on the same N,C,H,W numpy batch,
+    return the max abs difference of each squeezer. The random squeezers are skipped, their noise differs.
+    '''
+    max_diffs = {}
+    for name in squeezers_name:
+        if "random" in name:
+            continue
+        out_py = get_squeezer_by_name(name, 'python')(x)
+        out_torch = get_squeezer_by_name(name, 'torch')(torch.from_numpy(x).float())
+        max_diffs[name] = float(np.max(np.abs(out_py - out_torch.detach().cpu().numpy())))
+        if not name.startswith("bilateral_filter"):  # bilateral_filter_torch is an approximation
+            assert max_diffs[name] <= atol, "{} differs by {}".format(name, max_diffs[name])
+    return max_diffs
+
 
 def isfloat(value):
     try:
@@ -211,6 +313,14 @@ def parse_params(params_str):
         params.append(param)
     return params
 
+def numpy_squeezer_as_torch(squeezer_py):
+    ''' run a numpy squeezer on a tensor, the same way as non_local_means_*_torch, the result is a CPU tensor '''
+    def squeezer_torch(imgs, *args):
+        if isinstance(imgs, torch.Tensor):
+            imgs = imgs.detach().cpu().numpy()
+        return torch.from_numpy(np.asarray(squeezer_py(imgs, *args)))
+    return squeezer_torch
+
 def get_squeezer_by_name(name, func_type):
     squeezer_list = ['none',
                      'bit_depth_random',
@@ -232,19 +342,30 @@ def get_squeezer_by_name(name, func_type):
     for squeezer_name in squeezer_list:
         if name.startswith(squeezer_name):
             params_str = name[len(squeezer_name):]
-            func_name = "%s_py" % squeezer_name if func_type == 'python' else "%s_tf" % squeezer_name
+            if func_type == 'python':
+                func_name = "%s_py" % squeezer_name
+            elif func_type == 'torch':
+                func_name = "%s_torch" % squeezer_name
+            else:
+                func_name = "%s_tf" % squeezer_name
+            # 构建时就解析函数，torch没有实现的squeezer退回到numpy实现
+            func = globals().get(func_name)
+            if func is None and func_type == 'torch' and "%s_py" % squeezer_name in globals():
+                func = numpy_squeezer_as_torch(globals()["%s_py" % squeezer_name])
+            if func is None:
+                raise NotImplementedError("no {} backend for squeezer {}".format(func_type, name))
             # Return a list
             args = parse_params(params_str)
             # print ("params_str: %s, args: %s" % (params_str, args))
-            return lambda x: globals()[func_name](*([x] + args))
+            return lambda x: func(*([x] + args))
 
     raise Exception('Unknown squeezer name: {} squeezer_name:{}'.format(name, squeezer_name))
 
-def get_sequential_squeezers_by_name(squeezers_name):
+def get_sequential_squeezers_by_name(squeezers_name, func_type='python'):
     # example_squeezers_name = "binary_filter_0.5,median_filter_2_2"
     squeeze_func = None
     for squeezer_name in squeezers_name.split(','):
-        squeezer = get_squeezer_by_name(squeezer_name, 'python')
+        squeezer = get_squeezer_by_name(squeezer_name, func_type)
         if squeeze_func == None:
             squeeze_func = lambda x: squeezer(x)
         else:
@@ -1,72 +1,42 @@
 import os
 import re
-import time
 from collections import defaultdict
 
 import glob
 
 import json
 
-import copy
 import torch
-from torch.optim import SGD
 from torch.utils.data import DataLoader
 
 from config import PY_ROOT, IN_CHANNELS, IMAGE_SIZE, CLASS_NUM
+from evaluation_toolkit.adaptation_engine import AdaptationEngine
 from dataset.meta_task_dataset import MetaTaskDataset
 from dataset.protocol_enum import SPLIT_DATA_PROTOCOL, LOAD_TASK_MODE
 from image_rotate_detector.image_rotate import ImageTransformCV2
 from image_rotate_detector.rotate_detector import Detector
-from meta_adv_detector.score import forward_pass, evaluate_two_way
 from networks.conv3 import Conv3
-import numpy as np
+from toolkit.device import to_device, module_to_device, set_device_by_args, device_name
 
-def speed_test(network, val_loader, inner_lr, num_updates, update_BN=True):
-    # test_net = copy.deepcopy(network)
+def speed_test(network, val_loader, inner_lr, num_updates, update_BN=True, cache=None):
     # Select ten tasks randomly from the test set to evaluate_accuracy on
-    test_net = copy.deepcopy(network)
-    all_times  = []
+    engine = AdaptationEngine(network, inner_lr, num_updates, update_BN, cache=cache)
     # support_images,support_gt_labels, support_binary_labels, query_images, query_gt_labels, query_binary_labels
     for val_idx, (support_images, _, support_labels, query_images, _, query_labels, positive_labels) in enumerate(val_loader):
         # print("process task {}  task_batch={}".format(val_idx, len(support_images)))
-        support_labels = support_labels.cuda()
-        query_labels = query_labels.cuda()
+        support_labels = to_device(support_labels)
+        query_labels = to_device(query_labels)
         for task_idx in range(support_images.size(0)):
-            # Make a test net with same parameters as our current net
-            test_net = copy.deepcopy(network)
-            test_net.cuda()
-            test_opt = SGD(test_net.parameters(), lr=inner_lr)
-            support_task, support_target = support_images[task_idx], support_labels[task_idx]
-            test_net.train()
-
-            before_time = time.time()
-            if not update_BN:
-                for m in test_net.modules():
-                    if isinstance(m, torch.nn.BatchNorm2d):
-                        m.eval()
-            for i in range(num_updates):  # 先fine_tune
-                loss, out = forward_pass(test_net, support_task, support_target)
-                test_opt.zero_grad()
-                loss.backward()
-                test_opt.step()
-            test_net.eval()
-            query_acc, query_F1_score = evaluate_two_way(test_net, query_images[task_idx], query_labels[task_idx])
-            pass_time = time.time() - before_time
-            all_times.append(pass_time)
-            test_net.eval()
-            # Evaluate the trained model on train and val examples
-
-    mean_time_elapse = np.mean(all_times)
-    std_var_time_elapse = np.var(all_times)
-    result_json = {"mean_time":mean_time_elapse, "var_time": std_var_time_elapse}
-
-    del test_net
-    return result_json
+            # time of fine-tuning on the support set and evaluating the query set, measured by the engine
+            engine.evaluate_task(support_images[task_idx], support_labels[task_idx], query_images[task_idx],
+                                 query_labels[task_idx], eval_support=False)
+    return engine.time_stats()
 
 def evaluate_speed(args):
     # 0-shot的时候请传递args.num_updates = 0
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpus[0][0])
+    set_device_by_args(args)
     # IMG_ROTATE_DET@CIFAR-10_TRAIN_II_TEST_I@conv3@epoch_20@lr_0.001@batch_100@no_fix_cnn_params.pth.tar
     extract_pattern_detail = re.compile(
         ".*?IMG_ROTATE_DET@(.*?)_(.*?)@(.*?)@epoch_(\d+)@lr_(.*?)@batch_(\d+)@(.*?)\.pth.tar")
@@ -111,13 +81,13 @@ def evaluate_speed(args):
             model = Detector(dataset, img_classifier_network, CLASS_NUM[dataset],image_transform, layer_number,num_classes=2)
             checkpoint = torch.load(model_path, map_location=lambda storage, location: storage)
             model.load_state_dict(checkpoint['state_dict'])
-            model.cuda()
+            model = module_to_device(model)
             print("=> loaded checkpoint '{}' (epoch {})"
                   .format(model_path, checkpoint['epoch']))
             evaluate_result = speed_test(model, data_loader, lr, num_updates, update_BN=False)
             result[dataset][report_shot] = evaluate_result
         break
 
-    with open("{}/train_pytorch_model/ROTATE_DET/cv2_rotate_model/speed_test.json".format(PY_ROOT), "w") as file_obj:
+    with open("{}/train_pytorch_model/ROTATE_DET/cv2_rotate_model/speed_test_{}.json".format(PY_ROOT, device_name()), "w") as file_obj:
         file_obj.write(json.dumps(result))
         file_obj.flush()
\ No newline at end of file
@@ -1,3 +1,6 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum, unique
 
 import cv2
@@ -9,6 +12,7 @@ import torch
 from torch.nn import functional as F
 from math import cos,sin
 from torch import nn
+from toolkit.device import to_device
 
 
 @unique
@@ -20,48 +24,61 @@ class Direction(Enum):
 
 
 class ImageTransformCV2(object):
-    def __init__(self, dataset, shift_pixels_one_direction):
+    '''
+    CPU transforms: each shift x rotate variant is one composed affine matrix, so every image is warped once per
+    variant instead of a shift warp followed by a rotate warp. The images are warped by a thread pool (OpenCV releases
+    the GIL) directly into a preallocated TRANS_NUM, B, H, W, C array.
+    '''
+    def __init__(self, dataset, shift_pixels_one_direction, num_threads=None):
         assert isinstance(shift_pixels_one_direction, list)
         self.pixels_shift_dict = {}
         for direction in Direction:
             self.pixels_shift_dict[direction] = copy.copy(shift_pixels_one_direction)
         self.pixels_shift_dict[Direction.right].append(0)
         self.rotate_angles = IMAGE_ROTATE_DETECTOR_ANGLES[dataset]
-        self.process_chain = [self.shift_pixel_cv2,self.rotate]
-
-    def rotate(self, xs):
-        new_xs = []
-        for x in xs:
-            for rotate_angle in self.rotate_angles:
-                M = cv2.getRotationMatrix2D((x.shape[0] // 2, x.shape[1] / 2), rotate_angle, 1)
-                rotate_x = cv2.warpAffine(x,  M, (x.shape[1], x.shape[0]))
-                new_xs.append(rotate_x)
-        return np.stack(new_xs) # B,
-
-
-    def shift_pixel_cv2(self, xs):
-        new_xs = []
-        for x in xs:  # xs shape = (N,H,W,C)
+        self.num_threads = num_threads or os.cpu_count()
+        self._pool = None
+        self.M_cache = {}  # (H, W) -> list of composed matrices
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.num_threads)
+        return self._pool
+
+    def __getstate__(self):
+        # deepcopy/pickle of the detector do not carry the thread pool, each copy starts its own
+        state = self.__dict__.copy()
+        state["_pool"] = None
+        return state
+
+    def shift_matrix(self, direction, shift_pixel):
+        if direction == Direction.left:
+            tx, ty = -shift_pixel, 0
+        elif direction == Direction.right:
+            tx, ty = shift_pixel, 0
+        elif direction == Direction.up:
+            tx, ty = 0, -shift_pixel
+        elif direction == Direction.down:
+            tx, ty = 0, shift_pixel
+        return np.float64([[1, 0, tx], [0, 1, ty], [0, 0, 1]])
+
+    def transform_matrices(self, height, width):
+        ''' rotate(shift(x)) as one 2x3 matrix per variant, shift major and angle minor like the former chain '''
+        key = (height, width)
+        if key not in self.M_cache:
+            Ms = []
             for direction, shift_pixels in self.pixels_shift_dict.items():
                 for shift_pixel in shift_pixels:
-                    if direction == Direction.left:
-                        tx = -shift_pixel
-                        ty = 0
-                    elif direction == Direction.right:
-                        tx = shift_pixel
-                        ty = 0
-                    elif direction == Direction.up:
-                        tx = 0
-                        ty = -shift_pixel
-                    elif direction == Direction.down:
-                        tx = 0
-                        ty = shift_pixel
-
-                    M = np.float32([[1, 0, tx], [0, 1, ty]])
-                    shift_x = cv2.warpAffine(x, M, (x.shape[1], x.shape[0]))
-                    new_xs.append(shift_x)
-        return np.stack(new_xs)
+                    for rotate_angle in self.rotate_angles:
+                        R = np.vstack([cv2.getRotationMatrix2D((height // 2, width / 2), rotate_angle, 1), [0, 0, 1]])
+                        Ms.append(R.dot(self.shift_matrix(direction, shift_pixel))[:2])
+            self.M_cache[key] = Ms
+        return self.M_cache[key]
 
+    def warp_image(self, x, Ms, out, idx):
+        for trans_idx, M in enumerate(Ms):
+            out[trans_idx, idx] = cv2.warpAffine(x, M, (x.shape[1], x.shape[0]))
 
     def shift_pixel_numpy(self, xs): # B, 224,224,3
         new_xs = []
@@ -84,28 +101,34 @@ class ImageTransformCV2(object):
 
     def __call__(self, xs, random_rotate=False):
         '''
-        :param x:  224, 224, 3
-        :return:
+        :param xs:  B, H, W, C
+        :return: TRANS_NUM, B, H, W, C
         '''
         if random_rotate:
             self.rotate_angles = [random.randint(-180, 180) for _ in range(len(self.rotate_angles))]
+            self.M_cache.clear()
         xs = xs.detach().cpu().numpy()
         batch_size = xs.shape[0]
         height, width, channel = xs.shape[1], xs.shape[2], xs.shape[3]
         if channel == 1:
             xs =  np.squeeze(xs, -1)
-
-        for process_func in self.process_chain:
-            xs = process_func(xs)  # B, H, W, C
-        xs = xs.reshape(batch_size, -1, height, width, channel)  # B, TRANS_NUM,H,W,C
-        xs = np.transpose(xs, axes=(1,0,2,3,4))
-        xs = torch.from_numpy(xs).cuda()  # TRANS_NUM,B, H,W,C
+        Ms = self.transform_matrices(height, width)
+        out = np.empty((len(Ms), batch_size) + xs.shape[1:], dtype=xs.dtype)  # TRANS_NUM, B, H, W(, C)
+        list(self.pool.map(lambda idx: self.warp_image(xs[idx], Ms, out, idx), range(batch_size)))
+        out = out.reshape(len(Ms), batch_size, height, width, channel)
+        xs = to_device(torch.from_numpy(out))  # TRANS_NUM,B, H,W,C
         return xs
 
 
-
-
 class ImageTransformTorch(nn.Module):
+    '''
+    Bank of all shift x rotate transforms, each one is a single affine matrix composing the shift and the rotation.
+    All transforms of a batch are applied by one grid_sample: the batch is folded into the channels (1, N*C, H, W)
+    and expanded over the transforms, so the grids (TRANS_NUM, H, W, 2) do not depend on the batch size.
+    The grids are cached by image size and device in a bounded LRU.
+    '''
+    MAX_CACHED_GRIDS = 8
+
     def __init__(self, dataset, shift_pixels_one_direction):
         super(ImageTransformTorch,self).__init__()
         assert isinstance(shift_pixels_one_direction, list)
@@ -114,88 +137,50 @@ class ImageTransformTorch(nn.Module):
             self.pixels_shift_dict[direction] = copy.copy(shift_pixels_one_direction)
         self.pixels_shift_dict[Direction.right].append(0)
         self.rotate_angles = IMAGE_ROTATE_DETECTOR_ANGLES[dataset]
-        self.process_chain = [self.shift_pixel,self.rotate]
-        self.M_cache = {}
-
-    def rotate(self, xs):
-        all_rotate_xs = []
-        for rotate_angle in self.rotate_angles:
-            # height = xs.size(2)
-            # width = xs.size(3)
-            # M = cv2.getRotationMatrix2D((width / 2, height / 2), rotate_angle, 1)  # 2,3
-            # M[0, -1] /= (-float(width - 1))
-            # M[1, -1] /= (-float(height - 1))
-            key = "rotate_{}_batchsize_{}".format(rotate_angle, xs.size(0))
-            if key in self.M_cache:
-                M = self.M_cache[key]
-            else:
-                M = torch.Tensor([
-                    [ cos(rotate_angle), sin(rotate_angle), 0],
-                    [-sin(rotate_angle), cos(rotate_angle), 0],
-                    ]).float().cuda()
-                M = M.unsqueeze(0).repeat(xs.size(0),1,1).float()
-                self.M_cache[key] = M
-            grid = F.affine_grid(M, xs.size())  # Trans * N,C,H,W
-            rotate_xs = F.grid_sample(xs, grid)
-            all_rotate_xs.append(rotate_xs)  # each is Trans * N , C , H , W
-        all_rotate_xs= torch.stack(all_rotate_xs).contiguous()  # R,Trans * N ,C,H,W
-        R,B = all_rotate_xs.size(0), all_rotate_xs.size(1)
-        all_rotate_xs = all_rotate_xs.view(B*R, all_rotate_xs.size(2), all_rotate_xs.size(3),all_rotate_xs.size(4)).contiguous() # R * Trans * N ,C,H,W
-        return all_rotate_xs
-
-
-    def shift_pixel(self, xs):
-        new_xs = []
-
+        self.shifts = []  # (tx, ty) in pixels of the source to sample, the order of the former shift_pixel loop
         for direction, shift_pixels in self.pixels_shift_dict.items():
             for shift_pixel in shift_pixels:
-                key = "{}_{}".format(direction, shift_pixel)
-                for x_torch in xs:
-                    if direction == Direction.left:
-                        tx = shift_pixel
-                        ty = 0
-                    elif direction == Direction.right:
-                        tx = -shift_pixel
-                        ty = 0
-                    elif direction == Direction.up:
-                        tx = 0
-                        ty = shift_pixel
-                    elif direction == Direction.down:
-                        tx = 0
-                        ty = -shift_pixel
-                    width = x_torch.size(2)
-                    height = x_torch.size(1)
-                    if key in self.M_cache:
-                        M = self.M_cache[key]
-                    else:
-                        M = np.array([[1, 0, tx/float(width - 1)], [0, 1, ty/float(height-1)]]).astype(np.float32)
-                        # M = np.array([[1, 0, 0], [0, 1, -0.0031]]).astype(np.float32)  # 向右移动20%, 向下移动40%
-                        M = torch.from_numpy(M).cuda()
-                        self.M_cache[key] = M
-                    grid = F.affine_grid(M.unsqueeze(0), x_torch.unsqueeze(0).size())
-                    shift_x = F.grid_sample(x_torch.unsqueeze(0), grid, mode='bilinear')
-                    new_xs.append(shift_x)
-        return torch.cat(new_xs, dim=0)  # R * B, C,H,W
-
-
+                self.shifts.append({Direction.left: (shift_pixel, 0), Direction.right: (-shift_pixel, 0),
+                                    Direction.up: (0, shift_pixel), Direction.down: (0, -shift_pixel)}[direction])
+        self.grid_cache = OrderedDict()
 
+    def transform_matrices(self, height, width):
+        ''' TRANS_NUM,2,3, rotate angle major and shift minor, like the former shift_pixel -> rotate chain '''
+        M = []
+        for rotate_angle in self.rotate_angles:
+            # the angle goes to cos/sin as it is, like the former rotate did
+            for tx, ty in self.shifts:
+                M.append([[ cos(rotate_angle), sin(rotate_angle), tx / float(width - 1)],
+                          [-sin(rotate_angle), cos(rotate_angle), ty / float(height - 1)]])
+        return torch.Tensor(M)
+
+    def get_grid(self, xs):
+        key = (xs.size(2), xs.size(3), xs.device, xs.dtype)
+        if key in self.grid_cache:
+            self.grid_cache.move_to_end(key)
+            return self.grid_cache[key]
+        M = self.transform_matrices(xs.size(2), xs.size(3)).to(device=xs.device, dtype=xs.dtype)
+        grid = F.affine_grid(M, (M.size(0), 1, xs.size(2), xs.size(3)))  # TRANS_NUM, H, W, 2
+        self.grid_cache[key] = grid
+        if len(self.grid_cache) > self.MAX_CACHED_GRIDS:
+            self.grid_cache.popitem(last=False)
+        return grid
 
     def forward(self, xs, random_rotate=False):
         '''
-        :param x:  224, 224, 3
-        :return:
+        :param xs:  N, H, W, C
+        :return: Transform, N, H, W, C
         '''
         if random_rotate:
             self.rotate_angles = [random.randint(-180, 180) for _ in range(len(self.rotate_angles))]
+            self.grid_cache.clear()
 
         xs = xs.permute(0,3,1,2)  # N,H,W,C -> N,C,H,W
-        batch_size = xs.size(0)
-        channel, height, width = xs.size(1),xs.size(2), xs.size(3)
-        for process_func in self.process_chain:
-            xs = process_func(xs)
-        xs = xs.permute(0, 2, 3, 1).contiguous()  # B,H,W,C
-        xs = xs.view(-1, batch_size, height, width, channel)  # Transform, N,  H, W,C
-
+        batch_size, channel, height, width = xs.size(0), xs.size(1),xs.size(2), xs.size(3)
+        grid = self.get_grid(xs)
+        xs = xs.reshape(1, batch_size * channel, height, width).expand(grid.size(0), -1, -1, -1)
+        xs = F.grid_sample(xs, grid)  # Transform, N * C, H, W
+        xs = xs.view(-1, batch_size, channel, height, width).permute(0, 1, 3, 4, 2).contiguous()  # Transform, N,  H, W,C
         return xs
 
 
@@ -206,7 +191,6 @@ if __name__ == "__main__":
     img_list = transform(img)
     img_list = img_list.detach().cpu().numpy()
     output_path = "/home1/machen/clean_cv2/"
-    import os
     os.makedirs(output_path, exist_ok=True)
     for i, img in enumerate(img_list):
         cv2.imwrite("{}/{}.png".format(output_path, i), img)
@@ -217,8 +201,6 @@ if __name__ == "__main__":
     img_list = transform(img)
     img_list = img_list.detach().cpu().numpy()
     output_path = "/home1/machen/clean_torch/"
-    import os
-
     os.makedirs(output_path, exist_ok=True)
     for i, img in enumerate(img_list):
 
@@ -41,6 +41,7 @@ from image_rotate_detector.image_rotate import ImageTransformCV2
 from config import PY_ROOT
 import re
 from image_rotate_detector.evaluation.speed_evaluation import evaluate_speed
+from toolkit.device import add_device_args
 
 # 整个程序分两步走:1. 先训练一个图像分类器，分类用原始的gt label; 2.再训练一个 detector，锁定图像分类器的weight
 parser = argparse.ArgumentParser(description='PyTorch RotateDetection(TransformDet) Training')
@@ -92,6 +93,7 @@ best_acc1 = 0
 
 
 def main():
+    add_device_args(parser)
     args = parser.parse_args()
     if args.seed is not None:
         random.seed(args.seed)
@@ -118,7 +120,7 @@ def main():
     elif args.study_subject == "zero_shot":
         evaluate_zero_shot(args)
     elif args.study_subject == "speed_test":
-        evaluate_speed(args)
+        evaluate_speed(args)  # the device is set inside, after CUDA_VISIBLE_DEVICES
 
 def evaluate_accuracy(net, in_, target_positive, weights=None):
     # in_ is one task's 5-way k-shot data, in_ is either support data or query data
@@ -223,6 +225,8 @@ def train_epochs(detector_model_path, train_loader, detector, optimizer, arch, a
     for epoch in range(args.start_epoch, args.epochs):
         adjust_learning_rate(optimizer, epoch, args)
         train(detector_model_path, train_loader, detector, detector_loss, optimizer, epoch, arch, args)
+        if hasattr(train_loader.dataset, "cache_stats") and train_loader.dataset.cache_stats() is not None:
+            print("epoch {} image cache: {}".format(epoch, train_loader.dataset.cache_stats()))
 
 
 def train(model_path, train_loader, model, criterion, optimizer, epoch, arch, args):
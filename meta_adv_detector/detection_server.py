@@ -0,0 +1,254 @@
+import base64
+import copy
+import http.client
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from evaluation_toolkit.adaptation_engine import AdaptationEngine
+from toolkit.device import to_device, autocast
+
+'''
+Online detection service of MetaAdvDet.
+A context (an attack / task seen in deployment) is registered with a few labeled support images, the meta-learned
+network is fine-tuned on them once and the adapted detector is kept for that context.
+With an AdaptedWeightCache, registering a support set again restores its adapted weights without fine-tuning.
+Single images are then submitted against a context; a batching thread coalesces them into micro-batches
+that are closed either when max_batch_size images are collected or when the oldest image has waited max_latency_ms.
+Label 0 is the adversarial way and label 1 the clean way, the same as adv_label of MetaTaskDataset.
+'''
+
+
+def encode_array(array):
+    array = np.ascontiguousarray(array, dtype=np.float32)
+    return {"data": base64.b64encode(array.tobytes()).decode("ascii"), "shape": list(array.shape)}
+
+
+def decode_array(array_json):
+    return np.frombuffer(base64.b64decode(array_json["data"]), dtype=np.float32).reshape(array_json["shape"])
+
+
+class UnknownContextError(KeyError):
+    pass
+
+
+class DetectionRequest(object):
+    def __init__(self, context, image):
+        self.context = context
+        self.image = image
+        self.future = Future()
+        self.arrive_time = time.time()
+
+
+class DetectionServer(object):
+    def __init__(self, network, inner_lr, num_updates, max_batch_size=64, max_latency_ms=5.0, update_BN=True,
+                 cache=None):
+        self.engine = AdaptationEngine(network, inner_lr, num_updates, update_BN, cache=cache)
+        self.detectors = {}  # context -> adapted detector
+        self.detectors_lock = threading.Lock()
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self.requests = queue.Queue()
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+        self.running = False
+        self.batch_thread = None
+
+    def start(self):
+        self.running = True
+        self.batch_thread = threading.Thread(target=self.batch_loop, daemon=True)
+        self.batch_thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.batch_thread is not None:
+            self.batch_thread.join()
+            self.batch_thread = None
+
+    def register(self, context, support_images, support_labels):
+        ''' fine-tune the master network on the support set of the context, replaces the former detector of it '''
+        support_images = torch.as_tensor(support_images, dtype=torch.float32)
+        support_labels = to_device(torch.as_tensor(support_labels, dtype=torch.long))
+        with self.engine.worker() as worker:
+            detector = copy.deepcopy(self.engine.adapt(worker, support_images, support_labels))
+        detector.eval()
+        with self.detectors_lock:
+            self.detectors[context] = detector
+        return context
+
+    def unregister(self, context):
+        with self.detectors_lock:
+            self.detectors.pop(context, None)
+
+    def submit(self, context, image):
+        ''' image: one image, flattened or C x H x W, returns a Future of the scores '''
+        request = DetectionRequest(context, torch.as_tensor(image, dtype=torch.float32))
+        if context not in self.detectors:
+            request.future.set_exception(UnknownContextError("context {} is not registered".format(context)))
+        else:
+            self.requests.put(request)
+        return request.future
+
+    def detect(self, context, image, timeout=None):
+        return self.submit(context, image).result(timeout)
+
+    def next_batch(self):
+        try:
+            first_request = self.requests.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first_request]
+        deadline = first_request.arrive_time + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remain_time = deadline - time.time()
+            if remain_time <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remain_time))
+            except queue.Empty:
+                break
+        return batch
+
+    def batch_loop(self):
+        while self.running:
+            batch = self.next_batch()
+            if batch:
+                self.run_batch(batch)
+
+    def run_batch(self, batch):
+        context_requests = OrderedDict()
+        for request in batch:
+            context_requests.setdefault(request.context, []).append(request)
+        for context, requests in context_requests.items():
+            try:
+                with self.detectors_lock:
+                    if context not in self.detectors:  # unregistered after submit
+                        raise UnknownContextError("context {} is not registered".format(context))
+                    detector = self.detectors[context]
+                x = to_device(torch.stack([request.image.view(-1) for request in requests]))
+                with torch.no_grad(), autocast():
+                    out = detector.net_forward(x)
+                scores = F.softmax(out.float(), dim=1).cpu().numpy()
+            except Exception as e:
+                for request in requests:
+                    request.future.set_exception(e)
+                continue
+            finish_time = time.time()
+            for request, score in zip(requests, scores):
+                request.future.set_result({"adv_score": float(score[0]), "clean_score": float(score[1]),
+                                           "is_adversarial": bool(score[0] > score[1])})
+            with self.stats_lock:
+                self.latencies.extend(finish_time - request.arrive_time for request in requests)
+                self.batch_sizes.append(len(requests))
+                if self.first_arrive_time is None:
+                    self.first_arrive_time = requests[0].arrive_time
+                self.last_finish_time = finish_time
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.latencies = deque(maxlen=1000000)
+            self.batch_sizes = []
+            self.first_arrive_time = None
+            self.last_finish_time = None
+
+    def stats(self):
+        ''' server side latency (from submit to result) and throughput '''
+        with self.stats_lock:
+            if not self.latencies:
+                return {"num_images": 0}
+            latencies = np.array(self.latencies) * 1000
+            return {"num_images": len(latencies), "p50_ms": float(np.percentile(latencies, 50)),
+                    "p99_ms": float(np.percentile(latencies, 99)), "mean_batch_size": float(np.mean(self.batch_sizes)),
+                    "images_per_sec": len(latencies) / max(self.last_finish_time - self.first_arrive_time, 1e-9)}
+
+
+class DetectionRequestHandler(BaseHTTPRequestHandler):
+    '''
+    POST /register {"context", "support_images": encoded array, "support_labels": list}
+    POST /detect {"context", "image": encoded array}
+    GET /stats
+    '''
+    protocol_version = "HTTP/1.1"  # keep-alive, a client reuses its connection
+
+    def send_json(self, code, result):
+        body = json.dumps(result).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.detection_server.stats())
+        else:
+            self.send_json(404, {"error": "unknown path {}".format(self.path)})
+
+    def do_POST(self):
+        detection_server = self.server.detection_server
+        try:
+            request_json = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+            if self.path == "/register":
+                detection_server.register(request_json["context"], decode_array(request_json["support_images"]),
+                                          request_json["support_labels"])
+                self.send_json(200, {"context": request_json["context"]})
+            elif self.path == "/detect":
+                self.send_json(200, detection_server.detect(request_json["context"], decode_array(request_json["image"])))
+            else:
+                self.send_json(404, {"error": "unknown path {}".format(self.path)})
+        except UnknownContextError as e:
+            self.send_json(404, {"error": str(e)})
+        except (KeyError, ValueError, json.JSONDecodeError) as e:  # a missing field, bad json, base64 or shape
+            self.send_json(400, {"error": "bad request: {}".format(e)})
+        except Exception as e:  # every request gets a response instead of a dropped connection
+            self.send_json(500, {"error": "{}: {}".format(type(e).__name__, e)})
+
+    def log_message(self, format, *args):
+        pass  # no log line for every image
+
+
+def serve(detection_server, host="127.0.0.1", port=0):
+    ''' start the HTTP interface in a background thread, port 0 picks a free port, returns the http server '''
+    httpd = ThreadingHTTPServer((host, port), DetectionRequestHandler)
+    httpd.daemon_threads = True
+    httpd.detection_server = detection_server
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
+
+
+class DetectionClient(object):
+    ''' one connection to the server, use one client per thread '''
+
+    def __init__(self, host, port, timeout=60):
+        self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def request(self, method, path, request_json=None):
+        body = json.dumps(request_json) if request_json is not None else None
+        self.connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = self.connection.getresponse()
+        result = json.loads(response.read().decode("utf-8"))
+        if response.status != 200:
+            raise RuntimeError(result["error"])
+        return result
+
+    def register(self, context, support_images, support_labels):
+        return self.request("POST", "/register", {"context": context, "support_images": encode_array(support_images),
+                                                  "support_labels": [int(label) for label in support_labels]})
+
+    def detect(self, context, image):
+        return self.request("POST", "/detect", {"context": context, "image": encode_array(image)})
+
+    def stats(self):
+        return self.request("GET", "/stats")
+
+    def close(self):
+        self.connection.close()
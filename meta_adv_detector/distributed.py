@@ -0,0 +1,54 @@
+import torch
+import torch.distributed as dist
+
+'''
+Data-parallel meta-training: the tasks of each meta-batch are sharded across processes, every process computes
+the summed meta-gradient of its own tasks and the meta-gradients are all-reduced before the meta update,
+so every process takes the same Adam step as a single process on the whole meta-batch.
+The gloo backend runs on CPU-only boxes, one process per group of cores.
+'''
+
+
+def init_distributed(backend, init_method, world_size, rank):
+    dist.init_process_group(backend=backend, init_method=init_method, world_size=world_size, rank=rank)
+    if backend == "nccl":
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+    print("rank {}/{} joins the {} process group".format(rank, world_size, backend))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def all_reduce_flat_grad(flat_grad):
+    ''' sum the flat meta-gradient buffer over all processes in place, one all_reduce per meta-batch '''
+    if is_distributed():
+        dist.all_reduce(flat_grad, op=dist.ReduceOp.SUM)
+    return flat_grad
+
+
+def broadcast_network(network):
+    ''' start all processes from the parameters and buffers of rank 0 '''
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in network.state_dict().values():
+            dist.broadcast(tensor, src=0)
+
+
+def destroy_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
@@ -0,0 +1,50 @@
+from meta_adv_detector.evaluation.inner_loop_benchmark import random_meta_batch, loop_meta_grads, timeit
+from meta_adv_detector.inner_loop import InnerLoop, parse_checkpoint_indices
+from meta_adv_detector.meta_adv_det import MetaLearner
+from toolkit.device import module_to_device, reset_peak_memory, peak_memory_mb, is_cpu
+
+
+def checkpoint_configs(args):
+    ''' name -> (checkpoint_steps, checkpoint_blocks), in the order of decreasing memory saving '''
+    configs = [("steps+blocks", "all", "all"), ("steps", "all", []),
+               ("every_other_step", list(range(0, args.num_updates, 2)), []), ("blocks", [], "all")]
+    if args.checkpoint_steps or args.checkpoint_blocks:
+        configs.append(("args", parse_checkpoint_indices(args.checkpoint_steps),
+                        parse_checkpoint_indices(args.checkpoint_blocks)))
+    configs.append(("none", [], []))
+    return configs
+
+
+def benchmark_inner_loop_checkpointing(args, iterations=5):
+    '''
+    Memory vs time of the checkpointed second-order (maml) inner loop on random tasks, e.g. with --arch resnet18.
+    Every config is checked to give the same meta-gradient as the unrolled inner loop without checkpointing.
+    '''
+    assert args.arch in ["resnet10", "resnet18"], "the blocks are those of the MetaNetwork of networks/resnet.py"
+    learner = MetaLearner(args.dataset, args.num_classes, args.meta_batch_size, args.meta_lr, args.inner_lr,
+                          args.lr_decay_itr, args.epoch, args.num_updates, args.load_task_mode, args.split_protocol,
+                          args.arch, args.tot_num_tasks, args.num_support, args.num_query, args.no_random_way, "",
+                          train=False, adv_arch=args.adv_arch)
+    network = learner.network
+    meta_batch = random_meta_batch(args.dataset, args.meta_batch_size, args.num_classes, args.num_support, args.num_query)
+    print("blocks of {}: {}".format(args.arch, list(enumerate(network.functional_graph.block_names()))))
+    if is_cpu():
+        print("peak memory is the peak RSS of the process, which grows monotonically over the configs")
+
+    result_json = {"arch": args.arch, "meta_batch_size": args.meta_batch_size, "num_updates": args.num_updates}
+    all_meta_grads = {}
+    for name, checkpoint_steps, checkpoint_blocks in checkpoint_configs(args):
+        fast_net = module_to_device(InnerLoop(network, args.num_updates, args.inner_lr, args.meta_batch_size, "maml",
+                                              checkpoint_steps=checkpoint_steps, checkpoint_blocks=checkpoint_blocks))
+        reset_peak_memory()
+        all_meta_grads[name] = loop_meta_grads(fast_net, network, *meta_batch)
+        itr_per_sec = timeit(lambda: loop_meta_grads(fast_net, network, *meta_batch), iterations)
+        result_json[name] = {"ms_per_step": 1000 / itr_per_sec, "peak_memory_MB": peak_memory_mb()}
+        del fast_net
+    reference = all_meta_grads["none"]
+    for name, meta_grads in all_meta_grads.items():
+        result_json[name]["max_grad_diff"] = max((meta_grads[k] - reference[k]).abs().max().item()
+                                                 for k in reference.keys())
+        result_json[name]["time_ratio"] = result_json[name]["ms_per_step"] / result_json["none"]["ms_per_step"]
+    print(result_json)
+    return result_json
@@ -0,0 +1,172 @@
+import time
+import types
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, update_wrapper
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from config import IN_CHANNELS, IMAGE_SIZE
+from networks.meta_network import MetaNetwork
+from networks.resnet import resnet10, resnet18
+from toolkit.device import to_device, module_to_device, synchronize
+
+
+# The former MetaNetwork.net_forward and its helpers, copied verbatim from networks/meta_network.py before the
+# compiled functional graph, kept here only as the baseline of the benchmark.
+def conv_weight_forward(self, x, conv_fc_module_to_name, param_dict):
+    module_weight_name = conv_fc_module_to_name[self]["weight"]
+    conv_weight = param_dict[module_weight_name]
+    conv_bias = self.bias
+    if self.bias is not None:
+        module_bias_name = conv_fc_module_to_name[self]["bias"]
+        conv_bias = param_dict[module_bias_name]
+    out = F.conv2d(x, conv_weight, conv_bias, self.stride,
+                   self.padding, self.dilation, self.groups)  # B, C, H, W
+    return out
+
+def fc_weight_forward(self, x,conv_fc_module_to_name, param_dict):
+    module_weight_name = conv_fc_module_to_name[self]["weight"]
+    fc_weight = param_dict[module_weight_name]
+    fc_bias = self.bias
+    if self.bias is not None:
+        module_bias_name = conv_fc_module_to_name[self]["bias"]
+        fc_bias = param_dict[module_bias_name]
+    return F.linear(x, fc_weight, fc_bias)
+
+def bn_forward(self, x, conv_fc_module_to_name, param_dict):
+    exponential_average_factor = 0.0
+    if self.training and self.track_running_stats:
+        self.num_batches_tracked += 1
+        if self.momentum is None:  # use cumulative moving average
+            exponential_average_factor = 1.0 / self.num_batches_tracked.item()
+        else:  # use exponential moving average
+            exponential_average_factor = self.momentum
+    module_weight_name = conv_fc_module_to_name[self]["weight"]
+    weight = param_dict[module_weight_name]
+    bias = self.bias
+    if self.bias is not None:
+        module_bias_name = conv_fc_module_to_name[self]["bias"]
+        bias = param_dict[module_bias_name]
+
+    return F.batch_norm(
+        x, self.running_mean, self.running_var, weight, bias,
+        self.training or not self.track_running_stats,
+        exponential_average_factor, self.eps)
+
+
+class PatchedMetaNetwork(nn.Module):
+    ''' the former per-call forward patching, runs on the network of a MetaNetwork '''
+
+    def __init__(self, meta_network):
+        super(PatchedMetaNetwork, self).__init__()
+        self.channels = meta_network.channels
+        self.img_size = meta_network.img_size
+        self.network = meta_network.network
+        self.conv_fc_module_to_name = self.construct_module_name_dict()
+
+    def construct_module_name_dict(self):
+        module_to_name = defaultdict(dict)
+        for name, module in self.network.named_modules():
+            if isinstance(module, nn.Conv2d) or isinstance(module, nn.Linear) or isinstance(module, nn.BatchNorm2d):
+                module_to_name[module]["weight"] = "network.{}.weight".format(name)
+                if module.bias is not None:
+                    module_to_name[module]["bias"] = "network.{}.bias".format(name)
+        return module_to_name
+
+    def backup_orig_forward(self, module):
+        if isinstance(module, nn.Conv2d) or isinstance(module, nn.Linear) or isinstance(module, nn.BatchNorm2d):
+            if not hasattr(module, "orig_forward"):
+                f = module.forward
+                g = types.FunctionType(f.__code__, f.__globals__, name=f.__name__,
+                                       argdefs=f.__defaults__,
+                                       closure=f.__closure__)
+                g = update_wrapper(g, f)
+                module.orig_forward = types.MethodType(g, module)
+
+    def recover_orig_forward(self, module):
+        if isinstance(module, nn.Conv2d) or isinstance(module, nn.Linear) or isinstance(module, nn.BatchNorm2d):
+            module.forward = module.orig_forward
+
+
+    def replace_forward(self, module, weight):
+        if isinstance(module, nn.Conv2d):
+            module.forward = partial(types.MethodType(conv_weight_forward, module), conv_fc_module_to_name=self.conv_fc_module_to_name,
+                                     param_dict=weight)
+        elif isinstance(module, nn.Linear):
+            module.forward = partial(types.MethodType(fc_weight_forward, module), conv_fc_module_to_name=self.conv_fc_module_to_name,
+                                     param_dict=weight)
+        elif isinstance(module, nn.BatchNorm2d):
+            module.forward = partial(types.MethodType(bn_forward, module), conv_fc_module_to_name=self.conv_fc_module_to_name,
+                                     param_dict=weight)
+
+    def forward(self,x):
+        return self.network(x)
+
+    def net_forward(self, x, weight=None):
+        self.network.apply(self.backup_orig_forward)  # 备份原本的forward函数
+        x = x.view(-1, self.channels, self.img_size[0], self.img_size[1])
+        if weight is not None:
+            self.network.apply(partial(self.replace_forward, weight=weight))
+        output = self.forward(x)
+        self.network.apply(self.recover_orig_forward)
+        return output
+
+
+def build_network(arch, dataset):
+    # conv3 is not benchmarked: it is trained with its own functional forward (Conv3.net_forward), not in MetaNetwork
+    if arch == "resnet10":
+        network = resnet10(2, in_channels=IN_CHANNELS[dataset], pretrained=False)
+    elif arch == "resnet18":
+        network = resnet18(2, in_channels=IN_CHANNELS[dataset], pretrained=False)
+    return module_to_device(MetaNetwork(network, IN_CHANNELS[dataset], IMAGE_SIZE[dataset]))
+
+
+def inner_step_time(forward, weights, x, target, iterations):
+    ''' time of one inner update step: forward with a params dict, then the gradient w.r.t. the params '''
+    synchronize()
+    before_time = time.time()
+    for _ in range(iterations):
+        loss = F.cross_entropy(forward(x, weights), target)
+        torch.autograd.grad(loss, list(weights.values()))
+    synchronize()
+    return (time.time() - before_time) / iterations
+
+
+def benchmark_functional_forward(args, archs=("resnet10", "resnet18"), iterations=100, num_threads=4):
+    '''
+    Compare MetaNetwork.net_forward (compiled functional graph) with the former per-call forward patching:
+    outputs must be equal, report the time of one inner step of each, and check that several weight sets
+    running in threads give the same outputs as running them one by one.
+    '''
+    result_json = {}
+    for arch in archs:
+        network = build_network(arch, args.dataset)
+        network.eval()  # running statistics are shared by the threads, so they are not updated in this benchmark
+        patched_network = PatchedMetaNetwork(network)
+        batch_size = args.num_classes * args.num_support
+        x = to_device(torch.rand(batch_size, IN_CHANNELS[args.dataset], *IMAGE_SIZE[args.dataset]))
+        target = to_device(torch.randint(0, args.num_classes, (batch_size,)).long())
+        weights = OrderedDict((name, param.detach().clone().requires_grad_()) for name, param in network.named_parameters())
+
+        functional_out = network.net_forward(x, weights)
+        patched_out = patched_network.net_forward(x, weights)
+        assert torch.allclose(functional_out, patched_out, atol=1e-5), "{} outputs differ".format(arch)
+
+        weight_sets = [OrderedDict((name, param.detach() + 0.01 * torch.randn_like(param)) for name, param in weights.items())
+                       for _ in range(num_threads)]
+        with torch.no_grad():
+            serial_outs = [network.net_forward(x, weight_set) for weight_set in weight_sets]
+            with ThreadPoolExecutor(max_workers=num_threads) as pool:
+                thread_outs = list(pool.map(lambda weight_set: network.net_forward(x, weight_set), weight_sets))
+        for serial_out, thread_out in zip(serial_outs, thread_outs):
+            assert torch.allclose(serial_out, thread_out, atol=1e-5), "{} threaded outputs differ".format(arch)
+
+        patched_time = inner_step_time(patched_network.net_forward, weights, x, target, iterations)
+        functional_time = inner_step_time(network.net_forward, weights, x, target, iterations)
+        result_json[arch] = {"patched_step_ms": patched_time * 1000, "functional_step_ms": functional_time * 1000,
+                             "speedup": patched_time / functional_time}
+        print(arch, result_json[arch])
+    return result_json
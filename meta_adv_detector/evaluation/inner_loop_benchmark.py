@@ -0,0 +1,75 @@
+import time
+
+import numpy as np
+import torch
+
+from config import IN_CHANNELS, IMAGE_SIZE
+from meta_adv_detector.inner_loop import InnerLoop, BatchedInnerLoop
+from meta_adv_detector.meta_adv_det import MetaLearner
+from toolkit.device import to_device, module_to_device, synchronize
+
+
+def random_meta_batch(dataset, meta_batch_size, num_classes, num_support, num_query):
+    dim_input = int(np.prod(IMAGE_SIZE[dataset]) * IN_CHANNELS[dataset])
+    support_images = to_device(torch.rand(meta_batch_size, num_classes * num_support, dim_input))
+    query_images = to_device(torch.rand(meta_batch_size, num_classes * num_query, dim_input))
+    support_labels = to_device(torch.randint(0, num_classes, (meta_batch_size, num_classes * num_support)).long())
+    query_labels = to_device(torch.randint(0, num_classes, (meta_batch_size, num_classes * num_query)).long())
+    return support_images, query_images, support_labels, query_labels
+
+
+def loop_meta_grads(fast_net, network, support_images, query_images, support_labels, query_labels):
+    grads = []
+    for task_idx in range(support_images.size(0)):
+        fast_net.copy_weights(network)
+        grads.append(fast_net.forward(support_images[task_idx], query_images[task_idx], support_labels[task_idx],
+                                      query_labels[task_idx]))
+    return {k: sum(d[k] for d in grads) for k in grads[0].keys()}
+
+
+def batched_meta_grads(fast_net, network, support_images, query_images, support_labels, query_labels):
+    fast_net.copy_weights(network)
+    return fast_net.forward(support_images, query_images, support_labels, query_labels)
+
+
+def timeit(func, iterations):
+    synchronize()
+    before_time = time.time()
+    for _ in range(iterations):
+        func()
+    synchronize()
+    return iterations / (time.time() - before_time)
+
+
+def benchmark_batched_inner_loop(args, iterations=20, rel_tol=1e-2):
+    '''
+    Check that BatchedInnerLoop gives the same summed meta-gradient as the task-by-task InnerLoop on random tasks,
+    then report the meta-training iterations/sec of both.
+    '''
+    learner = MetaLearner(args.dataset, args.num_classes, args.meta_batch_size, args.meta_lr, args.inner_lr,
+                          args.lr_decay_itr, args.epoch, args.num_updates, args.load_task_mode, args.split_protocol,
+                          args.arch, args.tot_num_tasks, args.num_support, args.num_query, args.no_random_way, "",
+                          train=False, adv_arch=args.adv_arch)
+    network = learner.network
+    loop_net = module_to_device(InnerLoop(network, args.num_updates, args.inner_lr, args.meta_batch_size))
+    batched_net = module_to_device(BatchedInnerLoop(network, args.num_updates, args.inner_lr, args.meta_batch_size))
+    meta_batch = random_meta_batch(args.dataset, args.meta_batch_size, args.num_classes, args.num_support, args.num_query)
+
+    loop_grads = loop_meta_grads(loop_net, network, *meta_batch)
+    batched_grads = batched_meta_grads(batched_net, network, *meta_batch)
+    max_diff = max((loop_grads[k] - batched_grads[k]).abs().max().item() for k in loop_grads.keys())
+    # float32 sums in another order through the BN layers of tiny batches, so the tolerance is relative to the norm
+    # of each gradient instead of elementwise: a wrong meta-gradient is off by O(1), reordering noise by ~1e-4
+    rel_diffs = {k: ((loop_grads[k] - batched_grads[k]).norm() / loop_grads[k].norm().clamp(min=1e-12)).item()
+                 for k in loop_grads.keys()}
+    for k, rel_diff in rel_diffs.items():
+        assert rel_diff <= rel_tol, "meta-gradient of {} differs, relative diff {}".format(k, rel_diff)
+
+    loop_itr_per_sec = timeit(lambda: loop_meta_grads(loop_net, network, *meta_batch), iterations)
+    batched_itr_per_sec = timeit(lambda: batched_meta_grads(batched_net, network, *meta_batch), iterations)
+    result_json = {"arch": args.arch, "meta_batch_size": args.meta_batch_size, "num_updates": args.num_updates,
+                   "max_grad_diff": max_diff, "max_rel_grad_diff": max(rel_diffs.values()),
+                   "loop_itr_per_sec": loop_itr_per_sec,
+                   "batched_itr_per_sec": batched_itr_per_sec, "speedup": batched_itr_per_sec / loop_itr_per_sec}
+    print(result_json)
+    return result_json
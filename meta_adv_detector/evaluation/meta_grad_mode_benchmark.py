@@ -0,0 +1,49 @@
+import torch
+
+from meta_adv_detector.evaluation.inner_loop_benchmark import random_meta_batch, loop_meta_grads, batched_meta_grads, timeit
+from meta_adv_detector.inner_loop import InnerLoop, BatchedInnerLoop
+from meta_adv_detector.meta_adv_det import MetaLearner
+from toolkit.device import module_to_device, reset_peak_memory, peak_memory_mb, is_cpu
+
+# in the order of increasing memory, because the peak RSS on the CPU cannot be reset between the modes
+BENCHMARK_MODES = ["reptile", "fomaml", "imaml", "maml"]
+
+
+def flat_meta_grad(meta_grads):
+    return torch.cat([meta_grads[k].view(-1) for k in sorted(meta_grads.keys())])
+
+
+def benchmark_meta_grad_modes(args, iterations=10):
+    '''
+    Report the time of one meta step and the peak memory of every meta_grad_mode on random tasks,
+    and the cosine similarity of its meta-gradient to the second-order MAML meta-gradient.
+    '''
+    learner = MetaLearner(args.dataset, args.num_classes, args.meta_batch_size, args.meta_lr, args.inner_lr,
+                          args.lr_decay_itr, args.epoch, args.num_updates, args.load_task_mode, args.split_protocol,
+                          args.arch, args.tot_num_tasks, args.num_support, args.num_query, args.no_random_way, "",
+                          train=False, adv_arch=args.adv_arch)
+    network = learner.network
+    meta_batch = random_meta_batch(args.dataset, args.meta_batch_size, args.num_classes, args.num_support, args.num_query)
+    maml_net = module_to_device(InnerLoop(network, args.num_updates, args.inner_lr, args.meta_batch_size, "maml"))
+    maml_grad = flat_meta_grad(loop_meta_grads(maml_net, network, *meta_batch))
+    del maml_net
+
+    result_json = {"arch": args.arch, "meta_batch_size": args.meta_batch_size, "num_updates": args.num_updates,
+                   "batched_inner_loop": args.batched_inner_loop, "peak_memory": "RSS" if is_cpu() else "cuda"}
+    for mode in BENCHMARK_MODES:
+        if args.batched_inner_loop and mode in ["fomaml", "maml"]:
+            fast_net = BatchedInnerLoop(network, args.num_updates, args.inner_lr, args.meta_batch_size, mode)
+            meta_grads_func = batched_meta_grads
+        else:
+            fast_net = InnerLoop(network, args.num_updates, args.inner_lr, args.meta_batch_size, mode,
+                                 args.imaml_lambda, args.imaml_cg_steps)
+            meta_grads_func = loop_meta_grads
+        fast_net = module_to_device(fast_net)
+        reset_peak_memory()
+        meta_grad = flat_meta_grad(meta_grads_func(fast_net, network, *meta_batch))
+        itr_per_sec = timeit(lambda: meta_grads_func(fast_net, network, *meta_batch), iterations)
+        result_json[mode] = {"ms_per_step": 1000 / itr_per_sec, "peak_memory_MB": peak_memory_mb(),
+                             "cosine_to_maml": torch.nn.functional.cosine_similarity(meta_grad, maml_grad, dim=0).item()}
+        del fast_net
+    print(result_json)
+    return result_json
@@ -0,0 +1,104 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from config import PY_ROOT
+from evaluation_toolkit.adapted_cache import build_adapted_cache
+from meta_adv_detector.detection_server import DetectionServer, DetectionClient, serve
+from meta_adv_detector.meta_adv_det import MetaLearner
+from toolkit.device import device_name
+
+
+def build_detection_server(args):
+    learner = MetaLearner(args.dataset, 2, args.meta_batch_size, args.meta_lr, args.inner_lr, args.lr_decay_itr,
+                          args.epoch, args.test_num_updates, args.load_task_mode, args.split_protocol, args.arch,
+                          args.tot_num_tasks, args.num_support, 15, True, "", train=False, adv_arch=args.adv_arch,
+                          need_val=True)
+    if args.model_path:
+        print("=> loading checkpoint '{}'".format(args.model_path))
+        checkpoint = torch.load(args.model_path, map_location=lambda storage, location: storage)
+        learner.network.load_state_dict(checkpoint['state_dict'], strict=True)
+    server = DetectionServer(learner.network, args.inner_lr, args.test_num_updates, args.max_batch_size,
+                             args.max_latency_ms, cache=build_adapted_cache(args))
+    return server, learner.val_loader
+
+
+def run_detection_server(args):
+    ''' the long-running service, register contexts and send images with DetectionClient '''
+    server, _ = build_detection_server(args)
+    httpd = serve(server.start(), args.host, args.port)
+    print("detection server listens on {}:{}".format(*httpd.server_address))
+    try:
+        while True:
+            time.sleep(60)
+            print(server.stats())
+    except KeyboardInterrupt:
+        httpd.shutdown()
+        server.stop()
+
+
+def benchmark_detection_server(args, num_contexts=10, num_clients=16):
+    '''
+    Offline test of the service with local clients: register the support sets of num_contexts validation tasks,
+    then num_clients threads send the query images one by one. Report client and server side p50/p99 latency
+    and the throughput, and check the accuracy against the query labels.
+    '''
+    server, val_loader = build_detection_server(args)
+    httpd = serve(server.start(), "127.0.0.1", 0)
+    host, port = httpd.server_address
+    queries = []
+    register_client = DetectionClient(host, port)
+    register_times = []
+    for support_images, _, support_labels, query_images, _, query_labels, _ in val_loader:
+        for task_idx in range(support_images.size(0)):
+            context = "task_{}".format(len(register_times))
+            before_time = time.time()
+            register_client.register(context, support_images[task_idx].numpy(), support_labels[task_idx].numpy())
+            register_times.append(time.time() - before_time)
+            queries.extend((context, image, label) for image, label in zip(query_images[task_idx].numpy(),
+                                                                          query_labels[task_idx].numpy()))
+            if len(register_times) >= num_contexts:
+                break
+        if len(register_times) >= num_contexts:
+            break
+    register_client.close()
+    np.random.shuffle(queries)  # contexts are interleaved, as in deployment
+
+    def send(client_idx):
+        client = DetectionClient(host, port)
+        latencies, correct = [], 0
+        for context, image, label in queries[client_idx::num_clients]:
+            before_time = time.time()
+            result = client.detect(context, image)
+            latencies.append(time.time() - before_time)
+            correct += int(int(not result["is_adversarial"]) == label)
+        client.close()
+        return latencies, correct
+
+    server.reset_stats()
+    before_time = time.time()
+    with ThreadPoolExecutor(max_workers=num_clients) as pool:
+        client_results = list(pool.map(send, range(num_clients)))
+    elapse = time.time() - before_time
+    latencies = np.concatenate([latencies for latencies, _ in client_results]) * 1000
+    result_json = {"device": device_name(), "num_contexts": len(register_times), "num_clients": num_clients,
+                   "max_batch_size": args.max_batch_size, "max_latency_ms": args.max_latency_ms,
+                   "register_mean_ms": float(np.mean(register_times) * 1000),
+                   "client_p50_ms": float(np.percentile(latencies, 50)),
+                   "client_p99_ms": float(np.percentile(latencies, 99)),
+                   "images_per_sec": len(latencies) / elapse,
+                   "accuracy": sum(correct for _, correct in client_results) / len(latencies),
+                   "server": server.stats()}
+    httpd.shutdown()
+    server.stop()
+    print(result_json)
+    os.makedirs("{}/train_pytorch_model/speed_test".format(PY_ROOT), exist_ok=True)
+    file_name = "{}/train_pytorch_model/speed_test/serving_benchmark_{}.json".format(PY_ROOT, device_name())
+    with open(file_name, "w") as file_obj:
+        file_obj.write(json.dumps(result_json))
+        file_obj.flush()
+    return result_json
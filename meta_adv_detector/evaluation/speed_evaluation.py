@@ -3,67 +3,38 @@ import re
 from collections import defaultdict
 
 import glob
-import time
-from collections import defaultdict
-import copy
 import json
 import torch
-import numpy as np
-from torch.optim import SGD
 
 from config import PY_ROOT
+from evaluation_toolkit.adaptation_engine import AdaptationEngine
+from evaluation_toolkit.adapted_cache import build_adapted_cache
 from dataset.protocol_enum import SPLIT_DATA_PROTOCOL, LOAD_TASK_MODE
 from evaluation_toolkit.evaluation import finetune_eval_task_accuracy
-from meta_adv_detector.meta_adv_det import MetaLearner, forward_pass, evaluate_two_way
+from meta_adv_detector.meta_adv_det import MetaLearner
+from toolkit.device import to_device, device_name
 
 
-def speed_test(network, val_loader, inner_lr, num_updates, update_BN=True):
-    # test_net = copy.deepcopy(network)
+def speed_test(network, val_loader, inner_lr, num_updates, update_BN=True, cache=None):
     # Select ten tasks randomly from the test set to evaluate_accuracy on
-    test_net = copy.deepcopy(network)
-    all_times  = []
+    engine = AdaptationEngine(network, inner_lr, num_updates, update_BN, cache=cache)
     # support_images,support_gt_labels, support_binary_labels, query_images, query_gt_labels, query_binary_labels
     for val_idx, (support_images, _, support_labels, query_images, _, query_labels, positive_labels) in enumerate(val_loader):
         # print("process task {}  task_batch={}".format(val_idx, len(support_images)))
-        support_labels = support_labels.cuda()
-        query_labels = query_labels.cuda()
+        support_labels = to_device(support_labels)
+        query_labels = to_device(query_labels)
         for task_idx in range(support_images.size(0)):
-            # Make a test net with same parameters as our current net
-            test_net = copy.deepcopy(network)
-            test_net.cuda()
-            test_opt = SGD(test_net.parameters(), lr=inner_lr)
-            support_task, support_target = support_images[task_idx], support_labels[task_idx]
-            test_net.train()
-
-            before_time = time.time()
-            if not update_BN:
-                for m in test_net.modules():
-                    if isinstance(m, torch.nn.BatchNorm2d):
-                        m.eval()
-            for i in range(num_updates):  # 先fine_tune
-                loss, out = forward_pass(test_net, support_task, support_target)
-                test_opt.zero_grad()
-                loss.backward()
-                test_opt.step()
-            test_net.eval()
-            query_acc, query_F1_score = evaluate_two_way(test_net, query_images[task_idx], query_labels[task_idx])
-            pass_time = time.time() - before_time
-            all_times.append(pass_time)
-            test_net.eval()
-            # Evaluate the trained model on train and val examples
-
-    mean_time_elapse = np.mean(all_times)
-    std_var_time_elapse = np.var(all_times)
-    result_json = {"mean_time":mean_time_elapse, "var_time": std_var_time_elapse}
-
-    del test_net
-    return result_json
+            # time of fine-tuning on the support set and evaluating the query set, measured by the engine
+            engine.evaluate_task(support_images[task_idx], support_labels[task_idx], query_images[task_idx],
+                                 query_labels[task_idx], eval_support=False)
+    return engine.time_stats()
 
 def evaluate_speed(args):
     extract_pattern = re.compile(
         ".*/MAML@(.*?)_(.*?)@model_(.*?)@data.*?@epoch_(\d+)@meta_batch_size_(\d+)@way_(\d+)@shot_(\d+)@num_query_(\d+)@num_updates_(\d+)@lr_(.*?)@inner_lr_(.*?)@fixed_way_(.*?)@rotate_(.*?)\.pth.tar")
     report_result = defaultdict(dict)
     str2bool = lambda v: v.lower() in ("yes", "true", "t", "1")
+    cache = build_adapted_cache(args)  # shared by all models, the key contains the hash of the model weights
     for model_path in glob.glob("{}/train_pytorch_model/cross_adv_group/MAML@*".format(PY_ROOT)):
         if str(args.split_protocol) not in model_path:
             continue
@@ -95,11 +66,11 @@ def evaluate_speed(args):
                               True, "", train=False, adv_arch=args.adv_arch, need_val=True)
 
         learner.network.load_state_dict(checkpoint['state_dict'], strict=True)
-        result_json = speed_test(learner.network, learner.val_loader, inner_lr, args.test_num_updates, update_BN=True)
+        result_json = speed_test(learner.network, learner.val_loader, inner_lr, args.test_num_updates, update_BN=True, cache=cache)
         report_result[dataset][num_support] = result_json
 
     os.makedirs("{}/train_pytorch_model/speed_test".format(PY_ROOT),exist_ok=True)
-    file_name = "{}/train_pytorch_model/speed_test/speed_test_result.json".format(PY_ROOT)
+    file_name = "{}/train_pytorch_model/speed_test/speed_test_result_{}.json".format(PY_ROOT, device_name())
     with open(file_name, "w") as file_obj:
         file_obj.write(json.dumps(report_result))
         file_obj.flush()
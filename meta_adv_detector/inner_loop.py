@@ -1,19 +1,93 @@
 from collections import OrderedDict
 
 from meta_adv_detector.score import *
+from networks.layers import batched_cross_entropy
 from torch import nn
 import torch
 import copy
+from toolkit.device import to_device
+from networks.meta_network import MetaNetwork
+
+# fomaml is the meta-gradient the InnerLoop has always computed: the inner gradients are not differentiated
+META_GRAD_MODES = ["fomaml", "maml", "reptile", "imaml"]
+
+
+def conjugate_gradient(matvec, b, num_steps, eps=1e-10):
+    ''' solve A x = b with A given by matvec, x and b are lists of tensors in the order of the parameters '''
+    x = [torch.zeros_like(t) for t in b]
+    r = [t.clone() for t in b]
+    p = [t.clone() for t in b]
+    rs_old = sum((t * t).sum() for t in r)
+    for _ in range(num_steps):
+        Ap = matvec(p)
+        alpha = rs_old / (sum((p_i * Ap_i).sum() for p_i, Ap_i in zip(p, Ap)) + eps)
+        x = [x_i + alpha * p_i for x_i, p_i in zip(x, p)]
+        r = [r_i - alpha * Ap_i for r_i, Ap_i in zip(r, Ap)]
+        rs_new = sum((t * t).sum() for t in r)
+        if rs_new.item() < eps:
+            break
+        p = [r_i + (rs_new / rs_old) * p_i for r_i, p_i in zip(r, p)]
+        rs_old = rs_new
+    return x
+
+
+def parse_checkpoint_indices(value):
+    ''' "" -> no checkpointing, "all" -> all, "0,2,4" -> [0, 2, 4] '''
+    if not value:
+        return []
+    if value == "all":
+        return "all"
+    return [int(idx) for idx in value.split(",")]
+
+
+class CheckpointedInnerStep(torch.autograd.Function):
+    '''
+    One second-order inner step whose activations are not kept: forward only computes the new fast weights,
+    the meta backward recomputes the step with create_graph and backprops grad_outputs through it.
+    Only the fast weights before the step stay in memory.
+    '''
+
+    @staticmethod
+    def forward(ctx, inner_loop, in_support, target_support, *weights):
+        ctx.inner_loop = inner_loop
+        ctx.save_for_backward(in_support, target_support, *weights)
+        with torch.enable_grad():
+            fast_weights = inner_loop.detached_weights(weights)
+            new_weights = inner_loop.inner_step(in_support, target_support, fast_weights, False,
+                                                inner_loop.checkpoint_blocks)
+        return tuple(weight.detach() for weight in new_weights.values())
+
+    @staticmethod
+    def backward(ctx, *grad_outputs):
+        in_support, target_support, *weights = ctx.saved_tensors
+        with torch.enable_grad():
+            fast_weights = ctx.inner_loop.detached_weights(weights)
+            new_weights = ctx.inner_loop.inner_step(in_support, target_support, fast_weights, True)
+            grads = torch.autograd.grad(list(new_weights.values()), list(fast_weights.values()), grad_outputs)
+        return (None, None, None) + tuple(grads)
+
 
 class InnerLoop(nn.Module):
     '''
     This module performs the inner loop of MAML
     The forward method updates weights with gradient steps on training data, 
     then computes and returns a meta-gradient w.r.t. validation data
+    meta_grad_mode selects how the meta-gradient is computed:
+    fomaml: first-order MAML, the inner gradients are treated as constants
+    maml: second-order MAML, backprop through all the inner steps, memory grows linearly with num_updates
+    reptile: no query loss backprop, the meta-gradient is theta - the weights adapted on support + query set
+    imaml: implicit MAML, the inner steps add imaml_lambda/2 * ||w - theta||^2 to the support loss and
+           the meta-gradient is solved by cg_steps of conjugate gradient, memory does not depend on num_updates
+    Gradient checkpointing, both take a list of indices or "all":
+    checkpoint_steps: the maml inner steps which are recomputed in the meta backward instead of keeping their graph
+    checkpoint_blocks: the FunctionalGraph blocks of MetaNetwork whose activations are recomputed in the backward of
+                       the forwards that are differentiated only once
     '''
 
-    def __init__(self, network, num_updates, step_size, meta_batch_size):
+    def __init__(self, network, num_updates, step_size, meta_batch_size, meta_grad_mode="fomaml", imaml_lambda=2.0,
+                 cg_steps=5, checkpoint_steps=None, checkpoint_blocks=None):
         super(InnerLoop, self).__init__()
+        assert meta_grad_mode in META_GRAD_MODES, "unknown meta_grad_mode {}".format(meta_grad_mode)
         self.network = copy.deepcopy(network)
         # Number of updates to be taken
         self.num_updates = num_updates
@@ -22,42 +96,146 @@ class InnerLoop(nn.Module):
         self.loss_fn = nn.CrossEntropyLoss()
         # for loss normalization 
         self.meta_batch_size = meta_batch_size
+        self.meta_grad_mode = meta_grad_mode
+        self.imaml_lambda = imaml_lambda
+        self.cg_steps = cg_steps
+        if checkpoint_steps == "all":
+            checkpoint_steps = range(num_updates)
+        self.checkpoint_steps = frozenset(checkpoint_steps or [])
+        assert not checkpoint_blocks or isinstance(self.network, MetaNetwork), "only MetaNetwork has blocks"
+        if checkpoint_blocks == "all":
+            checkpoint_blocks = range(len(self.network.functional_graph.blocks))
+        self.checkpoint_blocks = frozenset(checkpoint_blocks or [])
 
     def copy_weights(self, net):
         ''' Set this module's weights to be the same as those of 'net' '''
         self.network.copy_weights(net)
 
-    def net_forward(self, x, weights=None):
+    def net_forward(self, x, weights=None, checkpoint_blocks=()):
+        if checkpoint_blocks:
+            return self.network.net_forward(x, weights, checkpoint_blocks)
         return self.network.net_forward(x, weights)
 
-    def forward_pass(self, in_, target, weights=None):
+    def forward_pass(self, in_, target, weights=None, checkpoint_blocks=()):
         ''' Run data through net, return loss and output '''
-        input_var = in_.cuda()
-        target_var = target.cuda()
+        input_var = to_device(in_)
+        target_var = to_device(target)
         # Run the batch through the net, compute loss
-        out = self.net_forward(input_var, weights)
+        out = self.net_forward(input_var, weights, checkpoint_blocks)
         loss = self.loss_fn(out, target_var)
         return loss, out
-    
-    def forward(self, in_support, in_query, target_support, target_query):
-        in_support, in_query, target_support, target_query = in_support.detach(), in_query.detach(), target_support.detach(), target_query.detach()
-        ##### Test net before training, should be random accuracy ####
+
+    def named_meta_grads(self, grads):
+        return {name:g for ((name, _), g) in zip(self.named_parameters(), grads)}
+
+    def detached_weights(self, weights):
+        names = [name for (name, _) in self.network.named_parameters()]
+        return OrderedDict((name, weight.detach().requires_grad_()) for (name, weight) in zip(names, weights))
+
+    def inner_step(self, in_support, target_support, fast_weights, create_graph, checkpoint_blocks=()):
+        loss, _ = self.forward_pass(in_support, target_support, fast_weights, checkpoint_blocks)
+        grads = torch.autograd.grad(loss, fast_weights.values(), create_graph=create_graph)
+        return OrderedDict((name, param - self.step_size*grad) for ((name, param), grad) in zip(fast_weights.items(), grads))
+
+    def adapt(self, in_support, target_support, create_graph=False):
+        ''' the fast weights after num_updates steps, they are differentiable w.r.t. the parameters '''
         fast_weights = OrderedDict((name, param) for (name, param) in self.network.named_parameters())
+        # recomputing blocks does not save memory when the inner graph is kept for the second-order backward
+        checkpoint_blocks = () if create_graph else self.checkpoint_blocks
         for i in range(self.num_updates):
-            if i==0:
+            if create_graph and i in self.checkpoint_steps:
+                new_weights = CheckpointedInnerStep.apply(self, in_support, target_support, *fast_weights.values())
+                fast_weights = OrderedDict(zip(fast_weights.keys(), new_weights))
+            elif i==0 and not checkpoint_blocks:
                 loss, _ = self.forward_pass(in_support, target_support)
-                grads = torch.autograd.grad(loss, self.parameters() )
+                grads = torch.autograd.grad(loss, self.parameters(), create_graph=create_graph)
+                fast_weights = OrderedDict((name, param - self.step_size*grad) for ((name, param), grad) in zip(fast_weights.items(), grads))
             else:
-                loss, _ = self.forward_pass(in_support, target_support, fast_weights)
-                grads = torch.autograd.grad(loss, fast_weights.values())
-            fast_weights = OrderedDict((name, param - self.step_size*grad) for ((name, param), grad) in zip(fast_weights.items(), grads))
+                fast_weights = self.inner_step(in_support, target_support, fast_weights, create_graph, checkpoint_blocks)
+        return fast_weights
+
+    def adapt_detached(self, in_, target, prox_lambda=0.0):
+        ''' num_updates steps without any graph back to the parameters, prox_lambda > 0 adds the iMAML proximal term '''
+        theta = OrderedDict((name, param.detach()) for (name, param) in self.network.named_parameters())
+        fast_weights = OrderedDict((name, param.clone().requires_grad_()) for (name, param) in theta.items())
+        for _ in range(self.num_updates):
+            loss, _ = self.forward_pass(in_, target, fast_weights, self.checkpoint_blocks)
+            grads = torch.autograd.grad(loss, fast_weights.values())
+            with torch.no_grad():
+                fast_weights = OrderedDict(
+                    (name, (param - self.step_size * (grad + prox_lambda * (param - theta[name]))).requires_grad_())
+                    for ((name, param), grad) in zip(fast_weights.items(), grads))
+        return theta, fast_weights
+
+    def reptile_meta_grads(self, in_support, in_query, target_support, target_query):
+        theta, fast_weights = self.adapt_detached(torch.cat([in_support, in_query]),
+                                                  torch.cat([target_support, target_query]))
+        return [(theta[name] - fast_weights[name].detach()) / self.meta_batch_size for name in theta.keys()]
+
+    def imaml_meta_grads(self, in_support, in_query, target_support, target_query):
+        _, fast_weights = self.adapt_detached(in_support, target_support, self.imaml_lambda)
+        weights = list(fast_weights.values())
+        loss, _ = self.forward_pass(in_query, target_query, fast_weights, self.checkpoint_blocks)
+        query_grads = torch.autograd.grad(loss / self.meta_batch_size, weights)
+        loss, _ = self.forward_pass(in_support, target_support, fast_weights)
+        support_grads = torch.autograd.grad(loss, weights, create_graph=True)
+
+        def matvec(vectors):
+            ''' (I + H / imaml_lambda) v, H is the Hessian of the support loss at the adapted weights '''
+            hessian_vectors = torch.autograd.grad(support_grads, weights, vectors, retain_graph=True)
+            return [v + hv / self.imaml_lambda for v, hv in zip(vectors, hessian_vectors)]
+        return [grad.detach() for grad in conjugate_gradient(matvec, query_grads, self.cg_steps)]
+
+    def forward(self, in_support, in_query, target_support, target_query):
+        in_support, in_query, target_support, target_query = in_support.detach(), in_query.detach(), target_support.detach(), target_query.detach()
+        if self.meta_grad_mode == "reptile":
+            return self.named_meta_grads(self.reptile_meta_grads(in_support, in_query, target_support, target_query))
+        if self.meta_grad_mode == "imaml":
+            return self.named_meta_grads(self.imaml_meta_grads(in_support, in_query, target_support, target_query))
+        ##### Test net before training, should be random accuracy ####
+        fast_weights = self.adapt(in_support, target_support, create_graph=self.meta_grad_mode == "maml")
         ##### Test net after training, should be better than random ####
         # tr_post_loss, tr_post_acc, tr_post_two_acc = evaluate_accuracy(self, in_support, target_support,positive_label, weights=fast_weights)
         # val_post_loss, val_post_acc, val_post_two_acc = evaluate_accuracy(self, in_query, target_query,positive_label, weights=fast_weights)
         # Compute the meta gradient and return it
-        loss, _ = self.forward_pass(in_query, target_query, fast_weights)   #
+        loss, _ = self.forward_pass(in_query, target_query, fast_weights, self.checkpoint_blocks)   #
         loss = loss / self.meta_batch_size # normalize loss
         grads = torch.autograd.grad(loss, self.parameters())
-        meta_grads = {name:g for ((name, _), g) in zip(self.named_parameters(), grads)}
-        return meta_grads
+        return self.named_meta_grads(grads)
+
+
+class BatchedInnerLoop(InnerLoop):
+    '''
+    This module performs the inner loop of MAML for all the tasks of a meta-batch at once.
+    Each task gets its own slice of the stacked fast weights (T, *param.size()), convolutions become grouped convolutions
+    with one group per task, so that one forward/backward adapts the whole meta-batch.
+    The forward method returns the meta-gradient already summed over the tasks,
+    which is the same as summing the meta-gradients that InnerLoop returns task by task.
+    Only the fomaml and maml meta_grad_mode are batched.
+    '''
+
+    def __init__(self, network, num_updates, step_size, meta_batch_size, meta_grad_mode="fomaml", **kwargs):
+        assert meta_grad_mode in ["fomaml", "maml"], "BatchedInnerLoop does not support {}".format(meta_grad_mode)
+        super(BatchedInnerLoop, self).__init__(network, num_updates, step_size, meta_batch_size, meta_grad_mode, **kwargs)
+        assert not self.checkpoint_steps and not self.checkpoint_blocks, "BatchedInnerLoop does not support checkpointing"
 
+    def batched_forward_pass(self, in_, target, weights):
+        ''' in_: T, N, D, target: T, N, return the sum of each task's loss '''
+        out = self.network.batched_net_forward(to_device(in_), weights)
+        loss = batched_cross_entropy(out, to_device(target))
+        return loss, out
+
+    def forward(self, in_support, in_query, target_support, target_query):
+        in_support, in_query, target_support, target_query = in_support.detach(), in_query.detach(), target_support.detach(), target_query.detach()
+        num_tasks = in_support.size(0)
+        # expand does not copy, the gradient flowing back to each parameter is the sum over tasks
+        fast_weights = OrderedDict((name, param.unsqueeze(0).expand(num_tasks, *param.size()))
+                                   for (name, param) in self.network.named_parameters())
+        for i in range(self.num_updates):
+            loss, _ = self.batched_forward_pass(in_support, target_support, fast_weights)
+            grads = torch.autograd.grad(loss, fast_weights.values(), create_graph=self.meta_grad_mode == "maml")
+            fast_weights = OrderedDict((name, param - self.step_size*grad) for ((name, param), grad) in zip(fast_weights.items(), grads))
+        loss, _ = self.batched_forward_pass(in_query, target_query, fast_weights)
+        loss = loss / self.meta_batch_size # normalize loss
+        grads = torch.autograd.grad(loss, self.parameters())
+        return self.named_meta_grads(grads)
@@ -8,15 +8,20 @@ from networks.conv3 import Conv3
 
 import os
 import copy
+import time
 from config import PY_ROOT, IN_CHANNELS, IMAGE_SIZE
 from torch.optim import Adam,SGD
 from torch.utils.data import DataLoader
-from meta_adv_detector.inner_loop import InnerLoop
+from meta_adv_detector.inner_loop import InnerLoop, BatchedInnerLoop
 from dataset.meta_task_dataset import MetaTaskDataset
 from networks.resnet import resnet10, resnet18
 from meta_adv_detector.score import *
 
 from meta_adv_detector.tensorboard_helper import TensorBoardWriter
+from meta_adv_detector.distributed import is_distributed, get_rank, get_world_size, all_reduce_flat_grad, broadcast_network
+from meta_adv_detector.meta_grad import MetaGradAccumulator
+from torch.utils.data.distributed import DistributedSampler
+from toolkit.device import to_device, module_to_device, reset_peak_memory, peak_memory_mb
 
 
 class MetaLearner(object):
@@ -29,7 +34,9 @@ class MetaLearner(object):
                  epoch,
                  num_inner_updates, load_task_mode, protocol, arch,
                  tot_num_tasks, num_support, num_query, no_random_way,
-                 tensorboard_data_prefix, train=True, adv_arch="conv4", need_val=False):
+                 tensorboard_data_prefix, train=True, adv_arch="conv4", need_val=False, use_task_pack=False,
+                 batched_inner_loop=False, num_sample_workers=1, meta_grad_mode="fomaml", imaml_lambda=2.0,
+                 imaml_cg_steps=5, checkpoint_steps=None, checkpoint_blocks=None):
         super(self.__class__, self).__init__()
         self.dataset = dataset
         self.num_classes = num_classes
@@ -52,54 +59,58 @@ class MetaLearner(object):
                                   IN_CHANNELS[self.dataset], IMAGE_SIZE[self.dataset])
 
         self.network = network
-        self.network.cuda()
+        module_to_device(self.network)
         if train:
             trn_dataset = MetaTaskDataset(tot_num_tasks, num_classes, num_support, num_query,
                                           dataset, is_train=True, load_mode=load_task_mode,
                                           protocol=protocol,
-                                          no_random_way=no_random_way, adv_arch=adv_arch, fetch_attack_name=False)
+                                          no_random_way=no_random_way, adv_arch=adv_arch, fetch_attack_name=False,
+                                          use_task_pack=use_task_pack, num_sample_workers=num_sample_workers)
             # task number per mini-batch is controlled by DataLoader
-            self.train_loader = DataLoader(trn_dataset, batch_size=meta_batch_size, shuffle=True, num_workers=4, pin_memory=True)
-            self.tensorboard = TensorBoardWriter("{0}/pytorch_MAML_tensorboard".format(PY_ROOT),
-                                                 tensorboard_data_prefix)
-            os.makedirs("{0}/pytorch_MAML_tensorboard".format(PY_ROOT), exist_ok=True)
+            if is_distributed():  # each process gets its shard of every meta-batch
+                assert meta_batch_size % get_world_size() == 0, "meta_batch_size must be divisible by the world size"
+                self.train_sampler = DistributedSampler(trn_dataset, shuffle=True)
+                self.train_loader = DataLoader(trn_dataset, batch_size=meta_batch_size // get_world_size(),
+                                               sampler=self.train_sampler, num_workers=4, pin_memory=True)
+            else:
+                self.train_sampler = None
+                self.train_loader = DataLoader(trn_dataset, batch_size=meta_batch_size, shuffle=True, num_workers=4, pin_memory=True)
+            self.tensorboard = None
+            if get_rank() == 0:
+                self.tensorboard = TensorBoardWriter("{0}/pytorch_MAML_tensorboard".format(PY_ROOT),
+                                                     tensorboard_data_prefix)
+                os.makedirs("{0}/pytorch_MAML_tensorboard".format(PY_ROOT), exist_ok=True)
         if need_val:
             val_dataset = MetaTaskDataset(tot_num_tasks, num_classes, num_support, 15,
                                           dataset, is_train=False, load_mode=load_task_mode,
                                           protocol=protocol,
-                                          no_random_way=True, adv_arch=adv_arch, fetch_attack_name=False)
+                                          no_random_way=True, adv_arch=adv_arch, fetch_attack_name=False,
+                                          use_task_pack=use_task_pack, num_sample_workers=num_sample_workers)
             self.val_loader = DataLoader(val_dataset, batch_size=100, shuffle=False, num_workers=4, pin_memory=True) # 固定100个task，分别测每个task的准确率
-        self.fast_net = InnerLoop(self.network, self.num_inner_updates,
-                                  self.inner_step_size, self.meta_batch_size)  # 并行执行每个task
-        self.fast_net.cuda()
+        self.batched_inner_loop = batched_inner_loop
+        self.meta_grad_mode = meta_grad_mode
+        if batched_inner_loop:  # adapt all tasks of a meta-batch in one forward/backward
+            self.fast_net = BatchedInnerLoop(self.network, self.num_inner_updates,
+                                             self.inner_step_size, self.meta_batch_size, meta_grad_mode)
+        else:
+            self.fast_net = InnerLoop(self.network, self.num_inner_updates,
+                                      self.inner_step_size, self.meta_batch_size, meta_grad_mode,
+                                      imaml_lambda, imaml_cg_steps, checkpoint_steps,
+                                      checkpoint_blocks)  # 并行执行每个task
+        module_to_device(self.fast_net)
         self.opt = Adam(self.network.parameters(), lr=meta_step_size)
+        # the keys of the meta-gradients of fast_net are prefixed with "network."
+        self.meta_grad = MetaGradAccumulator(("network." + name, param) for name, param in self.network.named_parameters())
 
 
 
-    def meta_update(self, grads, query_images, query_labels):
-        in_, target = query_images[0], query_labels[0]
-        # We use a dummy forward / backward pass to get the correct grads into self.net
-        loss, out = forward_pass(self.network, in_, target)  # 其实传谁无所谓，因为loss.backward调用的时候，会用外部更新的梯度的求和来替换掉loss.backward自己算出来的梯度值
-        # Unpack the list of grad dicts
-        gradients = {k[len("network."):]: sum(d[k] for d in grads) for k in grads[0].keys()}  # 把N个task的grad加起来
-        # Register a hook on each parameter in the net that replaces the current dummy grad
-        # with our grads accumulated across the meta-batch
-        hooks = []
-        for (k,v) in self.network.named_parameters():
-            def get_closure():
-                key = k
-                def replace_grad(grad):
-                    return gradients[key]
-                return replace_grad
-            hooks.append(v.register_hook(get_closure()))
-        # Compute grads for current step, replace with summed gradients as defined by hook
-        self.opt.zero_grad()  # 清空梯度
-        loss.backward()  # 当这句话调用的时候，hook执行
-        # Update the net parameters with the accumulated gradient according to optimizer
+    def meta_update(self, query_images):
+        ''' step the meta optimizer with the meta-gradients accumulated in self.meta_grad '''
+        with torch.no_grad():  # 以前的dummy forward也会更新self.network的BN running statistics, 保留这一点, 但不需要backward
+            self.network.net_forward(query_images[0])
+        all_reduce_flat_grad(self.meta_grad.flat_grad)  # 分布式训练时再把所有进程的grad加起来
+        self.meta_grad.write_grads()  # .grad是累加buffer的view, 不需要dummy forward/backward和hook
         self.opt.step()
-        # Remove the hooks before next training phase
-        for h in hooks:
-            h.remove()
 
 
     def test_zero_shot_with_finetune_trainset(self):
@@ -112,7 +123,7 @@ class MetaLearner(object):
             for task_idx in range(query_images.size(0)):  # 选择100个task
                 # Make a test net with same parameters as our current net
                 test_net.copy_weights(self.network)
-                test_net.cuda()
+                module_to_device(test_net)
                 test_net.train()
                 current_fine_tune_idx = 0
                 for m in test_net.modules():
@@ -120,8 +131,8 @@ class MetaLearner(object):
                         m.eval()
                 test_opt = SGD(test_net.parameters(), lr=self.inner_step_size)
                 for _, _, _, task_test_img, _, test_adv_labels, _ in self.train_loader:
-                    task_test_img = task_test_img.cuda()
-                    test_adv_labels = test_adv_labels.cuda()
+                    task_test_img = to_device(task_test_img)
+                    test_adv_labels = to_device(test_adv_labels)
                     for inner_idx in range(task_test_img.size(0)):
                         finetune_img = task_test_img[inner_idx]
                         finetune_target = test_adv_labels[inner_idx]
@@ -154,38 +165,58 @@ class MetaLearner(object):
     def train(self, model_path, resume_epoch=0, need_val=False):
         # mtr_loss, mtr_acc, mval_loss, mval_acc = [], [], [], []
 
+        broadcast_network(self.network)
+        rank = get_rank()
         for epoch in range(resume_epoch, self.epoch):
             # Evaluate on test tasks
             # Collect a meta batch update
             # Save a model snapshot every now and then
-
+            if self.train_sampler is not None:
+                self.train_sampler.set_epoch(epoch)
+            start_time = time.time()
+            num_tasks = 0
+            reset_peak_memory()
             for i, (support_images, _, support_labels, query_images, _, query_labels, *_) in enumerate(self.train_loader):
                 itr = epoch * len(self.train_loader) + i
                 self.adjust_learning_rate(itr, self.meta_step_size, self.lr_decay_itr)
-                grads = []
-                support_images, support_labels, query_images, query_labels = support_images.cuda(), support_labels.cuda(), query_images.cuda(), query_labels.cuda()
-                for task_idx in range(support_images.size(0)):
+                self.meta_grad.zero()
+                num_tasks += support_images.size(0)
+                support_images, support_labels, query_images, query_labels = to_device(support_images), to_device(support_labels), to_device(query_images), to_device(query_labels)
+                if self.batched_inner_loop:
                     self.fast_net.copy_weights(self.network)
-                    # fast_net only forward one task's data
-                    g = self.fast_net.forward(support_images[task_idx],query_images[task_idx], support_labels[task_idx], query_labels[task_idx])
-                    # (trl, tra, vall, vala) = metrics
-                    grads.append(g)
+                    # the whole meta-batch is adapted at once, g is already summed over the tasks
+                    g = self.fast_net.forward(support_images, query_images, support_labels, query_labels)
+                    self.meta_grad.add(g)
+                else:
+                    for task_idx in range(support_images.size(0)):
+                        self.fast_net.copy_weights(self.network)
+                        # fast_net only forward one task's data
+                        g = self.fast_net.forward(support_images[task_idx],query_images[task_idx], support_labels[task_idx], query_labels[task_idx])
+                        # (trl, tra, vall, vala) = metrics
+                        self.meta_grad.add(g)  # 每个task结束就累加, 不再保存N个task的grad dict
 
                 # Perform the meta update
                 # print('Meta update', itr)
-                self.meta_update(grads, query_images, query_labels)
-                grads.clear()
-                if itr % 1000 == 0 and need_val:
+                self.meta_update(query_images)
+                if (i + 1) % 100 == 0:
+                    itr_per_sec = (i + 1) / (time.time() - start_time)
+                    print("rank {} epoch {} iteration {}: {:.3f} it/s, {:.1f} tasks/s, {} {:.1f} ms/step, peak memory {:.0f}MB".format(
+                        rank, epoch, i + 1, itr_per_sec, num_tasks / (time.time() - start_time), self.meta_grad_mode,
+                        1000 / itr_per_sec, peak_memory_mb()))
+                    if self.tensorboard is not None:
+                        self.tensorboard.record_trn_itr_per_sec(itr_per_sec, itr)
+                if itr % 1000 == 0 and need_val and rank == 0:
                     result_json = finetune_eval_task_accuracy(self.network, self.val_loader, self.inner_step_size,
                                                 self.test_finetune_updates, update_BN=True)
                     query_F1_tensor = torch.Tensor(1)
                     query_F1_tensor.fill_(result_json["query_F1"])
                     self.tensorboard.record_val_query_F1(query_F1_tensor, itr)
-            torch.save({
-                'epoch': epoch + 1,
-                'state_dict': self.network.state_dict(),
-                'optimizer': self.opt.state_dict(),
-            }, model_path)
+            if rank == 0:  # 所有进程的参数相同, 只由rank 0保存
+                torch.save({
+                    'epoch': epoch + 1,
+                    'state_dict': self.network.state_dict(),
+                    'optimizer': self.opt.state_dict(),
+                }, model_path)
 
 
     def adjust_learning_rate(self,itr, meta_lr, lr_decay_itr):
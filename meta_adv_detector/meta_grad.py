@@ -0,0 +1,40 @@
+import torch
+
+
+class MetaGradAccumulator(object):
+    '''
+    Accumulates the meta-gradients of the tasks of a meta-batch into one preallocated flat buffer.
+    Each parameter's .grad is a view of the buffer, so after the tasks are added the optimizer can step directly,
+    without a dummy forward/backward to fire grad-replacing hooks and without a list of per-task grad dicts.
+    The flat buffer is also what the distributed meta-training all-reduces.
+    '''
+
+    def __init__(self, named_parameters):
+        named_parameters = list(named_parameters)
+        self.names = [name for name, _ in named_parameters]
+        self.params = [param for _, param in named_parameters]
+        self.flat_grad = torch.zeros(sum(param.numel() for param in self.params), dtype=self.params[0].dtype,
+                                     device=self.params[0].device)
+        self.grad_views = []
+        offset = 0
+        for param in self.params:
+            self.grad_views.append(self.flat_grad[offset: offset + param.numel()].view_as(param))
+            offset += param.numel()
+        self.name_to_view = dict(zip(self.names, self.grad_views))
+
+    def zero(self):
+        self.flat_grad.zero_()
+
+    def add(self, meta_grads):
+        ''' meta_grads: dict of parameter name -> grad, e.g. returned by InnerLoop.forward '''
+        for name, grad in meta_grads.items():
+            self.name_to_view[name].add_(grad)
+
+    def add_list(self, grads):
+        ''' grads: grads in the same order as the parameters, e.g. returned by torch.autograd.grad '''
+        for grad_view, grad in zip(self.grad_views, grads):
+            grad_view.add_(grad)
+
+    def write_grads(self):
+        for param, grad_view in zip(self.params, self.grad_views):
+            param.grad = grad_view
@@ -2,6 +2,7 @@ import numpy as np
 from sklearn.metrics import accuracy_score
 import torch
 from sklearn.metrics import f1_score
+from toolkit.device import to_device, autocast
 '''
 Helper methods for evaluating a classification network
 '''
@@ -24,37 +25,37 @@ def count_correct(pred, target):
 
 def forward_pass(net, in_, target, weights=None):
     ''' forward in_ through the net, return loss and output '''
-    input_var = in_.cuda()
-    target_var = target.cuda()
+    input_var = to_device(in_)
+    target_var = to_device(target)
     out = net.net_forward(input_var, weights)
     loss = net.loss_fn(out, target_var)
     return loss, out
 
 def forward_pass_rotate_random_angle(net, in_, target):
     ''' forward in_ through the net, return loss and output '''
-    input_var = in_.cuda()
-    target_var = target.cuda()
+    input_var = to_device(in_)
+    target_var = to_device(target)
     out = net.net_forward(input_var, True)
     loss = net.loss_fn(out, target_var)
     return loss, out
 
 def evaluate_two_way_random_angle(net, x, target):
-    x = x.cuda()
-    target = target.cuda()
-    with torch.no_grad():
+    x = to_device(x)
+    target = to_device(target)
+    with torch.no_grad(), autocast():
         _, out = forward_pass_rotate_random_angle(net, x, target)
-    predict = np.argmax(out.detach().cpu().numpy(), axis=1)
+    predict = np.argmax(out.detach().float().cpu().numpy(), axis=1)
     target = target.detach().cpu().numpy()
     F1 = f1_score(target, predict)
     accuracy = accuracy_score(target, predict)
     return accuracy, F1
 
 def evaluate_two_way(net, x, target):
-    x = x.cuda()
-    target = target.cuda()
-    with torch.no_grad():
+    x = to_device(x)
+    target = to_device(target)
+    with torch.no_grad(), autocast():
         loss, out = forward_pass(net, x, target)
-    predict = np.argmax(out.detach().cpu().numpy(), axis=1)
+    predict = np.argmax(out.detach().float().cpu().numpy(), axis=1)
     target = target.detach().cpu().numpy()
     F1 = f1_score(target, predict)
     accuracy = accuracy_score(target, predict)
@@ -66,8 +67,8 @@ def evaluate_two_way(net, x, target):
 
 def evaluate(net, in_, target_Nway, target_positive, weights=None, use_positive_position=True):
     # in_ is one task's 5-way k-shot data, in_ is either support data or query data
-    in_ = in_.cuda()
-    target_Nway = target_Nway.cuda()
+    in_ = to_device(in_)
+    target_Nway = to_device(target_Nway)
     l, out = forward_pass(net, in_, target_Nway, weights)
     predict = np.argmax(out.detach().cpu().numpy(), axis=1)
     Nway_labels = target_Nway.detach().cpu().numpy()
@@ -78,8 +79,8 @@ def evaluate(net, in_, target_Nway, target_positive, weights=None, use_positive_
     return two_way_accuracy, F1
 
 def get_net_predict(net, input):
-    input = input.cuda()
-    with torch.no_grad():
+    input = to_device(input)
+    with torch.no_grad(), autocast():
         out = net.net_forward(input)
-        predict = np.argmax(out.detach().cpu().numpy(), axis=1)
+        predict = np.argmax(out.detach().float().cpu().numpy(), axis=1)
     return predict
@@ -44,6 +44,9 @@ class TensorBoardWriter(object):
     def record_trn_query_twoway_acc(self, tensor, iter:int):
         self.writer.add_scalar("{}/trn_query_2way_acc".format(self.data_prefix), tensor, iter)
 
+    def record_trn_itr_per_sec(self, value, iter:int):
+        self.writer.add_scalar("{}/trn_itr_per_sec".format(self.data_prefix), value, iter)
+
     def export_json(self):
         self.writer.export_scalars_to_json(self.export_json_path)
 
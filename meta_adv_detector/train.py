@@ -14,6 +14,14 @@ import numpy as np
 from meta_adv_detector.meta_adv_det import MetaLearner
 import torch
 from meta_adv_detector.evaluation.speed_evaluation import evaluate_speed
+from meta_adv_detector.evaluation.inner_loop_benchmark import benchmark_batched_inner_loop
+from meta_adv_detector.evaluation.functional_forward_benchmark import benchmark_functional_forward
+from meta_adv_detector.evaluation.meta_grad_mode_benchmark import benchmark_meta_grad_modes
+from meta_adv_detector.evaluation.checkpoint_benchmark import benchmark_inner_loop_checkpointing
+from meta_adv_detector.inner_loop import META_GRAD_MODES, parse_checkpoint_indices
+from meta_adv_detector.evaluation.serving_benchmark import run_detection_server, benchmark_detection_server
+from meta_adv_detector.distributed import init_distributed, barrier, destroy_distributed
+from toolkit.device import add_device_args, set_device_by_args
 
 def parse_args():
     parser = argparse.ArgumentParser(description='PyTorch Meta_SGD Training')
@@ -47,6 +55,26 @@ def parse_args():
     parser.add_argument("--cross_arch_source", type=str, help="the source arch to evaluate_accuracy")
     parser.add_argument("--cross_arch_target", type=str, help="the target arch to evaluate_accuracy")
     parser.add_argument("--evaluate", action="store_true")
+    parser.add_argument("--batched_inner_loop", action="store_true", help="adapt all tasks of a meta-batch at once with grouped convolutions")
+    parser.add_argument("--meta_grad_mode", type=str, default="fomaml", choices=META_GRAD_MODES,
+                        help="fomaml: first-order MAML (the former behaviour), maml: second-order MAML, reptile: Reptile, imaml: implicit MAML")
+    parser.add_argument("--imaml_lambda", type=float, default=2.0, help="strength of the proximal term of imaml")
+    parser.add_argument("--imaml_cg_steps", type=int, default=5, help="conjugate gradient steps of imaml")
+    parser.add_argument("--checkpoint_steps", type=str, default="", help='"all" or comma separated inner steps whose graph is recomputed in the meta backward (maml mode)')
+    parser.add_argument("--checkpoint_blocks", type=str, default="", help='"all" or comma separated blocks of the network whose activations are recomputed in backward')
+    parser.add_argument("--task_pack", action="store_true", help="pack all tasks into one memory-mapped file and read tasks from it")
+    parser.add_argument("--sample_workers", type=int, default=1, help="processes to sample the tasks in NO_LOAD mode")
+    parser.add_argument("--world_size", type=int, default=1, help="processes of distributed meta-training, each one gets meta_batch_size/world_size tasks")
+    parser.add_argument("--dist_backend", type=str, default="gloo", choices=["gloo", "nccl"], help="backend of distributed meta-training")
+    parser.add_argument("--dist_url", type=str, default="tcp://127.0.0.1:23456", help="init method of distributed meta-training")
+    parser.add_argument("--model_path", type=str, default=None, help="checkpoint of the detector to serve")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="host of the detection server")
+    parser.add_argument("--port", type=int, default=8900, help="port of the detection server")
+    parser.add_argument("--max_batch_size", type=int, default=64, help="max images of one micro-batch of the detection server")
+    parser.add_argument("--max_latency_ms", type=float, default=5.0, help="max waiting time of an image before its micro-batch runs")
+    parser.add_argument("--adapted_cache_mb", type=int, default=0, help="memory budget(MB) of the cache of adapted detector weights, 0 means no cache")
+    parser.add_argument("--adapted_cache_dir", type=str, default=None, help="evicted adapted weights are spilled to this dir")
+    add_device_args(parser)
 
     ## Logging, saving, and testing options
     args = parser.parse_args()
@@ -55,6 +83,44 @@ def parse_args():
     print("using GPU :{}".format(args.gpu))
     return args
 
+def main_train_worker(rank, args, model_path, param_prefix):
+    load_task_mode = args.load_task_mode
+    set_device_by_args(args)  # the same device setup for every rank and every world_size
+    if args.world_size > 1:
+        init_distributed(args.dist_backend, args.dist_url, args.world_size, rank)
+        if rank != 0:  # rank 0 samples or packs the tasks first, the other ranks load them
+            barrier()
+            load_task_mode = LOAD_TASK_MODE.LOAD
+    class_number = args.num_classes
+    if args.no_random_way:
+        class_number = 2
+    learner = MetaLearner(args.dataset, class_number, args.meta_batch_size, args.meta_lr, args.inner_lr, args.lr_decay_itr,
+                          args.epoch, args.num_updates, load_task_mode,
+                          args.split_protocol, args.arch, args.tot_num_tasks, args.num_support, args.num_query,
+                          args.no_random_way,
+                          param_prefix, train=True, adv_arch=args.adv_arch, use_task_pack=args.task_pack,
+                          batched_inner_loop=args.batched_inner_loop, num_sample_workers=args.sample_workers,
+                          meta_grad_mode=args.meta_grad_mode, imaml_lambda=args.imaml_lambda,
+                          imaml_cg_steps=args.imaml_cg_steps,
+                          checkpoint_steps=parse_checkpoint_indices(args.checkpoint_steps),
+                          checkpoint_blocks=parse_checkpoint_indices(args.checkpoint_blocks))
+    if args.world_size > 1 and rank == 0:
+        barrier()
+    # epoch 5-way  k-shot num_updates num_support num_query meta_lr inner_lr
+
+    resume_epoch = 0
+    if os.path.exists(model_path):
+        print("=> loading checkpoint '{}'".format(model_path))
+        checkpoint = torch.load(model_path, map_location=lambda storage, location: storage)
+        resume_epoch = checkpoint['epoch']
+        learner.network.load_state_dict(checkpoint['state_dict'], strict=True)
+        learner.opt.load_state_dict(checkpoint['optimizer'])
+        print("=> loaded checkpoint '{}' (epoch {})"
+              .format(model_path, checkpoint['epoch']))
+    print("after training, model will be stored in {}".format(model_path))
+    learner.train(model_path, resume_epoch, need_val=False)
+    destroy_distributed()
+
 def main():
     args = parse_args()
     random.seed(1337)
@@ -73,29 +139,13 @@ def main():
             args.study_subject,
             param_prefix)
         os.makedirs(os.path.dirname(model_path), exist_ok=True)
-        class_number = args.num_classes
-        if args.no_random_way:
-            class_number = 2
-        learner = MetaLearner(args.dataset, class_number, args.meta_batch_size, args.meta_lr, args.inner_lr, args.lr_decay_itr,
-                              args.epoch, args.num_updates, args.load_task_mode,
-                              args.split_protocol, args.arch, args.tot_num_tasks, args.num_support, args.num_query,
-                              args.no_random_way,
-                              param_prefix, train=True, adv_arch=args.adv_arch)
-        # epoch 5-way  k-shot num_updates num_support num_query meta_lr inner_lr
-
-        resume_epoch = 0
-        if os.path.exists(model_path):
-            print("=> loading checkpoint '{}'".format(model_path))
-            checkpoint = torch.load(model_path)
-            resume_epoch = checkpoint['epoch']
-            learner.network.load_state_dict(checkpoint['state_dict'], strict=True)
-            learner.opt.load_state_dict(checkpoint['optimizer'])
-            print("=> loaded checkpoint '{}' (epoch {})"
-                  .format(model_path, checkpoint['epoch']))
-        print("after training, model will be stored in {}".format(model_path))
-        learner.train(model_path, resume_epoch, need_val=False)
+        if args.world_size > 1:
+            torch.multiprocessing.spawn(main_train_worker, args=(args, model_path, param_prefix), nprocs=args.world_size)
+        else:
+            main_train_worker(0, args, model_path, param_prefix)
     else: # 测试模式
         # MAML@CIFAR-10_TRAIN_I_TEST_II@conv4@epoch_40@meta_batch_size_10@way_2@shot_1@num_query_15@num_updates_2@lr_0.001@inner_lr_0.01.pth.tar
+        set_device_by_args(args)  # every study_subject runs on the device of --device
         if args.study_subject == "cross_domain":
             meta_cross_domain_evaluate(args)
         elif args.study_subject == "cross_arch":
@@ -106,6 +156,18 @@ def main():
             meta_zero_shot_evaluate(args)
         elif args.study_subject == "speed_test":
             evaluate_speed(args)
+        elif args.study_subject == "inner_loop_benchmark":
+            benchmark_batched_inner_loop(args)
+        elif args.study_subject == "functional_forward_benchmark":
+            benchmark_functional_forward(args)
+        elif args.study_subject == "meta_grad_mode_benchmark":
+            benchmark_meta_grad_modes(args)
+        elif args.study_subject == "checkpoint_benchmark":
+            benchmark_inner_loop_checkpointing(args)
+        elif args.study_subject == "detection_server":
+            run_detection_server(args)
+        elif args.study_subject == "serving_benchmark":
+            benchmark_detection_server(args)
         else:
             meta_ablation_study_evaluate(args)
 
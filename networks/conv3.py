@@ -3,6 +3,7 @@ import math
 from collections import OrderedDict
 
 from torch import nn
+from toolkit.device import to_device
 
 
 
@@ -42,7 +43,7 @@ class Conv3(nn.Module):
         x = x.view(-1, self.channels, self.img_size[0], self.img_size[1])
         if weights is None:
             x = self.features(x)
-            x = x.view(x.size(0), -1)
+            x = x.reshape(x.size(0), -1)  # reshape, because x may be channels_last on CPU
             x = self.fc(x)
         else:
             x = conv2d(x, weights['features.conv1.weight'], weights['features.conv1.bias'])
@@ -57,13 +58,27 @@ class Conv3(nn.Module):
             x = batchnorm(x, weight=weights['features.bn3.weight'], bias=weights['features.bn3.bias'], momentum=1)
             x = relu(x)
             x = maxpool(x, kernel_size=2, stride=2)
-            x = x.view(x.size(0), -1)
+            x = x.reshape(x.size(0), -1)
             x = linear(x, weights['fc.weight'], weights['fc.bias'])
         return x
 
     def net_forward(self, x, weights=None):
         return self.forward(x, weights)
 
+    def batched_net_forward(self, x, weights):
+        ''' x: T, N, D, weights: each one is stacked as T, *param.size(), return T, N, num_classes '''
+        num_tasks = x.size(0)
+        x = tasks_to_channels(x, self.channels, self.img_size)
+        for i in range(1, 4):
+            x = batched_conv2d(x, weights['features.conv{}.weight'.format(i)], weights['features.conv{}.bias'.format(i)])
+            x = batched_batchnorm(x, weight=weights['features.bn{}.weight'.format(i)],
+                                  bias=weights['features.bn{}.bias'.format(i)], momentum=1)
+            x = relu(x)
+            x = maxpool(x, kernel_size=2, stride=2)
+        x = x.reshape(x.size(0), -1)
+        x = batched_linear(x, weights['fc.weight'], weights['fc.bias'])
+        return channels_to_tasks(x, num_tasks)
+
     def _init_weights(self):
         ''' Set weights to Gaussian, biases to zero '''
         torch.manual_seed(1337)
@@ -96,8 +111,8 @@ class Conv3(nn.Module):
 
     def forward_pass(self, in_, target, weights=None):
         ''' Run data through net, return loss and output '''
-        input_var = in_.cuda()
-        target_var = target.cuda()
+        input_var = to_device(in_)
+        target_var = to_device(target)
         # Run the batch through the net, compute loss
         out = self.net_forward(input_var, weights)
         loss = self.loss_fn(out, target_var)
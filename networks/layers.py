@@ -11,12 +11,12 @@ than being contained in modules
 
 def linear(input, weight, bias=None):
     if bias is None:
-        return F.linear(input, weight.cuda())
+        return F.linear(input, weight.to(input.device))
     else:
-        return F.linear(input, weight.cuda(), bias.cuda())
+        return F.linear(input, weight.to(input.device), bias.to(input.device))
 
 def conv2d(input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1):
-    return F.conv2d(input, weight.cuda(), bias.cuda(), stride, padding, dilation, groups)
+    return F.conv2d(input, weight.to(input.device), bias.to(input.device), stride, padding, dilation, groups)
 
 def relu(input):
     return F.threshold(input, 0, 0, inplace=True)
@@ -28,8 +28,8 @@ def batchnorm(input, weight=None, bias=None, running_mean=None, running_var=None
     ''' momentum = 1 restricts stats to the current mini-batch '''
     # This hack only works when momentum is 1 and avoids needing to track running stats
     # by substuting dummy variables
-    running_mean = torch.zeros(np.prod(np.array(input.data.size()[1]))).cuda()
-    running_var = torch.ones(np.prod(np.array(input.data.size()[1]))).cuda()
+    running_mean = torch.zeros(np.prod(np.array(input.data.size()[1])), device=input.device)
+    running_var = torch.ones(np.prod(np.array(input.data.size()[1])), device=input.device)
     return F.batch_norm(input, running_mean, running_var, weight, bias, training, momentum, eps)
 
 def bilinear_upsample(in_, factor):
@@ -37,3 +37,50 @@ def bilinear_upsample(in_, factor):
 
 def log_softmax(input):
     return F.log_softmax(input)
+
+'''
+Batched functional layers for adapting T tasks at once.
+Activations of T tasks are laid side by side on the channel axis (N, T*C, H, W),
+every weight carries a leading task axis (T, ...), so that each task only sees its own slice of the weights.
+'''
+
+def tasks_to_channels(input, channels, img_size):
+    ''' T, N, D -> N, T*C, H, W '''
+    num_tasks, batch_size = input.size(0), input.size(1)
+    x = input.view(num_tasks, batch_size, channels, img_size[0], img_size[1]).transpose(0, 1)
+    return x.reshape(batch_size, num_tasks * channels, img_size[0], img_size[1])
+
+def channels_to_tasks(input, num_tasks):
+    ''' N, T*C -> T, N, C '''
+    return input.view(input.size(0), num_tasks, -1).transpose(0, 1)
+
+def batched_conv2d(input, weight, bias=None, stride=1, padding=0, dilation=1, groups=1):
+    ''' one group per task, weight: T, C_out, C_in // groups, kH, kW '''
+    num_tasks = weight.size(0)
+    weight = weight.reshape(-1, *weight.size()[2:])
+    if bias is not None:
+        bias = bias.reshape(-1)
+    return F.conv2d(input, weight, bias, stride, padding, dilation, groups * num_tasks)
+
+def batched_linear(input, weight, bias=None):
+    ''' input: N, T*F_in, weight: T, F_out, F_in '''
+    x = channels_to_tasks(input, weight.size(0))  # T, N, F_in
+    if bias is None:
+        out = torch.bmm(x, weight.transpose(1, 2))
+    else:
+        out = torch.baddbmm(bias.unsqueeze(1), x, weight.transpose(1, 2))
+    return out.transpose(0, 1).reshape(input.size(0), -1)
+
+def batched_batchnorm(input, weight, bias, running_mean=None, running_var=None, training=True, eps=1e-5, momentum=0.1):
+    ''' the statistics of each channel of (N, T*C, H, W) are exactly the statistics of one task's channel '''
+    num_tasks = weight.size(0)
+    if running_mean is not None:
+        running_mean = running_mean.repeat(num_tasks)
+        running_var = running_var.repeat(num_tasks)
+    return F.batch_norm(input, running_mean, running_var, weight.reshape(-1), bias.reshape(-1), training, momentum, eps)
+
+def batched_cross_entropy(output, target):
+    ''' output: T, N, num_classes, return the sum over tasks of each task's mean loss '''
+    num_tasks = output.size(0)
+    loss = F.cross_entropy(output.reshape(-1, output.size(2)), target.reshape(-1), reduction="none")
+    return loss.view(num_tasks, -1).mean(1).sum()
@@ -1,50 +1,171 @@
 import torch.nn.functional as F
 from torch import nn
 from collections import defaultdict
-import types
-from functools import partial, update_wrapper
+import inspect
 import torch
 import math
-
-def conv_weight_forward(self, x, conv_fc_module_to_name, param_dict):
-    module_weight_name = conv_fc_module_to_name[self]["weight"]
-    conv_weight = param_dict[module_weight_name]
-    conv_bias = self.bias
-    if self.bias is not None:
-        module_bias_name = conv_fc_module_to_name[self]["bias"]
-        conv_bias = param_dict[module_bias_name]
-    out = F.conv2d(x, conv_weight, conv_bias, self.stride,
-                   self.padding, self.dilation, self.groups)  # B, C, H, W
-    return out
-
-def fc_weight_forward(self, x,conv_fc_module_to_name, param_dict):
-    module_weight_name = conv_fc_module_to_name[self]["weight"]
-    fc_weight = param_dict[module_weight_name]
-    fc_bias = self.bias
-    if self.bias is not None:
-        module_bias_name = conv_fc_module_to_name[self]["bias"]
-        fc_bias = param_dict[module_bias_name]
-    return F.linear(x, fc_weight, fc_bias)
-
-def bn_forward(self, x, conv_fc_module_to_name, param_dict):
+from torch.utils.checkpoint import checkpoint
+from torch.fx import symbolic_trace
+from torch.fx.node import map_arg
+from networks.layers import tasks_to_channels, channels_to_tasks, batched_conv2d, batched_linear, batched_batchnorm
+from toolkit.device import to_device
+
+def conv_weight_forward(module, x, weight, bias, batched=False):
+    if batched:
+        return batched_conv2d(x, weight, bias, module.stride, module.padding, module.dilation, module.groups)
+    return F.conv2d(x, weight, bias, module.stride, module.padding, module.dilation, module.groups)  # B, C, H, W
+
+def fc_weight_forward(module, x, weight, bias, batched=False):
+    if batched:
+        return batched_linear(x, weight, bias)
+    return F.linear(x, weight, bias)
+
+def bn_forward(module, x, weight, bias, batched=False):
+    if batched:
+        # the running statistics are not tracked, because they cannot be shared by the tasks adapted together
+        if module.training or not module.track_running_stats:
+            return batched_batchnorm(x, weight, bias, training=True, eps=module.eps)
+        return batched_batchnorm(x, weight, bias, module.running_mean, module.running_var, training=False, eps=module.eps)
     exponential_average_factor = 0.0
-    if self.training and self.track_running_stats:
-        self.num_batches_tracked += 1
-        if self.momentum is None:  # use cumulative moving average
-            exponential_average_factor = 1.0 / self.num_batches_tracked.item()
+    if module.training and module.track_running_stats:
+        module.num_batches_tracked += 1
+        if module.momentum is None:  # use cumulative moving average
+            exponential_average_factor = 1.0 / module.num_batches_tracked.item()
         else:  # use exponential moving average
-            exponential_average_factor = self.momentum
-    module_weight_name = conv_fc_module_to_name[self]["weight"]
-    weight = param_dict[module_weight_name]
-    bias = self.bias
-    if self.bias is not None:
-        module_bias_name = conv_fc_module_to_name[self]["bias"]
-        bias = param_dict[module_bias_name]
-
+            exponential_average_factor = module.momentum
     return F.batch_norm(
-        x, self.running_mean, self.running_var, weight, bias,
-        self.training or not self.track_running_stats,
-        exponential_average_factor, self.eps)
+        x, module.running_mean, module.running_var, weight, bias,
+        module.training or not module.track_running_stats,
+        exponential_average_factor, module.eps)
+
+WEIGHT_FORWARDS = {nn.Conv2d: conv_weight_forward, nn.Linear: fc_weight_forward, nn.BatchNorm2d: bn_forward}
+
+
+class FunctionalGraph(object):
+    '''
+    The module graph of a network, traced by torch.fx and compiled once into a flat list of steps.
+    Calling it with a params dict runs the network with those params, the Conv2d/Linear/BatchNorm2d modules only
+    provide their hyper-parameters, no module is modified per call. All intermediate values live in a local dict,
+    so several weight sets can run through the same network at the same time (BatchNorm2d in training mode still
+    updates its running statistics like the module would do).
+    In batched mode the params dict holds stacked T, *param.size() tensors and x is laid out as N, T*C, H, W.
+    Runs of steps with a single input value and a single output value are blocks, which can be checkpointed.
+    '''
+
+    def __init__(self, network, param_prefix="network."):
+        # the extra arguments of forward, e.g. weights=None of Conv3, are fixed to their defaults while tracing
+        concrete_args = {name: arg.default for name, arg in list(inspect.signature(network.forward).parameters.items())[1:]
+                         if arg.default is not inspect.Parameter.empty}
+        graph = symbolic_trace(network, concrete_args=concrete_args).graph
+        modules = dict(network.named_modules())
+        nodes = list(graph.nodes)
+        last_use = {}
+        for idx, node in enumerate(nodes):
+            for input_node in node.all_input_nodes:
+                last_use[input_node] = idx
+        free_after = defaultdict(list)
+        for node, idx in last_use.items():
+            free_after[idx].append(node)
+        self.steps = []
+        is_first_placeholder = True
+        for idx, node in enumerate(nodes):
+            target = node.target
+            weight_name, bias_name = None, None
+            if node.op == "placeholder":
+                target = is_first_placeholder
+                is_first_placeholder = False
+            elif node.op == "get_attr":
+                weight_name = param_prefix + node.target
+                target = network
+                for attr in node.target.split("."):
+                    target = getattr(target, attr)
+            elif node.op == "call_module":
+                target = modules[node.target]
+                if type(target) in WEIGHT_FORWARDS:
+                    weight_name = "{}{}.weight".format(param_prefix, node.target)
+                    if target.bias is not None:
+                        bias_name = "{}{}.bias".format(param_prefix, node.target)
+            self.steps.append((node, node.op, target, weight_name, bias_name, free_after[idx]))
+        self.blocks = self.split_blocks(nodes, last_use)
+        self.block_starts = {start: block for block, (start, _, _, _) in enumerate(self.blocks)}
+
+    @staticmethod
+    def split_blocks(nodes, last_use):
+        '''
+        (start, end, input node, output node) of the runs of steps between two points where only one value is alive,
+        e.g. every residual block of a ResNet, such a block can be recomputed from its input alone
+        '''
+        blocks = []
+        live = set()
+        cut_idx, cut_node = None, None
+        for idx, node in enumerate(nodes):
+            if node.op == "output":
+                break
+            for input_node in node.all_input_nodes:
+                if last_use[input_node] == idx:
+                    live.discard(input_node)
+            if node in last_use:
+                live.add(node)
+            if live == {node}:
+                # a single op saves nothing by recomputing, and it may be an in-place op on the block input
+                if cut_node is not None and sum(n.op.startswith("call_") for n in nodes[cut_idx + 1: idx + 1]) > 1:
+                    blocks.append((cut_idx + 1, idx + 1, cut_node, node))
+                cut_idx, cut_node = idx, node
+        return blocks
+
+    def block_names(self):
+        return ["{}..{}".format(self.steps[start][0].name, self.steps[end - 1][0].name) for start, end, _, _ in self.blocks]
+
+    def run_step(self, env, step, x, param_dict, batched):
+        node, op, target, weight_name, bias_name, free_nodes = step
+        load = lambda n: env[n]
+        if op == "placeholder":
+            env[node] = x if target else (node.args[0] if node.args else None)
+        elif op == "get_attr":
+            env[node] = param_dict.get(weight_name, target)
+        elif op == "call_function":
+            env[node] = target(*map_arg(node.args, load), **map_arg(node.kwargs, load))
+        elif op == "call_method":
+            self_obj, *args = map_arg(node.args, load)
+            env[node] = getattr(self_obj, target)(*args, **map_arg(node.kwargs, load))
+        elif op == "call_module":
+            args = map_arg(node.args, load)
+            if weight_name is not None:
+                bias = param_dict[bias_name] if bias_name is not None else None
+                env[node] = WEIGHT_FORWARDS[type(target)](target, args[0], param_dict[weight_name], bias, batched)
+            else:
+                env[node] = target(*args, **map_arg(node.kwargs, load))
+        elif op == "output":
+            return map_arg(node.args[0], load)
+        for free_node in free_nodes:
+            del env[free_node]
+
+    def run_block(self, block_input, block, param_dict, batched):
+        start, end, input_node, output_node = self.blocks[block]
+        env = {input_node: block_input}
+        for step in self.steps[start:end]:
+            self.run_step(env, step, None, param_dict, batched)
+        return env[output_node]
+
+    def __call__(self, x, param_dict, batched=False, checkpoint_blocks=()):
+        '''
+        the activations inside the blocks of checkpoint_blocks (indices of self.blocks) are not kept for backward,
+        they are recomputed from the block input during backward (BatchNorm2d running statistics are updated again)
+        '''
+        env = {}
+        idx = 0
+        while idx < len(self.steps):
+            block = self.block_starts.get(idx) if checkpoint_blocks else None
+            if block is not None and block in checkpoint_blocks:
+                _, end, input_node, output_node = self.blocks[block]
+                env[output_node] = checkpoint(self.run_block, env.pop(input_node), block, param_dict, batched,
+                                              use_reentrant=False)
+                idx = end
+                continue
+            if self.steps[idx][1] == "output":
+                return self.run_step(env, self.steps[idx], x, param_dict, batched)
+            self.run_step(env, self.steps[idx], x, param_dict, batched)
+            idx += 1
 
 
 class MetaNetwork(nn.Module):
@@ -54,7 +175,7 @@ class MetaNetwork(nn.Module):
         self.img_size = img_size
         self.network = network
         self.loss_fn = nn.CrossEntropyLoss()
-        self.conv_fc_module_to_name = self.construct_module_name_dict()
+        self._functional_graph = None
         self._init_weights()
 
     def _init_weights(self):
@@ -77,40 +198,18 @@ class MetaNetwork(nn.Module):
                 # m.bias.data.zero_() + 1
                 m.bias.data = torch.ones(m.bias.data.size())
 
-    def construct_module_name_dict(self):
-        module_to_name = defaultdict(dict)
-        for name, module in self.network.named_modules():
-            if isinstance(module, nn.Conv2d) or isinstance(module, nn.Linear) or isinstance(module, nn.BatchNorm2d):
-                module_to_name[module]["weight"] = "network.{}.weight".format(name)
-                if module.bias is not None:
-                    module_to_name[module]["bias"] = "network.{}.bias".format(name)
-        return module_to_name
-
-    def backup_orig_forward(self, module):
-        if isinstance(module, nn.Conv2d) or isinstance(module, nn.Linear) or isinstance(module, nn.BatchNorm2d):
-            if not hasattr(module, "orig_forward"):
-                f = module.forward
-                g = types.FunctionType(f.__code__, f.__globals__, name=f.__name__,
-                                       argdefs=f.__defaults__,
-                                       closure=f.__closure__)
-                g = update_wrapper(g, f)
-                module.orig_forward = types.MethodType(g, module)
-
-    def recover_orig_forward(self, module):
-        if isinstance(module, nn.Conv2d) or isinstance(module, nn.Linear) or isinstance(module, nn.BatchNorm2d):
-            module.forward = module.orig_forward
-
-
-    def replace_forward(self, module, weight):
-        if isinstance(module, nn.Conv2d):
-            module.forward = partial(types.MethodType(conv_weight_forward, module), conv_fc_module_to_name=self.conv_fc_module_to_name,
-                                     param_dict=weight)
-        elif isinstance(module, nn.Linear):
-            module.forward = partial(types.MethodType(fc_weight_forward, module), conv_fc_module_to_name=self.conv_fc_module_to_name,
-                                     param_dict=weight)
-        elif isinstance(module, nn.BatchNorm2d):
-            module.forward = partial(types.MethodType(bn_forward, module), conv_fc_module_to_name=self.conv_fc_module_to_name,
-                                     param_dict=weight)
+    @property
+    def functional_graph(self):
+        # compiled lazily, so that subclasses which never run with a params dict (e.g. Detector) never trace the network
+        if self._functional_graph is None:
+            self._functional_graph = FunctionalGraph(self.network, param_prefix="network.")
+        return self._functional_graph
+
+    def __getstate__(self):
+        # deepcopy/pickle do not carry the compiled graph, it refers to the modules of this copy only
+        state = self.__dict__.copy()
+        state["_functional_graph"] = None
+        return state
 
     def forward(self,x):
         return self.network(x)
@@ -123,18 +222,22 @@ class MetaNetwork(nn.Module):
                 if m_to.bias is not None:
                     m_to.bias.data = m_from.bias.data.clone()
 
-    def net_forward(self, x, weight=None):
-        self.network.apply(self.backup_orig_forward)  # 备份原本的forward函数
+    def net_forward(self, x, weight=None, checkpoint_blocks=()):
         x = x.view(-1, self.channels, self.img_size[0], self.img_size[1])
-        if weight is not None:
-            self.network.apply(partial(self.replace_forward, weight=weight))
-        output = self.forward(x)
-        self.network.apply(self.recover_orig_forward)
-        return output
+        if weight is None:
+            return self.forward(x)
+        return self.functional_graph(x, weight, checkpoint_blocks=checkpoint_blocks)
+
+    def batched_net_forward(self, x, weight):
+        ''' x: T, N, D, weight: each one is stacked as T, *param.size(), return T, N, num_classes '''
+        num_tasks = x.size(0)
+        x = tasks_to_channels(x, self.channels, self.img_size)
+        output = self.functional_graph(x, weight, batched=True)
+        return channels_to_tasks(output, num_tasks)
 
     def forward_pass(self, in_, target, weight=None):
-        input_var = in_.cuda()
-        target_var = target.cuda()
+        input_var = to_device(in_)
+        target_var = to_device(target)
         out = self.net_forward(input_var, weight)
         loss = self.loss_fn(out, target_var)
         return loss, out
\ No newline at end of file
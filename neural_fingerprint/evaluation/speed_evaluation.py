@@ -9,6 +9,7 @@ from config import PY_ROOT, IN_CHANNELS, IMAGE_SIZE, CLASS_NUM
 from dataset.meta_task_dataset import MetaTaskDataset
 from networks.conv3 import Conv3
 from neural_fingerprint.fingerprint_detector import NeuralFingerprintDetector
+from toolkit.device import module_to_device, device_name
 
 
 def evaluate_speed(args):
@@ -28,7 +29,7 @@ def evaluate_speed(args):
 
         reject_thresholds = [0. + 0.001 * i for i in range(2050)]
         network.load_state_dict(torch.load(model_path, lambda storage, location: storage)["state_dict"])
-        network.cuda()
+        network = module_to_device(network)
         print("load {} over".format(model_path))
         detector = NeuralFingerprintDetector(ds_name, network, num_dx, CLASS_NUM[ds_name], eps=eps,
                                              out_fp_dxdy_dir=args.output_dx_dy_dir)
@@ -55,7 +56,7 @@ def evaluate_speed(args):
             print("shot {} done".format(shot))
         break
 
-    file_name = "{}/train_pytorch_model/NF_Det/speed_test_result.json".format(PY_ROOT)
+    file_name = "{}/train_pytorch_model/NF_Det/speed_test_result_{}.json".format(PY_ROOT, device_name())
     with open(file_name, "w") as file_obj:
         file_obj.write(json.dumps(results))
         file_obj.flush()
@@ -1,6 +1,7 @@
 from collections import defaultdict
 import os
 import pickle
+import torch
 from sklearn.metrics import f1_score
 class Fingerprints:
     def __init__(self):
@@ -115,3 +116,51 @@ class Stats:
         for result, fn in zip(dicts, fns):
             self.write_dict(result, fn, log_dir, name)
 
+
+class ThresholdStats(object):
+    '''
+    Detection statistics of all reject thresholds at once, instead of one Stats of id sets per tau.
+    Every example is stored once by its fingerprint distance diff_norm[y_class_with_fp], it is legal at tau if the
+    distance < tau. After one sort the number of legal examples at each tau is a searchsorted and TP is a cumsum
+    of the sorted binary labels, so all taus cost O(n log n) instead of O(n x |taus|) set operations.
+    '''
+
+    def __init__(self, name="", ds_name=""):
+        self.name = name
+        self.ds_name = ds_name
+        self.scores = []
+        self.binary_y = []
+
+    def add(self, scores, binary_y):
+        ''' scores: B fingerprint distances, binary_y: B labels, real image : 1 , adversarial image 0 '''
+        scores = torch.as_tensor(scores).detach().float().view(-1)
+        self.scores.append(scores)
+        self.binary_y.append(torch.as_tensor(binary_y).to(scores.device).long().view(-1))
+
+    def clear(self):
+        self.scores = []
+        self.binary_y = []
+
+    def compute_counts(self, reject_thresholds):
+        ''' return dict of the counts, each one a tensor of len(reject_thresholds) in the order of reject_thresholds '''
+        scores = torch.cat(self.scores)
+        binary_y = torch.cat(self.binary_y)
+        sorted_scores, order = torch.sort(scores)
+        # tp_cumsum[k] : number of real images among the k smallest distances
+        tp_cumsum = torch.cat([binary_y.new_zeros(1), torch.cumsum(binary_y[order], 0)])
+        taus = torch.as_tensor(reject_thresholds, dtype=sorted_scores.dtype, device=sorted_scores.device)
+        num_legal = torch.searchsorted(sorted_scores, taus)  # number of distances < tau
+        TP = tp_cumsum[num_legal]
+        num_P = binary_y.sum()
+        precision = TP.float() / num_legal.clamp(min=1).float()
+        recall = TP.float() / num_P.clamp(min=1).float()
+        # same as f1_score(ground_truth_list, predition_list) of Stats, 0 if there is neither P nor legal
+        F1 = 2 * TP.float() / (num_legal + num_P).clamp(min=1).float()
+        return {"num": scores.numel(), "num_legal": num_legal, "num_reject": scores.numel() - num_legal,
+                "TP": TP, "FP": num_legal - TP, "precision": precision, "recall": recall, "F1": F1}
+
+    def best_tau(self, reject_thresholds):
+        ''' return (tau, F1) of the best F1, the first of reject_thresholds on ties '''
+        F1 = self.compute_counts(reject_thresholds)["F1"]
+        best = int(torch.argmax(F1).item())
+        return reject_thresholds[best], F1[best].item()
@@ -8,10 +8,11 @@ import torch
 import os
 from collections import defaultdict
 
-from neural_fingerprint.fingerprint import Fingerprints,Example,Stats
+from neural_fingerprint.fingerprint import Fingerprints,Example,Stats,ThresholdStats
 from config import IMAGE_SIZE, IN_CHANNELS, META_ATTACKER_INDEX
 import copy
 from torch import optim
+from toolkit.device import to_device, synchronize
 class NeuralFingerprintDetector(object):
 
     def __init__(self, dataset, model, num_dx, num_class, eps, out_fp_dxdy_dir):
@@ -35,7 +36,9 @@ class NeuralFingerprintDetector(object):
                     self.fp_target[i, j, i] = - 0.7
             self.fp_target = 1.5 * self.fp_target
             self.dump_dx_dy()
-        self.fp_target = torch.from_numpy(self.fp_target).cuda().float()
+        self.fp_target = to_device(torch.from_numpy(self.fp_target).float())
+        # fixed_dxs : num_dx x C x H x W, uploaded once and kept on the device
+        self.fixed_dxs = to_device(torch.from_numpy(np.concatenate(self.fp_dx, axis=0)).float())
 
         self.fp = Fingerprints()
         self.fp.dx = self.fp_dx
@@ -53,33 +56,37 @@ class NeuralFingerprintDetector(object):
         print("dump to {} and {} over".format(self.dx_path, self.dy_path))
 
 
-    def get_all_loss(self, model, x,y, epoch):
-        x, y = x.cuda(), y.cuda()
+    def perturbed_batch(self, x):
+        ''' x : B x C x H x W -> cat of x and x + dx_i for all dx, (1 + num_dx) * B x C x H x W, dx major '''
+        xp = x.unsqueeze(0) + self.fixed_dxs.unsqueeze(1)  # num_dx x B x C x H x W
+        return torch.cat([x, xp.view(-1, *x.size()[1:])])
 
-        real_bs = y.size(0)
-        fp_target_var = torch.index_select(self.fp_target, 0, y)
-        x_net = x
-        for i in range(self.num_dx):
-            dx = self.fp_dx[i]
-            dx = torch.from_numpy(dx).float().cuda()
-            x_net = torch.cat((x_net, x + dx))
-        logits_net = model(x_net)
-        output_net = F.log_softmax(logits_net, dim=1)
-        yhat = output_net[:real_bs]
+    def normalized_logits(self, logits_net, real_bs):
+        ''' split the logits of perturbed_batch, return logits_norm: B x num_class, logits_p_norm: num_dx x B x num_class '''
         logits = logits_net[:real_bs]
+        logits_p = logits_net[real_bs:].view(self.num_dx, real_bs, self.num_class)
         # 除以模长，归一化
-        logits_norm = logits * torch.norm(logits, 2, 1, keepdim=True).reciprocal().expand(real_bs, self.num_class)
-        loss_fingerprint_y = 0
-        loss_fingerprint_dy = 0
+        logits_norm = logits * torch.norm(logits, 2, 1, keepdim=True).reciprocal()
+        logits_p_norm = logits_p * torch.norm(logits_p, 2, 2, keepdim=True).reciprocal()
+        return logits_norm, logits_p_norm
+
+    @staticmethod
+    def sum_of_mse(input, target):
+        ''' the sum over dx of MSELoss(input[i], target[i]), input and target: num_dx x B x num_class '''
+        return ((input - target) ** 2).reshape(input.size(0), -1).mean(1).sum()
+
+    def get_all_loss(self, model, x,y, epoch):
+        x, y = to_device(x), to_device(y)
+
+        real_bs = y.size(0)
+        fp_target_var = torch.index_select(self.fp_target, 0, y).transpose(0, 1)  # num_dx x B x num_class
+        logits_net = model(self.perturbed_batch(x))
+        yhat = F.log_softmax(logits_net[:real_bs], dim=1)
+        logits_norm, logits_p_norm = self.normalized_logits(logits_net, real_bs)
         loss_vanilla = self.loss_func(yhat, y)
-        for i in range(self.num_dx):
-            fp_target_var_i = fp_target_var[:, i, :]
-            logits_p = logits_net[(i + 1) * real_bs: (i + 2) * real_bs]
-            logits_p_norm = logits_p * torch.norm(logits_p, 2, 1, keepdim=True).reciprocal().expand(real_bs,
-                                                                                                    self.num_class)
-            diff_logits_p = logits_p_norm - logits_norm + 0.00001
-            loss_fingerprint_y += self.loss_n(logits_p_norm, fp_target_var_i)
-            loss_fingerprint_dy += self.loss_n(diff_logits_p, fp_target_var_i)
+        diff_logits_p = logits_p_norm - logits_norm.unsqueeze(0) + 0.00001
+        loss_fingerprint_y = self.sum_of_mse(logits_p_norm, fp_target_var)
+        loss_fingerprint_dy = self.sum_of_mse(diff_logits_p, fp_target_var)
         if self.dataset == "MNIST" or self.dataset == "F-MNIST":
             if epoch >= 1:
                 loss = loss_vanilla + 1.0 * loss_fingerprint_dy
@@ -102,8 +109,11 @@ class NeuralFingerprintDetector(object):
 
     def train(self, epoch, optimizer, data_loader):
         self.model.train()
+        num_images = 0
+        synchronize()
+        before_time = time.time()
         for batch_idx, (x, y) in enumerate(data_loader):
-            x,y = x.cuda(), y.cuda()
+            x,y = to_device(x), to_device(y)
             loss, loss_vanilla, loss_fingerprint_y, loss_fingerprint_dy = self.train_one_image(self.model, x, y, optimizer, epoch)
             if batch_idx % 100 == 0:
                 print(
@@ -114,6 +124,12 @@ class NeuralFingerprintDetector(object):
                         loss_fingerprint_y.item(),
                         loss_fingerprint_dy.item(),
                         loss.item()))
+            num_images += x.size(0)
+        synchronize()
+        time_elapse = time.time() - before_time
+        print("Train Epoch: {} done in {:.1f}s, {:.1f} images/s ({:.1f} forwarded images/s with {} dx)".format(
+            epoch, time_elapse, num_images / time_elapse, num_images * (1 + self.num_dx) / time_elapse, self.num_dx))
+        return num_images / time_elapse
 
     def test(self, epoch, data_loader, test_length=None):
         self.model.eval()
@@ -126,26 +142,16 @@ class NeuralFingerprintDetector(object):
         num_same_argmax = 0
         with torch.no_grad():
             for e,(data, target) in enumerate(data_loader):
-                data, target = data.cuda(), target.cuda()
-                data.requires_grad = False
-                data_np = data.detach().cpu().numpy()
-                real_bs = data_np.shape[0]
-                logits = self.model(data)
-                output = F.log_softmax(logits, dim=1)
-                logits_norm = logits * torch.norm(logits, 2, 1, keepdim=True).reciprocal().expand(real_bs, self.num_class)
-                fp_target_var = torch.index_select(self.fp_target, 0, target)
-                for i in range(self.num_dx):
-                    dx = self.fp_dx[i]
-                    fp_target_var_i = fp_target_var[:, i, :]
-                    logits_p = self.model(data + torch.from_numpy(dx).float().cuda())
-                    logits_p_norm = logits_p * torch.norm(logits_p, 2, 1, keepdim=True).reciprocal().expand(real_bs,
-                                                                                                            self.num_class)
-                    diff = logits_p_norm - logits_norm
-                    diff_class = diff.max(1, keepdim=True)[1]
-                    fp_target_class = fp_target_var_i.max(1, keepdim=True)[1]
-                    loss_y += self.loss_n(logits_p_norm, fp_target_var_i)
-                    loss_dy += 10.0 * self.loss_n(diff, fp_target_var_i)
-                    num_same_argmax += torch.sum(diff_class == fp_target_class)
+                data, target = to_device(data), to_device(target)
+                real_bs = data.size(0)
+                logits_net = self.model(self.perturbed_batch(data))
+                output = F.log_softmax(logits_net[:real_bs], dim=1)
+                logits_norm, logits_p_norm = self.normalized_logits(logits_net, real_bs)
+                fp_target_var = torch.index_select(self.fp_target, 0, target).transpose(0, 1)  # num_dx x B x num_class
+                diff = logits_p_norm - logits_norm.unsqueeze(0)
+                loss_y += self.sum_of_mse(logits_p_norm, fp_target_var)
+                loss_dy += 10.0 * self.sum_of_mse(diff, fp_target_var)
+                num_same_argmax += torch.sum(diff.max(2)[1] == fp_target_var.max(2)[1])
                 test_loss += F.nll_loss(output, target, size_average=False).item()  # sum up batch loss
                 pred = output.max(1, keepdim=True)[1]  # get the index of the max log-probability
                 correct += pred.eq(target.view_as(pred)).detach().cpu().sum()
@@ -174,58 +180,47 @@ class NeuralFingerprintDetector(object):
         return result
 
 
-    def model_with_fingerprint(self, model, x, fp):
-        # x : B x C x W x H with B = 1
-        # Check y' = f(x+dx) for all dx
-
-        assert x.size()[0] == 1  # batch
-
-        # Get perturbations for predicted class
-
-        logits = model(x)
-
+    def batch_fingerprint(self, model, x):
+        '''
+        x : B x C x H x W, x and its B x num_dx perturbations x + dx run through the model in one forward.
+        return yhat: B x num_class, y_class: B, diff_norm: B x num_class (论文公式9), y_class_with_fp: B
+        '''
+        batch_size = x.size(0)
+        # broadcast: B x num_dx x C x H x W
+        xp = (x.unsqueeze(1) + self.fixed_dxs.unsqueeze(0)).view(batch_size * self.num_dx, *x.size()[1:])
+        logits_all = model(torch.cat([x, xp]))
+        logits = logits_all[:batch_size]
+        logits_p = logits_all[batch_size:].view(batch_size, self.num_dx, self.num_class)
         yhat = F.softmax(logits, dim=1)
-        y_class = yhat.data.max(1, keepdim=True)[1]
-        y_class = y_class.detach().cpu().numpy()[0, 0]
-
-        # fixed_dxs : num_perturb x C x W x H
-        fixed_dxs = torch.from_numpy(np.concatenate(fp.dx, axis=0)).float().cuda()
-
-        # cmopute x + dx : broadcast! num_perturb x C x W x H
-        xp = x + fixed_dxs
-
-        # if args.debug: print("xp", xp.size(), "x", x.size(), "fixed_dxs", fixed_dxs.size())
-
-        logits_p = self.model(xp)
-        yhat_p = F.softmax(logits_p, dim=1)
-
-        # compute f(x + dx) : num_perturb x num_class
-
-        # print("get fixed_dys : num_target_class x num_perturb x num_class: for each target class, a set of perturbations and desired outputs (num_class).")
-        fixed_dys = fp.dy
-        logits_norm = logits * torch.norm(logits, 2, 1, keepdim=True).reciprocal().expand(1, self.num_class)
-        logits_p_norm = logits_p * torch.norm(logits_p, 2, 1, keepdim=True).reciprocal().expand(self.num_dx,
-                                                                                                self.num_class)
-        diff_logits_p = logits_p_norm - logits_norm
-        # diff_logits_p = diff_logits_p * torch.norm(diff_logits_p, 2, 1, keepdim=True).reciprocal().expand(args.num_dx, args.num_class)
-
-        diff = fixed_dys - diff_logits_p # 论文公式9
-
-        diff_norm = torch.norm(diff, 2, dim=2)
-
-        diff_norm = torch.mean(diff_norm, dim=1)  #论文公式9求均值
-
-        y_class_with_fp = diff_norm.min(0, keepdim=True)[1] #差距最小的那个logit的位置
-        y_class_with_fp = y_class_with_fp.detach().cpu().numpy()[0]
-
-        ex = Example(x, yhat, y_class)
-        ex.dxs = fixed_dxs
-        ex.yhat_p = yhat_p
-        ex.diff = diff
-        ex.diff_norm = diff_norm.detach().cpu().numpy()
-        ex.y_class_with_fp = y_class_with_fp
+        logits_norm = logits * torch.norm(logits, 2, 1, keepdim=True).reciprocal()
+        logits_p_norm = logits_p * torch.norm(logits_p, 2, 2, keepdim=True).reciprocal()
+        diff_logits_p = logits_p_norm - logits_norm.unsqueeze(1)  # B x num_dx x num_class
+        # fixed_dys : num_target_class x num_dx x num_class -> diff : B x num_target_class x num_dx x num_class
+        diff = self.fp_target.unsqueeze(0) - diff_logits_p.unsqueeze(1)
+        diff_norm = torch.mean(torch.norm(diff, 2, dim=3), dim=2)
+        y_class_with_fp = diff_norm.min(1)[1]  # 差距最小的那个logit的位置
+        return yhat, yhat.max(1)[1], diff_norm, y_class_with_fp
+
+    def examples_with_fingerprint(self, model, x):
+        ''' the batched scores of x split into one Example per image, which are only needed for the Stats reporting '''
+        with torch.no_grad():
+            yhat, y_class, diff_norm, y_class_with_fp = self.batch_fingerprint(model, x)
+        y_class = y_class.detach().cpu().numpy()
+        diff_norm = diff_norm.detach().cpu().numpy()
+        y_class_with_fp = y_class_with_fp.detach().cpu().numpy()
+        examples = []
+        for b in range(x.size(0)):
+            ex = Example(x[b:b + 1], yhat[b:b + 1], y_class[b])
+            ex.dxs = self.fixed_dxs
+            ex.diff_norm = diff_norm[b]
+            ex.y_class_with_fp = y_class_with_fp[b]
+            examples.append(ex)
+        return examples
 
-        return ex
+    def model_with_fingerprint(self, model, x, fp):
+        # x : B x C x W x H with B = 1, fp.dx and fp.dy are the resident fixed_dxs and fp_target
+        assert x.size()[0] == 1  # batch
+        return self.examples_with_fingerprint(model, x)[0]
 
     def detect_with_fingerprints(self, ex, stats_per_tau):
         diff_norm = ex.diff_norm
@@ -276,10 +271,9 @@ class NeuralFingerprintDetector(object):
         stats_per_tau = {i: Stats(tau=i, name=name, ds_name=ds_name) for i in reject_thresholds}
         i = 0
         for e, (x, y) in enumerate(data_loader):
-            data_np = x.detach().cpu().numpy()
-            real_bs = data_np.shape[0]
-            for b in range(real_bs):
-                ex = self.model_with_fingerprint(self.model, x[b:b + 1], self.fp)
+            real_bs = x.size(0)
+            examples = self.examples_with_fingerprint(self.model, to_device(x))
+            for b, ex in enumerate(examples):
                 # Careful! Needs Dataloader with shuffle=False
                 ex.id = i
                 ex.y = y[b]
@@ -290,8 +284,7 @@ class NeuralFingerprintDetector(object):
                     print("\nx", x[b:b + 1].size(), "y", y[b:b + 1], y[b:b + 1].size())
                     print("Fingerprinting image (hash:", hash(x[b:b + 1]), ") class", y[b])
                     print("Model    class prediction: [", ex.y_class, "] from logits:", ex.yhat)
-                    print("Model+fp class prediction: [{}] from diff_norm: {}".format(ex.y_class_with_fp,
-                                                                                      ex.diff_norm.detach().cpu().numpy()))
+                    print("Model+fp class prediction: [{}] from diff_norm: {}".format(ex.y_class_with_fp, ex.diff_norm))
             if e % 10 == 0:
                 print("Ex: {} batch {} of size {}".format(i, e, real_bs))
 
@@ -320,8 +313,7 @@ class NeuralFingerprintDetector(object):
 
     def eval_with_fingerprints_finetune(self, val_loader, ds_name, reject_thresholds, num_updates, lr):
         test_net = copy.deepcopy(self.model)
-        stats_per_tau = {thresh: Stats(tau=thresh, name=ds_name, ds_name=ds_name) for thresh in reject_thresholds}
-        i = 0
+        stats = ThresholdStats(name=ds_name, ds_name=ds_name)
         all_F1_scores = []
         all_tau = []
         # 注意这个val_loader要特别定制化
@@ -333,9 +325,9 @@ class NeuralFingerprintDetector(object):
             else:
                 support_images, support_gt_labels, support_binary_labels, query_images, query_gt_labels, query_binary_labels, _ = pack
             support_binary_labels = support_binary_labels.detach().cpu().numpy()
-            support_gt_labels = support_gt_labels.cuda()
-            support_images = support_images.cuda()
-            query_images = query_images.cuda()
+            support_gt_labels = to_device(support_gt_labels)
+            support_images = to_device(support_images)
+            query_images = to_device(query_images)
             for task_idx in range(support_images.size(0)):
 
                 clean_support_index = np.where(support_binary_labels[task_idx] == 1)[0]
@@ -354,47 +346,23 @@ class NeuralFingerprintDetector(object):
                     self.train_one_image(test_net, clean_imgs, clean_labels, optimizer, 1)
 
                 test_net.eval()
-                x, y = query_images[task_idx], query_gt_labels[task_idx]  # 注意这个分类信息是img gt label
-                binary_y = query_binary_labels[task_idx]
-                y = y.detach().cpu().numpy()
-                binary_y = binary_y.detach().cpu().numpy()
+                x = query_images[task_idx]
+                binary_y = query_binary_labels[task_idx]  # ground truth of real image : 1 , adversarial image 0
                 batch_size = x.size(0)
                 x = x.view(batch_size, IN_CHANNELS[ds_name], IMAGE_SIZE[ds_name][0], IMAGE_SIZE[ds_name][1])
 
-                data_np = x.detach().cpu().numpy()
-                real_bs = data_np.shape[0]
-
-                for b in range(real_bs):
-                    ex = self.model_with_fingerprint(test_net, x[b:b + 1], self.fp)
-                    # Careful! Needs Dataloader with shuffle=False
-                    ex.id = i
-                    ex.y = y[b] # ground truth of real image : 1 , adversarial image 0
-                    ex.binary_y = binary_y[b]
-                    ex, stats_per_tau = self.detect_with_fingerprints(ex, stats_per_tau)
-                    i += 1
-
-                # results = defaultdict(lambda: None)
-                # stats_results = defaultdict(lambda: None)
-
-                result = {}
-                for tau, stats in stats_per_tau.items():
-                    stats.counts = stats.compute_counts()
-                    ids_correct = stats.ids_correct
-                    F1 = stats.compute_counts(ids_correct=ids_correct)["F1"]
-                    result[tau] = F1
-                # best_F1 = result[min(result.keys(), key=lambda k: abs(k-threshold))]
-                best_F1 = max(list(result.values()))
-                # best_tau = threshold
-                best_tau = max(list(result.items()), key=lambda e:e[1])[0]
+                with torch.no_grad():
+                    diff_norm = self.batch_fingerprint(test_net, x)[2]  # the whole query set in one forward
+                # 每个样本只存一次最小的fingerprint距离, 所有tau一起算F1
+                stats.clear()
+                stats.add(diff_norm.min(1)[0], binary_y)
+                best_tau, best_F1 = stats.best_tau(reject_thresholds)
                 if each_attack_stats:
                     adversary = META_ATTACKER_INDEX[adversary_indexes[task_idx].item()]
                     attacker_stats[adversary].append(best_F1)
 
                 all_F1_scores.append(best_F1)
                 all_tau.append(best_tau)
-                stats_per_tau.clear()
-                for thresh in reject_thresholds:
-                    stats_per_tau[thresh] = Stats(tau=thresh, name=ds_name, ds_name=ds_name)
                 print("evaluate_accuracy task {}, F1:{}".format(task_idx, best_F1))
         F1 = np.mean(all_F1_scores)
         tau = np.mean(all_tau)
@@ -410,15 +378,14 @@ class NeuralFingerprintDetector(object):
 
     def test_speed(self, val_loader, ds_name, reject_thresholds, num_updates, lr):
         test_net = copy.deepcopy(self.model)
-        stats_per_tau = {thresh: Stats(tau=thresh, name=ds_name, ds_name=ds_name) for thresh in reject_thresholds}
-        i = 0
+        stats = ThresholdStats(name=ds_name, ds_name=ds_name)
         all_times = []
         # 注意这个val_loader要特别定制化
         for support_images,support_gt_labels, support_binary_labels, query_images, query_gt_labels, query_binary_labels,_ in val_loader:
             support_binary_labels = support_binary_labels.detach().cpu().numpy()
-            support_gt_labels = support_gt_labels.cuda()
-            support_images = support_images.cuda()
-            query_images = query_images.cuda()
+            support_gt_labels = to_device(support_gt_labels)
+            support_images = to_device(support_images)
+            query_images = to_device(query_images)
             for task_idx in range(support_images.size(0)):
                 print("evaluate_accuracy task {}".format(task_idx))
                 clean_support_index = np.where(support_binary_labels[task_idx] == 1)[0]
@@ -438,44 +405,20 @@ class NeuralFingerprintDetector(object):
                     self.train_one_image(test_net, clean_imgs, clean_labels, optimizer, 1)
 
                 test_net.eval()
-                x, y = query_images[task_idx], query_gt_labels[task_idx]  # 注意这个分类信息是img gt label
-                binary_y = query_binary_labels[task_idx]
-                y = y.detach().cpu().numpy()
-                binary_y = binary_y.detach().cpu().numpy()
+                x = query_images[task_idx]
+                binary_y = query_binary_labels[task_idx]  # ground truth of real image : 1 , adversarial image 0
                 batch_size = x.size(0)
                 x = x.view(batch_size, IN_CHANNELS[ds_name], IMAGE_SIZE[ds_name][0], IMAGE_SIZE[ds_name][1])
 
-                data_np = x.detach().cpu().numpy()
-                real_bs = data_np.shape[0]
-
-                for b in range(real_bs):
-                    ex = self.model_with_fingerprint(test_net, x[b:b + 1], self.fp)
-                    # Careful! Needs Dataloader with shuffle=False
-                    ex.id = i
-                    ex.y = y[b] # ground truth of real image : 1 , adversarial image 0
-                    ex.binary_y = binary_y[b]
-                    ex, stats_per_tau = self.detect_with_fingerprints(ex, stats_per_tau)
-                    i += 1
-
-                # results = defaultdict(lambda: None)
-                # stats_results = defaultdict(lambda: None)
-
-                result = {}
-                for tau, stats in stats_per_tau.items():
-                    stats.counts = stats.compute_counts()
-                    ids_correct = stats.ids_correct
-                    F1 = stats.compute_counts(ids_correct=ids_correct)["F1"]
-                    result[tau] = F1
-                # best_F1 = result[min(result.keys(), key=lambda k: abs(k-threshold))]
-                best_F1 = max(list(result.values()))
-                # best_tau = threshold
+                with torch.no_grad():
+                    diff_norm = self.batch_fingerprint(test_net, x)[2]  # the whole query set in one forward
+                # 每个样本只存一次最小的fingerprint距离, 所有tau一起算F1
+                stats.clear()
+                stats.add(diff_norm.min(1)[0], binary_y)
+                best_tau, best_F1 = stats.best_tau(reject_thresholds)
                 time_elapse = time.time() - before_time
-                best_tau = max(list(result.items()), key=lambda e:e[1])[0]
 
                 all_times.append(time_elapse)
-                stats_per_tau.clear()
-                for thresh in reject_thresholds:
-                    stats_per_tau[thresh] = Stats(tau=thresh, name=ds_name, ds_name=ds_name)
         mean_time = np.mean(all_times)
         var_time = np.var(all_times)
         del test_net
@@ -13,6 +13,7 @@ from dataset.meta_task_dataset import MetaTaskDataset
 from collections import defaultdict
 
 from neural_fingerprint.evaluation.speed_evaluation import evaluate_speed
+from toolkit.device import add_device_args, set_device_by_args
 
 import argparse
 
@@ -73,6 +74,7 @@ def parse_args():
     parser.add_argument("--best_tau",type=float,default=1.475234)
     parser.add_argument("--cross_domain_target", type=str)
     parser.add_argument("--cross_arch_target",type=str)
+    add_device_args(parser)
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
@@ -143,10 +145,13 @@ def main():
             resume_epoch = checkpoint["epoch"]
             network.load_state_dict(checkpoint["state_dict"])
 
+        all_throughput = []
         for epoch in range(resume_epoch, args.epochs + 1):
             if(epoch==1):
                 detector.test(epoch, test_loader, test_length=0.1*len(val_dataset))
-            detector.train(epoch, optimizer, train_loader)
+            all_throughput.append(detector.train(epoch, optimizer, train_loader))
+            print("Epoch{}, throughput {:.1f} images/s, mean of all epochs {:.1f} images/s".format(
+                epoch, all_throughput[-1], sum(all_throughput) / len(all_throughput)))
 
             print("Epoch{}, Saving model in {}".format(epoch, model_path))
             torch.save({
@@ -158,6 +163,7 @@ def main():
     else:  # 测试模式
 
         if args.study_subject == "speed_test":
+            set_device_by_args(args)
             evaluate_speed(args)
             return
 
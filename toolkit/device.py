@@ -0,0 +1,107 @@
+import contextlib
+import resource
+
+import torch
+
+'''
+The device on which the detectors run.
+The hot paths move tensors and modules through these helpers instead of calling .cuda(),
+so that the same code also runs on the CPU-only inference machines.
+The device is resolved lazily, because the train scripts set CUDA_VISIBLE_DEVICES after the imports.
+'''
+
+_device = None
+_cpu_config = {"channels_last": False, "bfloat16": False}
+
+
+def get_device():
+    global _device
+    if _device is None:
+        _device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    return _device
+
+
+def is_cpu():
+    return get_device().type == "cpu"
+
+
+def set_device(device, num_threads=None, num_interop_threads=None, channels_last=False, bfloat16=False):
+    ''' channels_last and bfloat16 only take effect on the CPU '''
+    global _device
+    _device = torch.device(device)
+    if _device.type == "cpu":
+        configure_cpu(num_threads, num_interop_threads, channels_last, bfloat16)
+    return _device
+
+
+def configure_cpu(num_threads=None, num_interop_threads=None, channels_last=False, bfloat16=False):
+    if num_threads:
+        torch.set_num_threads(num_threads)  # intra-op threads
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:  # can only be set once and before any inter-op parallel work has started
+            print("inter-op threads are already started, keep {}".format(torch.get_num_interop_threads()))
+    _cpu_config["channels_last"] = channels_last
+    _cpu_config["bfloat16"] = bfloat16
+    print("CPU mode: {} intra-op threads, {} inter-op threads, channels_last={}, bfloat16={}".format(
+        torch.get_num_threads(), torch.get_num_interop_threads(), channels_last, bfloat16))
+
+
+def to_device(tensor):
+    if is_cpu() and _cpu_config["channels_last"] and tensor.dim() == 4:
+        return tensor.to(get_device(), memory_format=torch.channels_last)
+    return tensor.to(get_device(), non_blocking=True)
+
+
+def module_to_device(module):
+    module = module.to(get_device())
+    if is_cpu() and _cpu_config["channels_last"]:
+        module = module.to(memory_format=torch.channels_last)
+    return module
+
+
+def autocast():
+    ''' bfloat16 autocast for inference on the CPU if configured, otherwise a no-op context '''
+    if is_cpu() and _cpu_config["bfloat16"]:
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def synchronize():
+    if get_device().type == "cuda":
+        torch.cuda.synchronize()
+
+
+def reset_peak_memory():
+    if get_device().type == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+
+
+def peak_memory_mb():
+    ''' peak allocated memory since reset_peak_memory on cuda, peak RSS of the process on the CPU (cannot be reset) '''
+    if get_device().type == "cuda":
+        return torch.cuda.max_memory_allocated() / 1024 ** 2
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KB on linux
+
+
+def device_name():
+    if get_device().type == "cuda":
+        return "cuda"
+    return "cpu_{}threads{}".format(torch.get_num_threads(), "_bf16" if _cpu_config["bfloat16"] else "")
+
+
+def add_device_args(parser):
+    parser.add_argument("--device", type=str, default=None, choices=["cuda", "cpu"],
+                        help="device to run on, default is cuda if available")
+    parser.add_argument("--cpu_threads", type=int, default=None, help="intra-op threads in CPU mode")
+    parser.add_argument("--cpu_interop_threads", type=int, default=None, help="inter-op threads in CPU mode")
+    parser.add_argument("--channels_last", action="store_true", help="use channels_last memory format in CPU mode")
+    parser.add_argument("--bf16", action="store_true", help="bfloat16 autocast for inference in CPU mode")
+    return parser
+
+
+def set_device_by_args(args):
+    if args.device is None:
+        return get_device()
+    return set_device(args.device, args.cpu_threads, args.cpu_interop_threads, args.channels_last, args.bf16)
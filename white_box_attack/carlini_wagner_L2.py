@@ -10,10 +10,8 @@ Referential implementation:
 from typing import Union, Tuple
 
 import copy
-import numpy as np
 import torch
 import torch.nn as nn
-import torch.optim as optim
 from torch.autograd import Variable
 
 from operator import methodcaller
@@ -108,18 +106,6 @@ def predict(model, inputs):
     return predictions
 
 
-def _var2numpy(var):
-    """
-    Make Variable to numpy array. No transposition will be made.
-
-    :param var: Variable instance on whatever device
-    :type var: Variable
-    :return: the corresponding numpy array
-    :rtype: np.ndarray
-    """
-    return var.detach().cpu().numpy()
-
-
 def atanh(x, eps=1e-6):
     """
     The inverse hyperbolic tangent function, missing in pytorch.
@@ -322,300 +308,230 @@ class CarliniWagnerL2(object):
         """
         Produce adversarial examples for ``inputs``.
 
+        All the bookkeeping (best L2, attack success, the binary search of the
+        scale constants) is kept in tensors on the device of ``model`` and
+        updated with masks. Within a binary search step an example whose loss
+        stops decreasing leaves the active set, so the forward/backward only
+        runs on the examples which are still being optimized.
+
         :param x: the processed images tensor, of dimension [B x C x H x W].
                ``x`` can be on either CPU or GPU, but it will eventually be
                moved to the same device as the one the parameters of ``model``
                reside
         :type inputs: torch.FloatTensor
-        :param target: the original image labels, or the attack targets, of
-               dimension [B]. If ``self.targeted`` is ``True``, then ``targets``
-               is treated as the attack targets, otherwise the labels.
-               ``targets`` can be on either CPU or GPU, but it will eventually
+        :param orig_class: the ground-truth image labels, of dimension [B]
+        :type orig_class: torch.LongTensor
+        :param target: the attack targets, of dimension [B]. If
+               ``self.targeted`` is ``False``, ``orig_class`` is used instead.
+               ``target`` can be on either CPU or GPU, but it will eventually
                be moved to the same device as the one the parameters of
                ``model`` reside
         :type target: torch.LongTensor
-        :param to_numpy: True to return an `np.ndarray`, otherwise,
-               `torch.FloatTensor`
-        :type to_numpy: bool
         :return: the adversarial examples on CPU, of dimension [B x C x H x W]
         """
-        # sanity check
-        # inputs = torch.from_numpy(orig_img).unsqueeze(0).float().cuda()  # B,H,W,C
-        # inputs = inputs.permute(0,3,1,2)
-        inputs = x.cuda().detach()
-        assert len(inputs.size()) == 4
+        assert len(x.size()) == 4
         assert len(target.size()) == 1
-
-        # get a copy of targets in numpy before moving to GPU, used when doing
-        # the binary search on `scale_const`
-        if self.targeted:
-            targets_np = target.clone().cpu().numpy()  # type: np.ndarray
-            target = make_cuda_consistent(self.model, target)[0]  # type: torch.FloatTensor
-        else:
-            targets_np = orig_class.clone().cpu().numpy()  # type: np.ndarray
-            target = make_cuda_consistent(self.model, orig_class)[0]  # type: torch.FloatTensor
-        # the type annotations here are used only for type hinting and do
-        # not indicate the actual type (cuda or cpu); same applies to all codes
-        # below
-        inputs = make_cuda_consistent(self.model, inputs)[0]  # type: torch.FloatTensor
-        # run the model a little bit to get the `num_classes`
-        with torch.no_grad():
-            num_classes = self.model(inputs).size(1)  # type: int
+        device = next(self.model.parameters()).device
+        inputs = x.detach().to(device)  # type: torch.FloatTensor
+        orig_class = orig_class.to(device)  # type: torch.LongTensor
+        # the attack targets if targeted, otherwise the image labels
+        target = target.to(device) if self.targeted else orig_class  # type: torch.LongTensor
         batch_size = inputs.size(0)  # type: int
 
-        # `lower_bounds_np`, `upper_bounds_np` and `scale_consts_np` are used
-        # for binary search of each `scale_const` in the batch. The element-wise
-        # inquality holds: lower_bounds_np < scale_consts_np <= upper_bounds_np
-        lower_bounds_np = np.zeros(batch_size)
-        upper_bounds_np = np.ones(batch_size) * self.c_range[1]
-        scale_consts_np = np.ones(batch_size) * self.c_range[0]
+        # `lower_bounds`, `upper_bounds` and `scale_consts` are used for binary
+        # search of each `scale_const` in the batch. The element-wise
+        # inquality holds: lower_bounds < scale_consts <= upper_bounds
+        lower_bounds = torch.zeros(batch_size, dtype=torch.float64, device=device)
+        upper_bounds = torch.full((batch_size,), self.c_range[1], dtype=torch.float64, device=device)
+        scale_consts = torch.full((batch_size,), self.c_range[0], dtype=torch.float64, device=device)
 
         # Optimal attack to be found.
-        # The three "placeholders" are defined as:
         # - `o_best_l2`: the least L2 norms
         # - `o_best_l2_ppred`: the perturbed predictions made by the adversarial
         #    perturbations with the least L2 norms
         # - `o_best_advx`: the underlying adversarial example of
         #   `o_best_l2_ppred`
-        o_best_l2 = np.ones(batch_size) * np.inf
-        o_best_l2_ppred = -np.ones(batch_size) # type: np.ndarray
-        o_best_advx = inputs.cpu().detach().numpy()  # type: np.ndarray
+        o_best_l2 = torch.full((batch_size,), float("inf"), device=device)
+        o_best_l2_ppred = torch.full((batch_size,), -1, dtype=torch.long, device=device)
+        o_best_advx = inputs.clone()
 
         # convert `inputs` to tanh-space
         inputs_tanh = self._to_tanh_space(inputs)  # type: torch.FloatTensor
-        inputs_tanh_var = Variable(inputs_tanh, requires_grad=False)
-
-        # the one-hot encoding of `targets`
-        targets_oh = torch.zeros(target.size() + (num_classes,)).cuda()  # type: torch.FloatTensor
-        targets_oh = make_cuda_consistent(self.model, targets_oh)[0]
-        targets_oh.scatter_(1, target.unsqueeze(1), 1.0)
-
-        targets_oh_var = Variable(targets_oh, requires_grad=False)
 
-        # the perturbation variable to optimize.
-        # `pert_tanh` is essentially the adversarial perturbation in tanh-space.
-        # In Carlini's code it's denoted as `modifier`
-        pert_tanh = torch.zeros(inputs.size()).cuda()  # type: torch.FloatTensor
+        # the perturbation to optimize, in Carlini's code it's denoted as `modifier`.
+        # It is updated by a masked Adam, whose moments and step counts are per example,
+        # so that the examples left the active set keep their state untouched.
+        pert_tanh = torch.zeros_like(inputs)  # type: torch.FloatTensor
         if self.init_rand:
-            nn.init.normal(pert_tanh, mean=0, std=1e-3)
-        pert_tanh = make_cuda_consistent(self.model, pert_tanh)[0]
-        pert_tanh_var = Variable(pert_tanh, requires_grad=True)
-        optimizer = optim.Adam([pert_tanh_var], lr=self.optimizer_lr)
+            nn.init.normal_(pert_tanh, mean=0, std=1e-3)
+        adam_m = torch.zeros_like(inputs)
+        adam_v = torch.zeros_like(inputs)
+        adam_steps = torch.zeros(batch_size, device=device)
+        check_interval = max(1, self.max_steps // 10)
         for sstep in range(self.binary_search_steps):
             if self.repeat and sstep == self.binary_search_steps - 1:
-                scale_consts_np = upper_bounds_np
-            scale_consts = torch.from_numpy(np.copy(scale_consts_np)).cuda().float()  # type: torch.FloatTensor
-            scale_consts = make_cuda_consistent(self.model, scale_consts)[0]
-            scale_consts_var = Variable(scale_consts, requires_grad=False)
+                scale_consts = upper_bounds.clone()
 
             # the minimum L2 norms of perturbations found during optimization
-            best_l2 = np.ones(batch_size) * np.inf
+            best_l2 = torch.full((batch_size,), float("inf"), device=device)
             # the perturbed predictions corresponding to `best_l2`, to be used
             # in binary search of `scale_const`
-            best_l2_ppred = -np.ones(batch_size)  # type: np.ndarray
-            # previous (summed) batch loss, to be used in early stopping policy
-            prev_batch_loss = np.inf  # type: float
+            best_l2_ppred = torch.full((batch_size,), -1, dtype=torch.long, device=device)
+            # previous loss of each example, to be used in early stopping policy
+            prev_loss = torch.full((batch_size,), float("inf"), device=device)
+            active = torch.arange(batch_size, device=device)
             for optim_step in range(self.max_steps):
-                batch_loss, pert_norms_np, pert_outputs_np, advxs_np = \
-                    self._optimize(self.model, optimizer, inputs_tanh_var,
-                                   pert_tanh_var, targets_oh_var,
-                                   scale_consts_var)
-
-                if self.abort_early and not optim_step % (self.max_steps // 10):
-                    if batch_loss > prev_batch_loss * (1 - self.ae_tol):
-                        break
-                    prev_batch_loss = batch_loss
+                losses, pert_norms, pert_outputs, advxs = self._optimize(
+                    self.model, inputs_tanh[active], pert_tanh, adam_m, adam_v, adam_steps, active,
+                    target[active], scale_consts[active].float(), orig_class[active], batch_size)
 
                 # update best attack found during optimization
-                pert_predictions_np = np.argmax(pert_outputs_np, axis=1)
-                comp_pert_predictions_np = np.argmax(
-                        self._compensate_confidence(pert_outputs_np,
-                                                    targets_np),
-                        axis=1)
-                for i in range(batch_size):
-                    l2 = pert_norms_np[i]
-                    cppred = comp_pert_predictions_np[i]
-                    ppred = pert_predictions_np[i]
-                    tlabel = targets_np[i]
-                    ax = advxs_np[i]
-                    if self._attack_successful(cppred, tlabel):
-                        assert cppred == ppred
-                        if l2 < best_l2[i]:
-                            best_l2[i] = l2
-                            best_l2_ppred[i] = ppred
-                        if l2 < o_best_l2[i]:
-                            o_best_l2[i] = l2
-                            o_best_l2_ppred[i] = ppred
-                            o_best_advx[i] = ax
+                pert_predictions = pert_outputs.argmax(1)
+                comp_pert_predictions = self._compensate_confidence(pert_outputs, target[active]).argmax(1)
+                successful = self._attack_successful(comp_pert_predictions, target[active])
+                better = successful & (pert_norms < best_l2[active])
+                best_l2[active[better]] = pert_norms[better]
+                best_l2_ppred[active[better]] = pert_predictions[better]
+                better = successful & (pert_norms < o_best_l2[active])
+                o_best_l2[active[better]] = pert_norms[better]
+                o_best_l2_ppred[active[better]] = pert_predictions[better]
+                o_best_advx[active[better]] = advxs[better]
+
+                if self.abort_early and not optim_step % check_interval:
+                    # the examples whose loss virtually stops decreasing leave the active set
+                    converged = losses > prev_loss[active] * (1 - self.ae_tol)
+                    prev_loss[active] = losses
+                    active = active[~converged]
+                    if active.numel() == 0:
+                        break
 
             # binary search of `scale_const`
-            for i in range(batch_size):
-                tlabel = targets_np[i]
-                assert best_l2_ppred[i] == -1 or \
-                       self._attack_successful(best_l2_ppred[i], tlabel)
-                assert o_best_l2_ppred[i] == -1 or \
-                       self._attack_successful(o_best_l2_ppred[i], tlabel)
-                if best_l2_ppred[i] != -1:
-                    # successful; attempt to lower `scale_const` by halving it
-                    if scale_consts_np[i] < upper_bounds_np[i]:
-                        upper_bounds_np[i] = scale_consts_np[i]
-                    # `upper_bounds_np[i] == c_range[1]` implies no solution
-                    # found, i.e. upper_bounds_np[i] has never been updated by
-                    # scale_consts_np[i] until
-                    # `scale_consts_np[i] > 0.1 * c_range[1]`
-                    if upper_bounds_np[i] < self.c_range[1] * 0.1:
-                        scale_consts_np[i] = (lower_bounds_np[i] + upper_bounds_np[i]) / 2
-                else:
-                    # failure; multiply `scale_const` by ten if no solution
-                    # found; otherwise do binary search
-                    if scale_consts_np[i] > lower_bounds_np[i]:
-                        lower_bounds_np[i] = scale_consts_np[i]
-                    if upper_bounds_np[i] < self.c_range[1] * 0.1:
-                        scale_consts_np[i] = (lower_bounds_np[i] + upper_bounds_np[i]) / 2
-                    else:
-                        scale_consts_np[i] *= 10
-        o_best_advx = torch.from_numpy(o_best_advx).float()
-        return o_best_advx
-
-
-    def _optimize(self, model, optimizer, inputs_tanh_var, pert_tanh_var,
-                  targets_oh_var, c_var):
+            successful = best_l2_ppred != -1
+            # successful; attempt to lower `scale_const` by halving it
+            upper_bounds = torch.where(successful & (scale_consts < upper_bounds), scale_consts, upper_bounds)
+            # failure; multiply `scale_const` by ten if no solution found; otherwise do binary search
+            lower_bounds = torch.where(~successful & (scale_consts > lower_bounds), scale_consts, lower_bounds)
+            # `upper_bounds[i] == c_range[1]` implies no solution found, i.e. upper_bounds[i] has never been
+            # updated by scale_consts[i] until `scale_consts[i] > 0.1 * c_range[1]`
+            scale_consts = torch.where(upper_bounds < self.c_range[1] * 0.1, (lower_bounds + upper_bounds) / 2,
+                                       torch.where(successful, scale_consts, scale_consts * 10))
+        return o_best_advx.detach().cpu().float()
+
+    def _extra_loss(self, advxs, orig_class, batch_size):
+        """
+        Additional loss of the active adversarial examples, added to the batch
+        loss before the backward. The plain attack has none.
+
+        :param advxs: the active adversarial examples, [A x C x H x W]
+        :param orig_class: the ground-truth labels of them, [A]
+        :param batch_size: the number of all examples ``B``
+        """
+        return 0
+
+    def _optimize(self, model, inputs_tanh, pert_tanh, adam_m, adam_v, adam_steps, active, targets, c, orig_class,
+                  batch_size):
         """
-        Optimize for one step.
+        Optimize the active examples for one step.
 
         :param model: the model to attack
         :type model: nn.Module
-        :param optimizer: the Adam optimizer to optimize ``modifier_var``
-        :type optimizer: optim.Adam
-        :param inputs_tanh_var: the input images in tanh-space
-        :type inputs_tanh_var: torch.FloatTensor
-        :param pert_tanh_var: the perturbation to optimize in tanh-space,
-               ``pert_tanh_var.requires_grad`` flag must be set to True
-        :type pert_tanh_var: torch.FloatTensor
-        :param targets_oh_var: the one-hot encoded target tensor (the attack
-               targets if self.targeted else image labels)
-        :type targets_oh_var: torch.FloatTensor
-        :param c_var: the constant :math:`c` for each perturbation of a batch,
-               a FloatTensor of dimension [B]
-        :type c_var: torch.FloatTensor
-        :return: the batch loss, squared L2-norm of adversarial perturbations
-                 (of dimension [B]), the perturbed activations (of dimension
-                 [B]), the adversarial examples (of dimension [B x C x H x W])
+        :param inputs_tanh: the active input images in tanh-space, [A x C x H x W]
+        :param pert_tanh: the perturbations in tanh-space of all examples,
+               [B x C x H x W], updated in place at the rows ``active``
+        :param adam_m: the first moments of Adam, [B x C x H x W]
+        :param adam_v: the second moments of Adam, [B x C x H x W]
+        :param adam_steps: the number of Adam steps taken by each example, [B]
+        :param active: the indexes of the active examples, [A]
+        :param targets: the attack targets if self.targeted else image labels, [A]
+        :param c: the constant :math:`c` of each active example, [A]
+        :param orig_class: the ground-truth labels, [A]
+        :param batch_size: the number of all examples ``B``
+        :return: the loss of each example (of dimension [A]), squared L2-norm of
+                 adversarial perturbations (of dimension [A]), the perturbed
+                 activations (of dimension [A x M]), the adversarial examples
+                 (of dimension [A x C x H x W]), all detached
         """
+        pert_var = pert_tanh[active].requires_grad_()
         # the adversarial examples in the image space
-        # of dimension [B x C x H x W]
-        advxs_var = self._from_tanh_space(inputs_tanh_var + pert_tanh_var)
+        advxs_var = self._from_tanh_space(inputs_tanh + pert_var)
         # the perturbed activation before softmax
         pert_outputs_var = model(advxs_var)
         # the original inputs
-        inputs_var = self._from_tanh_space(inputs_tanh_var)
-
-        perts_norm_var = torch.pow(advxs_var - inputs_var, 2)
-        perts_norm_var = torch.sum(perts_norm_var.view(
-                perts_norm_var.size(0), -1), 1)
-
-        # In Carlini's code, `target_activ_var` is called `real`.
-        # It should be a Variable of tensor of dimension [B], such that the
-        # `target_activ_var[i]` is the final activation (right before softmax)
-        # of the $t$th class, where $t$ is the attack target or the image label
-        #
-        # noinspection PyArgumentList
-        target_activ_var = torch.sum(targets_oh_var * pert_outputs_var, 1)
-        inf = 1e4  # sadly pytorch does not work with np.inf;
-                   # 1e4 is also used in Carlini's code
-        # In Carlini's code, `maxother_activ_var` is called `other`.
-        # It should be a Variable of tensor of dimension [B], such that the
-        # `maxother_activ_var[i]` is the maximum final activation of all classes
-        # other than class $t$, where $t$ is the attack target or the image
-        # label.
-        #
-        # The assertion here ensures (sufficiently yet not necessarily) the
-        # assumption behind the trick to get `maxother_activ_var` holds, that
-        # $\max_{i \ne t}{o_i} \ge -\text{_inf}$, where $t$ is the target and
-        # $o_i$ the $i$th element along axis=1 of `pert_outputs_var`.
-        #
-        # noinspection PyArgumentList
+        inputs_var = self._from_tanh_space(inputs_tanh)
+        perts_norm_var = torch.pow(advxs_var - inputs_var, 2).view(advxs_var.size(0), -1).sum(1)
+
+        # In Carlini's code, `target_activ_var` is called `real` and `maxother_activ_var` is called `other`,
+        # 1e4 is used as inf in Carlini's code
+        targets_oh = torch.zeros_like(pert_outputs_var).scatter_(1, targets.unsqueeze(1), 1.0)
+        inf = 1e4
         assert (pert_outputs_var.max(1)[0] >= -inf).all(), 'assumption failed'
-        # noinspection PyArgumentList
-        maxother_activ_var = torch.max(((1 - targets_oh_var) * pert_outputs_var
-                                        - targets_oh_var * inf), 1)[0]
+        target_activ_var = torch.sum(targets_oh * pert_outputs_var, 1)
+        maxother_activ_var = torch.max((1 - targets_oh) * pert_outputs_var - targets_oh * inf, 1)[0]
 
         # Compute $f(x')$, where $x'$ is the adversarial example in image space.
-        # The result `f_var` should be of dimension [B]
         if self.targeted:
             # if targeted, optimize to make `target_activ_var` larger than
             # `maxother_activ_var` by `self.confidence`
-            #
-            # noinspection PyArgumentList
-            f_var = torch.clamp(maxother_activ_var - target_activ_var
-                                + self.confidence, min=0.0)
+            f_var = torch.clamp(maxother_activ_var - target_activ_var + self.confidence, min=0.0)
         else:
             # if not targeted, optimize to make `maxother_activ_var` larger than
-            # `target_activ_var` (the ground truth image labels) by
-            # `self.confidence`
-            #
-            # noinspection PyArgumentList
-            f_var = torch.clamp(target_activ_var - maxother_activ_var
-                                + self.confidence, min=0.0)
-        # the total loss of current batch, should be of dimension [1]
-        batch_loss_var = torch.sum(perts_norm_var + c_var * f_var)  # type: torch.Tensor
-
-        # Do optimization for one step
-        optimizer.zero_grad()
-        batch_loss_var.backward()
-        optimizer.step()
-
-        # Make some records in python/numpy on CPU
-        batch_loss = batch_loss_var.item()
-        pert_norms_np = _var2numpy(perts_norm_var)
-        pert_outputs_np = _var2numpy(pert_outputs_var)
-        advxs_np = _var2numpy(advxs_var)
-        return batch_loss, pert_norms_np, pert_outputs_np, advxs_np
-
-    def _attack_successful(self, prediction, target):
+            # `target_activ_var` (the ground truth image labels) by `self.confidence`
+            f_var = torch.clamp(target_activ_var - maxother_activ_var + self.confidence, min=0.0)
+        losses_var = perts_norm_var + c * f_var
+        batch_loss_var = torch.sum(losses_var) + self._extra_loss(advxs_var, orig_class, batch_size)
+        grad = torch.autograd.grad(batch_loss_var, pert_var)[0]
+
+        # masked Adam step (the same update as optim.Adam with the default betas and eps)
+        with torch.no_grad():
+            beta1, beta2, eps = 0.9, 0.999, 1e-8
+            steps = adam_steps[active] + 1
+            adam_steps[active] = steps
+            m = adam_m[active].mul_(beta1).add_(grad, alpha=1 - beta1)
+            v = adam_v[active].mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            adam_m[active] = m
+            adam_v[active] = v
+            shape = (-1,) + (1,) * (grad.dim() - 1)
+            bias_correction1 = (1 - beta1 ** steps).view(shape)
+            bias_correction2 = (1 - beta2 ** steps).view(shape)
+            denom = (v.sqrt() / bias_correction2.sqrt()).add_(eps)
+            pert_tanh[active] = pert_var.detach() - self.optimizer_lr / bias_correction1 * m / denom
+        return losses_var.detach(), perts_norm_var.detach(), pert_outputs_var.detach(), advxs_var.detach()
+
+    def _attack_successful(self, predictions, targets):
         """
-        See whether the underlying attack is successful.
-
-        :param prediction: the prediction of the model on an input
-        :type prediction: int
-        :param target: either the attack target or the ground-truth image label
-        :type target: int
-        :return: ``True`` if the attack is successful
-        :rtype: bool
+        See whether the underlying attacks are successful.
+
+        :param predictions: the predictions of the model, [A]
+        :type predictions: torch.LongTensor
+        :param targets: either the attack targets or the ground-truth image labels, [A]
+        :type targets: torch.LongTensor
+        :return: a bool mask which is ``True`` where the attack is successful
+        :rtype: torch.BoolTensor
         """
         if self.targeted:
-            return prediction == target
+            return predictions == targets
         else:
-            return prediction != target
+            return predictions != targets
 
-    # noinspection PyUnresolvedReferences
     def _compensate_confidence(self, outputs, targets):
         """
         Compensate for ``self.confidence`` and returns a new weighted sum
         vector.
 
         :param outputs: the weighted sum right before the last layer softmax
-               normalization, of dimension [B x M]
-        :type outputs: np.ndarray
+               normalization, of dimension [A x M]
+        :type outputs: torch.FloatTensor
         :param targets: either the attack targets or the real image labels,
-               depending on whether or not ``self.targeted``, of dimension [B]
-        :type targets: np.ndarray
-        :return: the compensated weighted sum of dimension [B x M]
-        :rtype: np.ndarray
+               depending on whether or not ``self.targeted``, of dimension [A]
+        :type targets: torch.LongTensor
+        :return: the compensated weighted sum of dimension [A x M]
+        :rtype: torch.FloatTensor
         """
-        outputs_comp = np.copy(outputs)
-        rng = np.arange(targets.shape[0])
-        if self.targeted:
-            # for each image $i$:
-            # if targeted, `outputs[i, target_onehot]` should be larger than
-            # `max(outputs[i, ~target_onehot])` by `self.confidence`
-            outputs_comp[rng, targets] -= self.confidence
-        else:
-            # for each image $i$:
-            # if not targeted, `max(outputs[i, ~target_onehot]` should be larger
-            # than `outputs[i, target_onehot]` (the ground truth image labels)
-            # by `self.confidence`
-            outputs_comp[rng, targets] += self.confidence
+        # if targeted, `outputs[i, target]` should be larger than the others by `self.confidence`,
+        # if not targeted, the max of the others should be larger than `outputs[i, target]` by `self.confidence`
+        sign = -1.0 if self.targeted else 1.0
+        outputs_comp = outputs.clone()
+        outputs_comp[torch.arange(targets.size(0), device=targets.device), targets] += sign * self.confidence
         return outputs_comp
 
     def _to_tanh_space(self, x):
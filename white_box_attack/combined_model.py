@@ -3,6 +3,8 @@ import copy
 import torch
 # method from paper <Detecting Adversarial Examples through Image Transformation>
 # this model is only to generate adversarial examples
+# its output is an ordinary batch of logits, so the batched attacks (CarliniWagnerL2, IterativeGradientSign) run on it
+# directly: a target class wins only if it also beats the detector logit Z_D
 class CombinedModel(nn.Module):
     def  __init__(self, img_classifier, detector_network):
         super(CombinedModel, self).__init__()
@@ -1,5 +1,4 @@
 import os
-import random
 import sys
 
 
@@ -10,7 +9,6 @@ from white_box_attack.carlini_wagner_L2_neural_fingerprint import CarliniWagnerL
 from white_box_attack.iterative_FGSM_neural_fingerprint import IterativeFastGradientSignTargetedFingerprint
 
 from white_box_attack.iterative_FGSM import IterativeFastGradientSignTargeted
-from torch.utils.data import DataLoader
 import numpy as np
 from dataset.protocol_enum import SPLIT_DATA_PROTOCOL
 from image_rotate_detector.image_rotate import ImageTransformTorch
@@ -18,6 +16,7 @@ from image_rotate_detector.rotate_detector import Detector
 from neural_fingerprint.fingerprint_detector import NeuralFingerprintDetector
 from white_box_attack.carlini_wagner_L2 import CarliniWagnerL2
 from white_box_attack.combined_model import CombinedModel
+from white_box_attack.sharded_generation import SHARD_SIZE, generate_shards, merge_shards, num_shards_of
 
 
 from networks.conv3 import Conv3
@@ -49,6 +48,19 @@ parser.add_argument("--gpu",type=int,default=0)
 parser.add_argument("--atk_max_iter", type=int, default=100, help="max iterators of attack")
 parser.add_argument("--attack", type=str, default="CW_L2", choices=META_ATTACKER_PART_I+META_ATTACKER_PART_II)
 parser.add_argument("--protocol", type=SPLIT_DATA_PROTOCOL, help="the loaded detector model")
+parser.add_argument("--attack_batch_size", type=int, default=100, help="the number of images attacked together, "
+                    "the CW_L2 attack drops the converged images from the batch so larger batches are cheap")
+parser.add_argument("--gpus", type=str, default=None, help="comma separated GPUs, one generation worker process per GPU,"
+                                                            " overrides --gpu")
+parser.add_argument("--shard_size", type=int, default=SHARD_SIZE, help="the number of validation images of a shard")
+parser.add_argument("--loader_workers", type=int, default=0, help="the DataLoader workers of each generation worker")
+parser.add_argument("--seed", type=int, default=0, help="the seed of the random attack targets")
+parser.add_argument("--fgsm_eps", type=float, default=None, help="the L_inf radius of FGSM, set it to run BIM instead of "
+                                                                 "the unbounded I-FGSM")
+parser.add_argument("--fgsm_random_start", action="store_true", help="start FGSM from a random point of the eps ball (PGD)")
+parser.add_argument("--fgsm_no_early_stop", action="store_true", help="run all FGSM iterations even on the images "
+                    "which are already attacked successfully. Only for the detectors attacked through CombinedModel, "
+                    "the NeuralFP attack never stops early because its classifier alone does not see the detector")
 
 def build_meta_adv_detector(dataset,arch, adv_arch, shot, protocol):
     # extract_pattern = re.compile(
@@ -123,24 +135,47 @@ def build_neural_fingerprint_detector(dataset, arch, eps=0.1, num_dx=5):
     return detector
 
 
-def main():
-    args = parser.parse_args()
-    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu)
+def build_val_dataset(args):
     preprocessor = get_preprocessor(input_channels=IN_CHANNELS[args.dataset])
-
     if args.dataset == "CIFAR-10":
-        train_dataset = datasets.CIFAR10(IMAGE_DATA_ROOT[args.dataset], train=True, transform=preprocessor)
         val_dataset = datasets.CIFAR10(IMAGE_DATA_ROOT[args.dataset], train=False, transform=preprocessor)
     elif args.dataset == "MNIST":
-        train_dataset = datasets.MNIST(IMAGE_DATA_ROOT[args.dataset], train=True, transform=preprocessor, download=True)
         val_dataset = datasets.MNIST(IMAGE_DATA_ROOT[args.dataset], train=False, transform=preprocessor, download=True)
     elif args.dataset == "F-MNIST":
-        train_dataset = datasets.FashionMNIST(IMAGE_DATA_ROOT[args.dataset], train=True,transform=preprocessor, download=True)
         val_dataset = datasets.FashionMNIST(IMAGE_DATA_ROOT[args.dataset], train=False, transform=preprocessor, download=True)
     elif args.dataset=="SVHN":
-        train_dataset = SVHN(IMAGE_DATA_ROOT[args.dataset], train=True, transform=preprocessor)
         val_dataset = SVHN(IMAGE_DATA_ROOT[args.dataset], train=False, transform=preprocessor)
+    return val_dataset
+
+
+def get_output_paths(args):
+    ''' return the output dir, the clean and adversarial npz files and the directory of the shards '''
+    output_dir = "{}/adversarial_images/white_box@data_{}@det_{}".format(IMAGE_DATA_ROOT[args.dataset], args.adv_arch,
+                                                                       args.detector)
+    clean_file_name = output_dir + "/clean_{}@det_{}@protocol_{}@shot_{}@white_box.npz".format(args.dataset, args.detector, args.protocol, args.shot)
+    adv_file_name = output_dir + "/{}_{}@det_{}@protocol_{}@shot_{}@white_box.npz".format(args.attack, args.dataset, args.detector, args.protocol, args.shot)
+    shards_root = output_dir + "/shards_{}_{}@det_{}@protocol_{}@shot_{}@max_iter_{}@seed_{}".format(
+        args.attack, args.dataset, args.detector, args.protocol, args.shot, args.atk_max_iter, args.seed)
+    return output_dir, clean_file_name, adv_file_name, shards_root
+
+
+def main():
+    args = parser.parse_args()
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    gpus = args.gpus.split(",") if args.gpus else [str(args.gpu)]
+    if len(gpus) > 1:
+        torch.multiprocessing.spawn(run_worker, args=(args, gpus), nprocs=len(gpus))
+    else:
+        run_worker(0, args, gpus)
+    # 所有shard都生成完毕后再合并成evaluator读取的npz
+    _, clean_file_name, adv_file_name, shards_root = get_output_paths(args)
+    merge_shards(shards_root, num_shards_of(build_val_dataset(args), args.shard_size), clean_file_name, adv_file_name)
+
+
+def run_worker(rank, args, gpus):
+    ''' one generation worker on gpus[rank], which generates the shards shard_idx % len(gpus) == rank '''
+    os.environ['CUDA_VISIBLE_DEVICES'] = gpus[rank]
+    val_dataset = build_val_dataset(args)
 
     # load image classifier model
     img_classifier_model_path = "{}/train_pytorch_model/DL_IMAGE_CLASSIFIER_{}@{}@epoch_40@lr_0.0001@batch_500.pth.tar".format(PY_ROOT,
@@ -178,7 +213,8 @@ def main():
                                                 max_steps=args.atk_max_iter,optimizer_lr=0.01, neural_fp=detector_net)
         elif args.attack == "FGSM":
             attack = IterativeFastGradientSignTargetedFingerprint(img_classifier_network, alpha=0.01,
-                                                                  max_iters=args.atk_max_iter,neural_fp=detector_net)
+                                                                  max_iters=args.atk_max_iter,neural_fp=detector_net,
+                                                                  eps=args.fgsm_eps, random_start=args.fgsm_random_start)
     else:
         detector_net.eval()
         combined_model = CombinedModel(img_classifier_network, detector_net)
@@ -187,75 +223,19 @@ def main():
         if args.attack == "CW_L2":
             attack = CarliniWagnerL2(combined_model, True, confidence=0.3,search_steps=30, max_steps=args.atk_max_iter,optimizer_lr=0.01)
         elif args.attack == "FGSM":
-            attack = IterativeFastGradientSignTargeted(combined_model, alpha=0.01, max_iters=args.atk_max_iter)
-
-    generate(attack, args.attack, args.dataset, args.detector, val_dataset,
-             output_dir="{}/adversarial_images/white_box@data_{}@det_{}".format(IMAGE_DATA_ROOT[args.dataset],
-             args.adv_arch, args.detector), args=args)
-
-def generate(attacker, attack_name, dataset, detector_name, val_dataset, output_dir, args):
-    os.makedirs(output_dir, exist_ok=True)
-    # generate one by one
-    batch_size = 100
-    val_loader = DataLoader(val_dataset, batch_size=batch_size, shuffle=False, num_workers=0, pin_memory=True)
-
-    all_x_list = []
-    labels_list = []
-    all_gt_labels = []
-    for x, label in val_loader:  # label就是原始图像的分类label
-        real_x = x.detach().cpu().numpy()
-        all_x_list.extend(real_x)
-        for _ in range(len(real_x)):
-            labels_list.append(1)
-        all_gt_labels.extend(label.detach().cpu().numpy())
-        # 攻击成label=10，则认为是白盒攻击成功，对抗样本
-        x = x.cuda()
-        adv_target_label = torch.zeros(x.size(0)).long()
-        with torch.no_grad():
-            orig_out = attacker.model(x)
-            _, orig_pred = orig_out.max(1)
-            orig_pred = orig_pred.detach().cpu().numpy()
-            for idx, orig_label in enumerate(orig_pred):
-                r = list(range(0, orig_label)) + list(range(orig_label + 1, CLASS_NUM[dataset]))
-                adv_target_label[idx] = random.choice(r)
-        adv_target_label = adv_target_label.cuda()  # ! 攻击目标，既要让原始模型错误分类，也要让detector认为还是个干净得图片
-
-        adv_x = attacker.generate(x, label, adv_target_label)  # 一律攻击出一个label = 10的，表示是对抗样本
-
-        with torch.no_grad():
-            adv_x = adv_x.cuda()
-            adv_out = attacker.model(adv_x)
-            _, adv_pred = adv_out.max(1)
-            adv_pred = adv_pred.detach().cpu().numpy()
-            gt_labels = label.detach().cpu().numpy()
-
-            adv_x = adv_x.detach().cpu().numpy()
-            for idx, adv_label in enumerate(adv_pred):
-                orig_label = orig_pred[idx]
-                if adv_label != orig_label and adv_label != gt_labels[idx] and adv_label != CLASS_NUM[dataset]:
-                    labels_list.append(0)
-                    all_x_list.append(adv_x[idx])
-                    all_gt_labels.append(gt_labels[idx])
-    all_x_list = np.array(all_x_list)
-    labels_list = np.array(labels_list)
-    all_gt_labels = np.array(all_gt_labels)
-    clean_index = np.where(labels_list==1)[0]
-    adv_index = np.where(labels_list==0)[0]
-
-    clean_imgs = all_x_list[clean_index]
-    gt_clean = all_gt_labels[clean_index]
-
-    adv_imgs =all_x_list[adv_index]
-    gt_adv = all_gt_labels[adv_index]
-
-    clean_file_name = output_dir + "/clean_{}@det_{}@protocol_{}@shot_{}@white_box.npz".format(dataset, detector_name, args.protocol, args.shot)
-    adv_file_name = output_dir + "/{}_{}@det_{}@protocol_{}@shot_{}@white_box.npz".format(attack_name,dataset, detector_name, args.protocol, args.shot)
-    np.savez(clean_file_name, adv_images=clean_imgs, adv_label=np.ones(shape=clean_imgs.shape[0]), gt_label=gt_clean)
-    np.savez(adv_file_name, adv_images=adv_imgs, adv_label=np.zeros(shape=adv_imgs.shape[0]), gt_label=gt_adv)
-
-    print("done, save to {} and {}".format(clean_file_name, adv_file_name))
+            attack = IterativeFastGradientSignTargeted(combined_model, alpha=0.01, max_iters=args.atk_max_iter,
+                                                       eps=args.fgsm_eps, random_start=args.fgsm_random_start,
+                                                       early_stop=not args.fgsm_no_early_stop)
+
+    generate(attack, args.dataset, val_dataset, args, rank, len(gpus))
 
 
+def generate(attacker, dataset, val_dataset, args, rank=0, world_size=1):
+    ''' generate the shards of this worker into the shards directory, a finished shard is skipped on restart '''
+    _, _, _, shards_root = get_output_paths(args)
+    os.makedirs(shards_root, exist_ok=True)
+    generate_shards(attacker, dataset, val_dataset, shards_root, args.attack_batch_size, rank, world_size,
+                    shard_size=args.shard_size, num_workers=args.loader_workers, seed=args.seed)
 
 
 if __name__ == '__main__':
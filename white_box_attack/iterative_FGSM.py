@@ -5,116 +5,107 @@ Created on Fri Dec 16 01:24:11 2017
 """
 
 import torch
-from PIL import Image
-from torch import nn
+import torch.nn.functional as F
 
 
 
-class IterativeFastGradientSignUntargeted(object):
+class IterativeGradientSign(object):
     """
-        This class is similar to BasicIterativeMethodUntargeted
-         but its goal is to create a adversarial example whose prediction is different from the original prediction label.
-        It minimizes the initial class activation with iterative grad sign updates
+        Batched engine of I-FGSM / BIM / PGD, every step runs on the device.
+        eps=None is the plain I-FGSM; with eps the image is projected into the L_inf ball of radius eps around x after
+        every step (BIM), random_start additionally starts from a uniform point of that ball (PGD). box clamps the images.
+        With early_stop an example leaves the active set as soon as the attack is successful on it, so the following
+        steps only forward/backward the remaining examples; iterations records the number of steps of each example.
     """
-    def __init__(self, model, alpha=0.01, max_iters=10):
+    def __init__(self, model, alpha, max_iters=10, targeted=True, eps=None, random_start=False, box=None,
+                 early_stop=True):
         self.model = model
         self.model.eval()
         # Movement multiplier per iteration
         self.alpha = alpha
-        # Create the folder to export images if not exists
         self.max_iters = max_iters
+        self.targeted = targeted
+        self.eps = eps
+        self.random_start = random_start
+        self.box = box
+        self.early_stop = early_stop
+        self.iterations = None
 
-    def generate(self, x, orig_class, target):
-        # Define loss functions
-        ce_loss = nn.CrossEntropyLoss()
-        # Process image
-        processed_image = x.detach().cuda()
-        # Start iteration
+    def extra_loss(self, adv_x, orig_class):
+        # the additional loss of the active examples, which is minimized together with the attack loss
+        return 0
+
+    def attack_successful(self, out, orig_class, target):
+        if self.targeted:
+            return out.max(1)[1] == target
+        return out.max(1)[1] != orig_class
+
+    def project(self, adv_x, x):
+        if self.eps is not None:
+            adv_x = torch.min(torch.max(adv_x, x - self.eps), x + self.eps)
+        if self.box is not None:
+            adv_x = adv_x.clamp(self.box[0], self.box[1])
+        return adv_x
+
+    def generate_with_iterations(self, x, orig_class, target):
+        """
+        :return: the adversarial images and the number of steps taken by each of them
+        """
+        device = next(self.model.parameters()).device
+        x = x.detach().to(device)
+        orig_class = orig_class.to(device)
+        target = target.to(device) if self.targeted else orig_class
+        adv_x = x.clone()
+        if self.random_start and self.eps is not None:
+            adv_x = self.project(adv_x + torch.empty_like(x).uniform_(-self.eps, self.eps), x)
+        iterations = torch.full((x.size(0),), self.max_iters, dtype=torch.long, device=device)
+        active = torch.arange(x.size(0), device=device)
+        # targeted: 减小到target的CE, untargeted: 增大到原始类别的CE
+        direction = -1.0 if self.targeted else 1.0
         for i in range(self.max_iters):
-            # zero_gradients(x)
-            # Zero out previous gradients
-            # Can also use zero_gradients(x)
-            last_proceed_img = processed_image
-            processed_image = processed_image.detach()
-            del last_proceed_img
-            processed_image.requires_grad = True
-            processed_image.grad = None
-            self.model.zero_grad()
-            # Forward pass
+            processed_image = adv_x[active].requires_grad_()
             out = self.model(processed_image)
-            # Calculate CE loss
-            pred_loss = ce_loss(out, orig_class)
-            # Do backward pass
-            pred_loss.backward()
-            # Create Noise
-            # Here, processed_image.grad.data is also the same thing is the backward gradient from
-            # the first layer, can use that with hooks as well
-            adv_noise = self.alpha * torch.sign(processed_image.grad)
-            # Add Noise to processed image
-            processed_image = processed_image + adv_noise
+            keep = torch.ones(active.size(0), dtype=torch.bool, device=device)
+            if self.early_stop:
+                # the successful examples are finished, the forward of this step is reused for the check
+                with torch.no_grad():
+                    successful = self.attack_successful(out, orig_class[active], target[active])
+                iterations[active[successful]] = i
+                keep = ~successful
+                active = active[keep]
+                if active.numel() == 0:
+                    break
+            pred_loss = F.cross_entropy(out[keep], target[active]) + self.extra_loss(processed_image[keep],
+                                                                                     orig_class[active])
+            grad = torch.autograd.grad(pred_loss, processed_image)[0][keep]
+            with torch.no_grad():
+                adv_x[active] = self.project(processed_image.detach()[keep] + direction * self.alpha * torch.sign(grad),
+                                             x[active])
+        self.iterations = iterations
+        return adv_x, iterations
 
-            # Confirming if the image is indeed adversarial with added noise
-            # This is necessary (for some cases) because when we recreate image
-            # the values become integers between 1 and 255 and sometimes the adversariality
-            # is lost in the recreation process
-            # if gen_correct:
-            #     break
-            del out
-            del pred_loss
-        return processed_image
+    def generate(self, x, orig_class, target):
+        return self.generate_with_iterations(x, orig_class, target)[0]
 
 
-class IterativeFastGradientSignTargeted(object):
+class IterativeFastGradientSignUntargeted(IterativeGradientSign):
+    """
+        This class is similar to BasicIterativeMethodUntargeted
+         but its goal is to create a adversarial example whose prediction is different from the original prediction label.
+        It minimizes the initial class activation with iterative grad sign updates
+    """
+    def __init__(self, model, alpha=0.01, max_iters=10, eps=None, random_start=False, box=None, early_stop=True):
+        super(IterativeFastGradientSignUntargeted, self).__init__(model, alpha, max_iters, False, eps, random_start,
+                                                                  box, early_stop)
+
+
+class IterativeFastGradientSignTargeted(IterativeGradientSign):
     """
         The Basic Iterative Method is the iterative version of FGM and FGSM. If target labels are not specified, the
         attack aims for the least likely class (the prediction with the lowest score) for each input.
         Paper link: https://arxiv.org/abs/1607.02533
         It maximizes the target class activation with iterative grad sign updates
     """
-    def __init__(self, model, alpha, max_iters=10):
-        self.model = model
-        self.model.eval()
-        self.max_iters = max_iters
-        # Movement multiplier per iteration
-        self.alpha = alpha
-        # Create the folder to export images if not exists
-
-    def generate(self, x, orig_class, target):
-        # I honestly dont know a better way to create a variable with specific value
-        # Targeting the specific class
-        # Define loss functions
-        ce_loss = nn.CrossEntropyLoss()
-        # Process image
-        processed_image = x.detach().cuda()
-        # Start iteration
-        gen_correct = False
-        for i in range(self.max_iters):
-            # zero_gradients(x)
-            # Zero out previous gradients
-            # Can also use zero_gradients(x)
-            last_proceed_img = processed_image
-            processed_image = processed_image.detach()
-            del last_proceed_img
-            processed_image.requires_grad = True
-            processed_image.grad = None
-            self.model.zero_grad()
-            # Forward pass
-            out = self.model(processed_image)
-            # Calculate CE loss
-            pred_loss = ce_loss(out, target)
-            # Do backward pass
-            pred_loss.backward()
-            # Create Noise
-            # Here, processed_image.grad.data is also the same thing is the backward gradient from
-            # the first layer, can use that with hooks as well
-            adv_noise = self.alpha * torch.sign(processed_image.grad)
-            # Add noise to processed image
-            processed_image = processed_image - adv_noise
-
-            # Confirming if the image is indeed adversarial with added noise
-            # This is necessary (for some cases) because when we recreate image
-            # the values become integers between 1 and 255 and sometimes the adversariality
-            # is lost in the recreation process
-            del out
-            del pred_loss
-        return processed_image
+    def __init__(self, model, alpha, max_iters=10, eps=None, random_start=False, box=None, early_stop=True):
+        super(IterativeFastGradientSignTargeted, self).__init__(model, alpha, max_iters, True, eps, random_start,
+                                                                box, early_stop)
@@ -0,0 +1,146 @@
+import json
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from config import CLASS_NUM
+from toolkit.device import get_device, to_device
+
+'''
+Sharded, resumable white-box adversarial generation.
+The validation set is cut into shards of a fixed number of images and shard i is generated by worker i % num_workers,
+so that several processes (one per GPU) share the work. Every shard writes its clean images and the successful
+adversarial images batch by batch into preallocated npy memmaps, and its manifest.json records how many images are
+processed and how many adversarial images are kept. A restarted run skips the finished shards and continues an
+unfinished shard after its last written batch. merge_shards concatenates the shards in order into the
+*@white_box.npz files which the evaluators read.
+'''
+
+SHARD_SIZE = 1000
+STORE_NAMES = ["clean_images", "gt_labels", "adv_images", "adv_gt_labels"]
+
+
+def shard_dir(shards_root, shard_idx):
+    return "{}/shard_{}".format(shards_root, shard_idx)
+
+
+def read_manifest(path):
+    if not os.path.exists(path + "/manifest.json"):
+        return None
+    with open(path + "/manifest.json", "r") as file_obj:
+        return json.load(file_obj)
+
+
+def write_manifest(path, manifest):
+    with open(path + "/manifest.json.tmp", "w") as file_obj:
+        json.dump(manifest, file_obj)
+    os.replace(path + "/manifest.json.tmp", path + "/manifest.json")  # a manifest on disk is always complete
+
+
+def open_stores(path, num_images, image_shape, create):
+    ''' the npy memmaps of a shard, the adversarial stores are preallocated for every image of the shard '''
+    shapes = {"clean_images": (num_images,) + image_shape, "gt_labels": (num_images,),
+              "adv_images": (num_images,) + image_shape, "adv_gt_labels": (num_images,)}
+    dtypes = {"clean_images": np.float32, "gt_labels": np.int64, "adv_images": np.float32, "adv_gt_labels": np.int64}
+    if create:
+        return {name: np.lib.format.open_memmap("{}/{}.npy".format(path, name), mode="w+", dtype=dtypes[name],
+                                                shape=shapes[name]) for name in STORE_NAMES}
+    return {name: np.lib.format.open_memmap("{}/{}.npy".format(path, name), mode="r+") for name in STORE_NAMES}
+
+
+def attack_batch(attacker, dataset, x, label):
+    ''' attack one batch to random target classes, return the successful adversarial images and their gt labels '''
+    x = to_device(x)
+    with torch.no_grad():
+        _, orig_pred = attacker.model(x).max(1)
+        # 除orig_pred以外的类别中均匀随机选一个: orig_pred + [1, CLASS_NUM - 1] 的随机偏移
+        offset = torch.randint(1, CLASS_NUM[dataset], orig_pred.size(), device=orig_pred.device)
+        adv_target_label = (orig_pred + offset) % CLASS_NUM[dataset]  # ! 攻击目标，既要让原始模型错误分类，也要让detector认为还是个干净得图片
+
+    adv_x = attacker.generate(x, label, adv_target_label)  # 一律攻击出一个label = 10的，表示是对抗样本
+    if getattr(attacker, "iterations", None) is not None:
+        print("attack iterations: mean {:.1f} max {}".format(attacker.iterations.float().mean().item(),
+                                                             attacker.iterations.max().item()))
+
+    with torch.no_grad():
+        adv_x = to_device(adv_x.detach())
+        _, adv_pred = attacker.model(adv_x).max(1)
+    adv_pred, orig_pred = adv_pred.cpu(), orig_pred.cpu()
+    # 攻击成label=10，则认为是白盒攻击成功，对抗样本
+    success = (adv_pred != orig_pred) & (adv_pred != label) & (adv_pred != CLASS_NUM[dataset])
+    return adv_x.cpu()[success].numpy(), label[success].numpy()
+
+
+def generate_shard(attacker, dataset, val_dataset, path, start, end, batch_size, num_workers, seed):
+    os.makedirs(path, exist_ok=True)
+    manifest = read_manifest(path)
+    if manifest is not None and (manifest["start"], manifest["end"]) != (start, end):
+        raise IOError("{} holds images {}:{} instead of {}:{}, the shard size has changed".format(
+            path, manifest["start"], manifest["end"], start, end))
+    if manifest is not None and manifest["done"]:
+        return manifest
+    image_shape = tuple(val_dataset[start][0].size())
+    stores = open_stores(path, end - start, image_shape, create=manifest is None)
+    if manifest is None:
+        manifest = {"start": start, "end": end, "processed": 0, "num_adv": 0, "done": False}
+        write_manifest(path, manifest)
+    else:
+        print("resume {} from image {}/{}".format(path, manifest["processed"], end - start))
+    val_loader = DataLoader(Subset(val_dataset, range(start + manifest["processed"], end)), batch_size=batch_size,
+                            shuffle=False, num_workers=num_workers,
+                            pin_memory=get_device().type == "cuda")
+    for x, label in val_loader:
+        processed, num_adv = manifest["processed"], manifest["num_adv"]
+        torch.manual_seed(seed * 1000003 + start + processed)  # the random targets only depend on the image position
+        adv_imgs, gt_adv = attack_batch(attacker, dataset, x, label)
+        stores["clean_images"][processed: processed + x.size(0)] = x.numpy()
+        stores["gt_labels"][processed: processed + x.size(0)] = label.numpy()
+        stores["adv_images"][num_adv: num_adv + len(adv_imgs)] = adv_imgs
+        stores["adv_gt_labels"][num_adv: num_adv + len(adv_imgs)] = gt_adv
+        for store in stores.values():
+            store.flush()
+        # a crash before this line only repeats the batch, which is written to the same positions again
+        manifest["processed"] = processed + x.size(0)
+        manifest["num_adv"] = num_adv + len(adv_imgs)
+        write_manifest(path, manifest)
+        print("{}: {}/{} images, {} adversarial images".format(path, manifest["processed"], end - start,
+                                                              manifest["num_adv"]))
+    manifest["done"] = True
+    write_manifest(path, manifest)
+    return manifest
+
+
+def num_shards_of(val_dataset, shard_size=SHARD_SIZE):
+    return (len(val_dataset) + shard_size - 1) // shard_size
+
+
+def generate_shards(attacker, dataset, val_dataset, shards_root, batch_size, rank=0, world_size=1,
+                    shard_size=SHARD_SIZE, num_workers=0, seed=0):
+    ''' generate the shards shard_idx % world_size == rank, the finished ones are skipped '''
+    for shard_idx in range(rank, num_shards_of(val_dataset, shard_size), world_size):
+        start = shard_idx * shard_size
+        end = min(len(val_dataset), start + shard_size)
+        generate_shard(attacker, dataset, val_dataset, shard_dir(shards_root, shard_idx), start, end, batch_size,
+                       num_workers, seed)
+
+
+def merge_shards(shards_root, num_shards, clean_file_name, adv_file_name):
+    ''' concatenate all finished shards in order into the clean and adversarial *@white_box.npz files '''
+    arrays = {name: [] for name in STORE_NAMES}
+    for shard_idx in range(num_shards):
+        path = shard_dir(shards_root, shard_idx)
+        manifest = read_manifest(path)
+        if manifest is None or not manifest["done"]:
+            raise IOError("shard {} is not finished, please run the generation again".format(path))
+        for name in STORE_NAMES:
+            array = np.load("{}/{}.npy".format(path, name), mmap_mode="r")
+            arrays[name].append(array[:manifest["num_adv"]] if name.startswith("adv") else array)
+    clean_imgs = np.concatenate(arrays["clean_images"])
+    adv_imgs = np.concatenate(arrays["adv_images"])
+    np.savez(clean_file_name, adv_images=clean_imgs, adv_label=np.ones(shape=clean_imgs.shape[0]),
+             gt_label=np.concatenate(arrays["gt_labels"]))
+    np.savez(adv_file_name, adv_images=adv_imgs, adv_label=np.zeros(shape=adv_imgs.shape[0]),
+             gt_label=np.concatenate(arrays["adv_gt_labels"]))
+    print("done, save to {} and {}".format(clean_file_name, adv_file_name))